@@ -0,0 +1,77 @@
+"""Compares the per-pupil cost of the document context and compiled matchers
+
+Each case times the code as it was before `CTFContext` and the module-level
+compiled matchers were introduced (reproduced below) against the current code.
+Run with: python benchmarks/bench_context.py [pupils]
+"""
+import os
+import re
+import sys
+import timeit
+import xml.etree.ElementTree as ET
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import parse_CTFs as parser  # pylint: disable=import-error
+from synthetic_ctf import make_ctf
+
+
+def old_repair_case(parent_node: ET.Element) -> int:
+    fixed_cnt = 0
+    for tag in parser.NAME_TAGS:
+        for name_node in parent_node.findall('.//' + tag):
+            name = name_node.text
+            if name is not None and re.match(r'[A-Z.\'\-\s]+$', name):
+                name_node.text = name.title()
+                fixed_cnt += 1
+    return fixed_cnt
+
+
+def old_history_search(root_node: ET.Element, source_name: str) -> list:
+    return root_node.findall(
+        f".//SchoolHistory/School/[SchoolName=\"{source_name}\"]")
+
+
+def old_output_dir_facts(root: ET.Element) -> tuple:
+    """The lookups get_output_dir and are_joining_mid_year each made"""
+    year_group = root.find('.//NCyearActual')
+    source_in_hists = old_history_search(root, parser.get_source_school(root))
+    dob_node = root.find('.//Pupil/DOB')
+    return year_group, source_in_hists, dob_node, root.find('.//DateTime')
+
+
+def new_output_dir_facts(root: ET.Element) -> tuple:
+    ctx = parser.CTFContext(root)
+    return ctx.ncyear_actual, ctx.source_in_hists, ctx.first_dob, \
+        ctx.creation_date
+
+
+def per_pupil_us(statement, pupils: int, ctf: bytes, repeat: int = 5) -> float:
+    """Best time of `statement(root)` on a fresh tree, in µs per pupil"""
+    times = []
+    for _ in range(repeat):
+        root = ET.fromstring(ctf)
+        times.append(timeit.timeit(lambda: statement(root), number=1))
+    return min(times) / pupils * 1e6
+
+
+def main(pupils: int = 5000):
+    ctf = make_ctf(pupils)
+    source = parser.get_source_school(ET.fromstring(ctf))
+    cases = [
+        ('case repair', old_repair_case,
+         parser.repair_case_where_appropriate),
+        ('source school in histories',
+         lambda root: old_history_search(root, source),
+         lambda root: parser.source_school_appearances_in_history(root,
+                                                                  source)),
+        ('output dir facts', old_output_dir_facts, new_output_dir_facts),
+    ]
+    print(f'{pupils} pupils; µs per pupil (best of 5)')
+    print(f'{"":28} {"before":>8} {"after":>8} {"speedup":>8}')
+    for name, old, new in cases:
+        before = per_pupil_us(old, pupils, ctf)
+        after = per_pupil_us(new, pupils, ctf)
+        print(f'{name:28} {before:8.2f} {after:8.2f} {before / after:7.1f}x')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
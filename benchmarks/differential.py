@@ -0,0 +1,299 @@
+"""Checks that every engine fixes CTFs exactly as the reference engine does
+
+Each CTF of a corpus (the sample CTFs in test/CTFs, synthetic CTFs covering
+upper-case names, untidy contact details, missing surnames, comments and each
+kind of output folder, plus any CTFs named on the command line) is processed
+by `process_ctf` with the reference engine, which parses the whole tree with
+xml.etree and writes it out again, and then with each alternative engine:
+streaming, patching and sharding, with each installed XML backend. Each
+output is compared with the reference's after canonicalising both (C14N 2.0,
+so formatting, attribute order and comments don't count), as are the fixes
+made and the folders and files written. Any difference is listed, and the
+throughput of every engine on every CTF is shown side by side.
+
+python benchmarks/differential.py
+python benchmarks/differential.py --pupils 5000 "CTF Inbox/*.xml"
+python benchmarks/differential.py --engines tree lxml_sharded
+"""
+import os
+import sys
+import glob
+import time
+import shutil
+import argparse
+import tempfile
+import xml.etree.ElementTree as StdET
+from typing import Optional
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import parse_CTFs as parser  # pylint: disable=import-error
+from synthetic_ctf import make_ctf
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLES_DIR = os.path.join(REPO_DIR, 'test', 'CTFs')
+BACKENDS = [name for name, module in parser.XML_BACKENDS.items() if module]
+# The engine every other is compared with
+REFERENCE = 'tree'
+# Synthetic CTF name: make_ctf keyword arguments. Year 6s go to the year 7
+# folder, year 11s to the year 12 folder and year 9s to CTF_In.
+SYNTHETIC = {
+    'synthetic_mixed': {},
+    'synthetic_upper_case': {'upper_case': 1.0, 'spaced_phones': 1.0},
+    'synthetic_messy_contacts': {'messy_contacts': 0.5},
+    'synthetic_missing_surnames': {'missing_surnames': 0.3},
+    'synthetic_no_contacts': {'contacts': 0},
+    'synthetic_year_11': {'year_group': 11},
+    'synthetic_year_9': {'year_group': 9},
+}
+# A synthetic CTF with a comment before its first pupil, which the patch
+# output keeps and the sharded engine can't split around
+COMMENTED = 'synthetic_commented'
+# The date runs are taken to be on, so outputs go to the same folders
+# whenever the corpus is checked
+RUN_DATE = '2020-06-26'
+# Answers to the questions processing may ask
+ANSWERS = {parser.ABORT_QUESTION: False, parser.MID_YEAR_QUESTION: False}
+# Shards small enough for the synthetic CTFs to be sharded
+DEFAULT_SHARD_BYTES = 64 << 10
+
+
+def engines(backends: Optional[list] = None) -> dict:
+    """The engines to compare, with the reference first
+
+    Args:
+        backends: The XML backends to use; those installed by default
+    Returns:
+        {name: (streaming, run settings)}, names prefixed by the backend
+        unless it is xml.etree
+    """
+
+    found = {}
+    for backend in backends or BACKENDS:
+        prefix = '' if backend == 'etree' else f'{backend}_'
+        settings = {'xmlBackend': backend}
+        found.update({
+            f'{prefix}tree': (False, settings),
+            f'{prefix}streaming': (True, settings),
+            f'{prefix}patch': (False, {**settings, 'outputMode': 'patch'}),
+            f'{prefix}sharded': (False, {**settings, 'shardWorkers': 2}),
+        })
+    return {REFERENCE: (False, {'xmlBackend': 'etree'}), **found}
+
+
+def build_corpus(corpus_dir: str, pupils: int,
+                 extra: Optional[list] = None) -> list:
+    """Write the corpus to corpus_dir, returning the paths of its CTFs
+
+    Args:
+        pupils: The number of pupils in each synthetic CTF
+        extra: Paths or glob patterns of more CTFs to include, which are
+            read where they are
+    """
+
+    os.makedirs(corpus_dir, exist_ok=True)
+    paths = []
+    for name in sorted(os.listdir(SAMPLES_DIR)):
+        paths.append(shutil.copy(os.path.join(SAMPLES_DIR, name),
+                                 corpus_dir))
+    for seed, (name, options) in enumerate(SYNTHETIC.items()):
+        paths.append(write_ctf(corpus_dir, name,
+                               make_ctf(pupils, seed, **options)))
+    commented = make_ctf(pupils, len(SYNTHETIC)).replace(
+        b'<CTFpupilData>', b'<CTFpupilData>\n<!-- Exported from SIMS -->', 1)
+    paths.append(write_ctf(corpus_dir, COMMENTED, commented))
+    for pattern in extra or []:
+        paths.extend(sorted(glob.glob(pattern)) or [pattern])
+    return paths
+
+
+def write_ctf(corpus_dir: str, name: str, data: bytes) -> str:
+    """Write a generated CTF to the corpus, returning its path"""
+
+    path = os.path.join(corpus_dir, f'{name}.xml')
+    with open(path, 'wb') as ctf_file:
+        ctf_file.write(data)
+    return path
+
+
+def run_engine(ctf_path: str, streaming: bool, settings: dict,
+               work_dir: str) -> dict:
+    """Process a copy of a CTF with one engine
+
+    The copy is made in work_dir/in, and outputs go under work_dir/out.
+    Returns:
+        Dict with the 'success' of processing, the 'seconds' it took, the
+        'fixes' made, what was 'printed' and the 'outputs' written, as
+        {path relative to work_dir/out: canonical XML}
+    """
+
+    in_dir = os.path.join(work_dir, 'in')
+    out_dir = os.path.join(work_dir, 'out')
+    os.makedirs(in_dir)
+    copy = shutil.copy(ctf_path, in_dir)
+    settings = {**settings, 'destinationParentDir': out_dir,
+                'runDate': RUN_DATE,
+                'statsLog': os.path.join(work_dir, 'stats.jsonl')}
+    start = time.perf_counter()
+    success, printed, stats = parser.process_ctf_quietly(
+        copy, streaming, ANSWERS, settings)
+    seconds = time.perf_counter() - start
+    outputs = {}
+    for folder, _, names in os.walk(out_dir):
+        for name in names:
+            path = os.path.join(folder, name)
+            outputs[os.path.relpath(path, out_dir).replace(os.sep, '/')] = \
+                canonical(path)
+    return {'success': success, 'seconds': seconds, 'printed': printed,
+            'fixes': (stats or {}).get('fixes'), 'outputs': outputs}
+
+
+def canonical(path: str) -> str:
+    """The C14N 2.0 form of an XML file, without comments"""
+
+    try:
+        return StdET.canonicalize(from_file=path)
+    except StdET.ParseError as parse_error:
+        return f'Not well-formed: {parse_error}'
+
+
+def differences(reference: dict, result: dict) -> list:
+    """How an engine's result differs from the reference engine's"""
+
+    found = []
+    if result['success'] != reference['success']:
+        found.append(f"succeeded: {result['success']}, reference: "
+                     f"{reference['success']}")
+    if result['fixes'] != reference['fixes']:
+        found.append(f"fixes: {result['fixes']}, reference: "
+                     f"{reference['fixes']}")
+    if set(result['outputs']) != set(reference['outputs']):
+        found.append(f"output to: {sorted(result['outputs'])}, reference: "
+                     f"{sorted(reference['outputs'])}")
+    for path in sorted(set(result['outputs']) & set(reference['outputs'])):
+        output, expected = result['outputs'][path], reference['outputs'][path]
+        if output != expected:
+            offset = next((i for i, (a, b) in enumerate(zip(output, expected))
+                           if a != b), min(len(output), len(expected)))
+            start = max(offset - 20, 0)
+            found.append(f'{path} differs at character {offset}: '
+                         f'{output[start:offset + 40]!r}, reference: '
+                         f'{expected[start:offset + 40]!r}')
+    return found
+
+
+def compare_engines(ctf_paths: list, engines_to_run: dict, work_dir: str,
+                    shard_bytes: int = DEFAULT_SHARD_BYTES) -> dict:
+    """Process every CTF with every engine, comparing each with the reference
+
+    Args:
+        engines_to_run: {name: (streaming, run settings)}, the reference
+            first; see `engines`
+        work_dir: Folder to process copies of the CTFs in
+        shard_bytes: The shard size while comparing (see SHARD_BYTES), small
+            enough for the corpus to be sharded
+    Returns:
+        {CTF path: {engine name: {'bytes': int, 'seconds': float,
+                                  'differences': list}}}
+    """
+
+    results = {}
+    previous_shard_bytes = parser.SHARD_BYTES
+    parser.SHARD_BYTES = shard_bytes
+    try:
+        for ctf_number, ctf_path in enumerate(ctf_paths):
+            reference = None
+            results[ctf_path] = {}
+            for name, (streaming, settings) in engines_to_run.items():
+                run_dir = os.path.join(work_dir, str(ctf_number), name)
+                result = run_engine(ctf_path, streaming, settings, run_dir)
+                shutil.rmtree(run_dir)
+                if reference is None:
+                    reference = result
+                results[ctf_path][name] = {
+                    'bytes': os.path.getsize(ctf_path),
+                    'seconds': result['seconds'],
+                    'differences': differences(reference, result)}
+    finally:
+        parser.SHARD_BYTES = previous_shard_bytes
+    return results
+
+
+def report(results: dict) -> int:
+    """Print the throughput of each engine on each CTF and any differences
+
+    Returns:
+        The number of results differing from the reference
+    """
+
+    names = list(next(iter(results.values())))
+    width = max(len(name) for name in names) + 2
+    ctf_width = max(len(os.path.basename(path)) for path in results) + 2
+    print('Throughput (MB/s); * differs from', names[0])
+    print(f"{'CTF':<{ctf_width}}" +
+          ''.join(f'{name:>{width}}' for name in names))
+    totals = dict.fromkeys(names, 0.0)
+    total_mb = 0.0
+    for path, by_engine in results.items():
+        megabytes = by_engine[names[0]]['bytes'] / 1e6
+        total_mb += megabytes
+        row = f'{os.path.basename(path):<{ctf_width}}'
+        for name in names:
+            result = by_engine[name]
+            totals[name] += result['seconds']
+            cell = f"{megabytes / result['seconds']:.2f}"
+            cell += '*' if result['differences'] else ' '
+            row += f'{cell:>{width}}'
+        print(row)
+    print(f"{'all':<{ctf_width}}" + ''.join(
+        f'{total_mb / totals[name]:>{width - 1}.2f} ' for name in names))
+    differing = 0
+    for path, by_engine in results.items():
+        for name, result in by_engine.items():
+            if result['differences']:
+                differing += 1
+                print(f'\n{os.path.basename(path)} with {name}:')
+                for difference in result['differences']:
+                    print(' ', difference)
+    print(f'\n{differing} of {len(results) * (len(names) - 1)} results '
+          'differ from the reference')
+    return differing
+
+
+def main(argv: Optional[list] = None) -> int:
+    arg_parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    arg_parser.add_argument('ctfs', nargs='*', metavar='CTF',
+                            help='More CTFs (or glob patterns) to check')
+    arg_parser.add_argument('--pupils', type=int, default=500,
+                            help='Pupils in each synthetic CTF')
+    arg_parser.add_argument('--backends', nargs='+', choices=BACKENDS,
+                            default=BACKENDS)
+    arg_parser.add_argument('--engines', nargs='+', metavar='ENGINE',
+                            help='Engines to compare with the reference; '
+                                 'all of them by default')
+    arg_parser.add_argument('--shard-bytes', type=int,
+                            default=DEFAULT_SHARD_BYTES,
+                            help='Shard size for the sharded engines')
+    args = arg_parser.parse_args(argv)
+
+    engines_to_run = engines(args.backends)
+    if args.engines:
+        unknown = set(args.engines) - set(engines_to_run)
+        if unknown:
+            arg_parser.error(f"unknown engines: {', '.join(sorted(unknown))}"
+                             f"; choose from {', '.join(engines_to_run)}")
+        engines_to_run = {name: engine for name, engine
+                          in engines_to_run.items()
+                          if name == REFERENCE or name in args.engines}
+    work_dir = tempfile.mkdtemp(prefix='ctf_differential_')
+    try:
+        corpus = build_corpus(os.path.join(work_dir, 'corpus'), args.pupils,
+                              args.ctfs)
+        results = compare_engines(corpus, engines_to_run,
+                                  os.path.join(work_dir, 'runs'),
+                                  args.shard_bytes)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return 1 if report(results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
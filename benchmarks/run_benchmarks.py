@@ -0,0 +1,269 @@
+"""Times the parser on synthetic CTFs from 1 to 100,000 pupils
+
+For each size a CTF is generated (see synthetic_ctf.py), then, with each
+XML backend (xml.etree and, if it is installed, lxml)
+- parsing, each fixer and writing are timed on their own, in this process,
+- the whole pipeline is run with each engine in a fresh process, so its peak
+  RSS can be measured.
+Wall time, microseconds per pupil and (for the pipelines) peak RSS are
+reported. The startup time of a fresh interpreter importing the parser, and
+of the command line, is timed too. Timings can be saved as a baseline, and
+later runs flag any stage whose per-pupil cost (or startup time) has risen by
+more than the tolerance.
+
+python benchmarks/run_benchmarks.py --sizes 1 1000 100000 --save-baseline
+python benchmarks/run_benchmarks.py --check
+python benchmarks/run_benchmarks.py --backends lxml
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import subprocess
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import parse_CTFs as parser  # pylint: disable=import-error
+from synthetic_ctf import make_ctf
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'baseline.json')
+DEFAULT_SIZES = [1, 100, 1000, 10000]
+
+# Each fixer run on its own over a whole parsed tree
+FIXER_STAGES = {
+    'case': parser.repair_case_where_appropriate,
+    'empty_nodes': lambda root: parser.trim_empty_nodes(
+        root, parser.get_source_school(root)),
+    'phone_numbers': parser.remove_spaces_from_phone_numbers,
+    'surnames': parser.ensure_surnames_are_legal,
+    'contacts': parser.normalise_contact_details,
+}
+# Pipeline name: (streaming, output mode, shard workers). Only CTFs of at
+# least two shards (8 MB, about 5000 pupils) are sharded.
+ENGINES = {'pipeline': (False, 'rewrite', None),
+           'pipeline_streaming': (True, 'rewrite', None),
+           'pipeline_patch': (False, 'patch', None),
+           'pipeline_sharded': (False, 'rewrite', os.cpu_count())}
+BACKENDS = [name for name, module in parser.XML_BACKENDS.items() if module]
+# The date runs are taken to be on, a week after the synthetic CTFs were made,
+# so outputs go to the same folders whenever the benchmarks are run
+RUN_DATE = '2020-06-26'
+# Commands timed from a fresh interpreter for the startup time
+STARTUP_COMMANDS = {
+    'import': [sys.executable, '-c', 'import parse_CTFs'],
+    'command line --help': [sys.executable, 'parse_CTFs.py', '--help'],
+}
+
+
+def peak_rss_kb() -> int:
+    """Peak resident set size of this process in KB, or 0 if unknown"""
+    try:
+        # Unlike ru_maxrss, this isn't inherited from the parent through exec
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except FileNotFoundError:
+        pass
+    try:
+        import resource
+    except ImportError:  # Windows
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def best_time(stage, ctf_path: str, repeat: int) -> float:
+    """Best wall time in seconds of `stage(root)` on freshly parsed trees"""
+    times = []
+    for _ in range(repeat):
+        root = parser.parse_xml(ctf_path).getroot()
+        start = time.perf_counter()
+        stage(root)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def time_stages(ctf_path: str, repeat: int, backend: str) -> dict:
+    """Seconds taken to parse, run each fixer and write the CTF"""
+    parser.use_backend(backend)
+    timings = {}
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        parser.parse_xml(ctf_path)
+        times.append(time.perf_counter() - start)
+    timings['parse'] = min(times)
+    for name, stage in FIXER_STAGES.items():
+        timings[name] = best_time(stage, ctf_path, repeat)
+    timings['write'] = best_time(
+        lambda root: parser.ET.ElementTree(root).write(
+            os.devnull, encoding='UTF-8', xml_declaration=True),
+        ctf_path, repeat)
+    return timings
+
+
+def run_pipeline(ctf_path: str, out_dir: str, streaming: bool,
+                 output_mode: str, shard_workers: Optional[int],
+                 backend: str) -> tuple:
+    """Process a copy of the CTF as the command line would
+
+    Run in a fresh process so the peak RSS is the pipeline's own.
+    Returns:
+        (seconds, peak RSS in KB) tuple
+    """
+
+    copy_path = os.path.join(out_dir, 'in', os.path.basename(ctf_path))
+    os.makedirs(os.path.dirname(copy_path), exist_ok=True)
+    shutil.copy(ctf_path, copy_path)
+    parser.RUN_SETTINGS['destinationParentDir'] = os.path.join(out_dir, 'out')
+    parser.RUN_SETTINGS['xmlBackend'] = backend
+    parser.RUN_SETTINGS['outputMode'] = output_mode
+    parser.RUN_SETTINGS['shardWorkers'] = shard_workers
+    parser.RUN_SETTINGS['runDate'] = RUN_DATE
+    parser.PRESET_ANSWERS.update({parser.ABORT_QUESTION: False,
+                                  parser.MID_YEAR_QUESTION: False})
+    start = time.perf_counter()
+    success, _, _ = parser.process_ctf_quietly(copy_path, streaming, {})
+    seconds = time.perf_counter() - start
+    if not success:
+        raise RuntimeError(f'Processing {ctf_path} failed')
+    return seconds, peak_rss_kb()
+
+
+def time_startup(repeat: int) -> dict:
+    """Best wall time in seconds of each of the STARTUP_COMMANDS"""
+    timings = {}
+    for name, command in STARTUP_COMMANDS.items():
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.run(command, cwd=REPO_DIR, check=True,
+                           stdout=subprocess.DEVNULL)
+            times.append(time.perf_counter() - start)
+        timings[name] = {'seconds': min(times)}
+    return timings
+
+
+def run(sizes: list, args: argparse.Namespace) -> dict:
+    """Benchmark each size, returning {size: {stage: result}}"""
+    results = {'startup': time_startup(args.repeat)}
+    print('\nStartup')
+    for name, result in results['startup'].items():
+        print(f'  {name:26} {result["seconds"]:9.4f}')
+    spawn = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as work_dir:
+        for size in sizes:
+            ctf_path = os.path.join(work_dir, f'synthetic_{size}.xml')
+            with open(ctf_path, 'wb') as ctf_file:
+                ctf_file.write(make_ctf(size, args.seed, args.upper_case,
+                                        args.spaced_phones,
+                                        args.missing_surnames,
+                                        messy_contacts=args.messy_contacts))
+            repeat = max(1, min(args.repeat, 100000 // (size * 10) or 1))
+            stages = {}
+            for backend in args.backends:
+                for name, seconds in time_stages(ctf_path, repeat,
+                                                 backend).items():
+                    stages[f'{backend} {name}'] = {'seconds': seconds}
+                for name, engine in ENGINES.items():
+                    out_dir = os.path.join(work_dir,
+                                           f'{backend}_{name}_{size}')
+                    with ProcessPoolExecutor(1, mp_context=spawn) as executor:
+                        seconds, rss = executor.submit(
+                            run_pipeline, ctf_path, out_dir, *engine,
+                            backend).result()
+                    stages[f'{backend} {name}'] = {'seconds': seconds,
+                                                   'peak_rss_kb': rss}
+            for result in stages.values():
+                result['us_per_pupil'] = result['seconds'] / size * 1e6
+            results[str(size)] = stages
+            print_size(size, os.path.getsize(ctf_path), stages)
+    return results
+
+
+def print_size(size: int, file_bytes: int, stages: dict):
+    print(f'\n{size} pupils ({file_bytes / 1e6:.1f} MB)')
+    print(f'  {"stage":26} {"wall s":>9} {"µs/pupil":>9} {"peak RSS MB":>12}')
+    for name, result in stages.items():
+        rss = result.get('peak_rss_kb')
+        rss = f'{rss / 1024:12.1f}' if rss else ''
+        print(f'  {name:26} {result["seconds"]:9.4f} '
+              f'{result["us_per_pupil"]:9.1f} {rss}')
+
+
+def regressions(results: dict, baseline: dict, tolerance: float) -> list:
+    """List the stages whose per-pupil cost (or, for startup, time) exceeds
+    the baseline's by more than `tolerance` (a proportion)"""
+    found = []
+    for size, stages in results.items():
+        for name, result in stages.items():
+            base = baseline.get(size, {}).get(name)
+            if size == 'startup':
+                measure, unit, where = 'seconds', 's', 'startup'
+            else:
+                measure, unit, where = 'us_per_pupil', 'µs/pupil', \
+                    f'{size} pupils'
+            if base and measure in base and (
+                    result[measure] > base[measure] * (1 + tolerance)):
+                found.append(f'{where}, {name}: {result[measure]:.4g} {unit} '
+                             f'vs {base[measure]:.4g} baseline')
+    return found
+
+
+def main(argv: list = None) -> int:
+    arg_parser = argparse.ArgumentParser(
+        description='Benchmark the CTF parser on synthetic CTFs')
+    arg_parser.add_argument('--sizes', type=int, nargs='+',
+                            default=DEFAULT_SIZES,
+                            help='numbers of pupils (up to 100000)')
+    arg_parser.add_argument('--repeat', type=int, default=5,
+                            help='repeats of each in-process timing; the '
+                                 'best is kept (fewer for big files)')
+    arg_parser.add_argument('--backends', nargs='+', choices=BACKENDS,
+                            default=BACKENDS,
+                            help='XML backends to time (default: all '
+                                 'installed)')
+    arg_parser.add_argument('--seed', type=int, default=0)
+    arg_parser.add_argument('--upper-case', type=float, default=0.2)
+    arg_parser.add_argument('--spaced-phones', type=float, default=0.5)
+    arg_parser.add_argument('--missing-surnames', type=float, default=0.05)
+    arg_parser.add_argument('--messy-contacts', type=float, default=0.0,
+                            help='proportion of contact details to '
+                                 'normalise (gives contacts emails)')
+    arg_parser.add_argument('--baseline', default=BASELINE_PATH)
+    arg_parser.add_argument('--save-baseline', action='store_true',
+                            help='save these results as the baseline')
+    arg_parser.add_argument('--check', action='store_true',
+                            help='exit with status 1 if any stage regressed')
+    arg_parser.add_argument('--tolerance', type=float, default=0.25,
+                            help='allowed rise in µs/pupil over the baseline '
+                                 '(default: 0.25, ie 25%%)')
+    args = arg_parser.parse_args(argv)
+
+    results = run(args.sizes, args)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=1)
+        print('\nBaseline saved to', args.baseline)
+        return 0
+    if not os.path.exists(args.baseline):
+        return 0
+    with open(args.baseline) as baseline_file:
+        found = regressions(results, json.load(baseline_file), args.tolerance)
+    if found:
+        print('\nREGRESSIONS against', args.baseline)
+        print('\n'.join('  ' + regression for regression in found))
+    else:
+        print('\nNo regressions against', args.baseline)
+    return 1 if found and args.check else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,147 @@
+"""Generates synthetic CTFs of any size for benchmarking the parser
+
+Run as a script to write one to a file:
+python benchmarks/synthetic_ctf.py 10000 big.xml --upper-case 0.3
+"""
+import sys
+import random
+import argparse
+
+FORENAMES = ['Oliver', 'Amelia', 'George', 'Isla', 'Noah', 'Ava', 'Arthur',
+             'Mia', 'Muhammad', 'Ivy', 'Leo', 'Lily', "D'arcy", 'Mary-Jane']
+SURNAMES = ['Smith', 'Jones', 'Taylor', 'Brown', "O'Neill", 'Williams',
+            'Davies', 'Evans', 'Wilson', 'Van Der Berg', 'Mcdonald', 'Khan']
+TITLES = ['Mr', 'Mrs', 'Ms', 'Dr']
+SOURCE_SCHOOL = "St Mary's CE Primary"
+
+
+def make_ctf(pupils: int, seed: int = 0, upper_case: float = 0.2,
+             spaced_phones: float = 0.5, missing_surnames: float = 0.0,
+             contacts: int = 2, year_group: int = 6,
+             messy_contacts: float = 0.0) -> bytes:
+    """A CTF from the source school with `pupils` pupils
+
+    Each pupil has basic details, a school history including the source
+    school, an address, phone numbers and `contacts` contacts with their own
+    phone numbers, laid out as SIMS exports them.
+    Args:
+        pupils: The number of Pupil nodes
+        seed: Seed for the random choices, so output is repeatable
+        upper_case: Proportion of names written in upper case
+        spaced_phones: Proportion of phone numbers containing spaces
+        missing_surnames: Proportion of pupils without a Surname node (they
+            keep their PreferredSurname, so the CTF is still valid)
+        contacts: The number of contacts per pupil
+        year_group: Every pupil's NCyearActual
+        messy_contacts: Proportion of phone numbers, postcodes and emails
+            written in a non-canonical form (+44 numbers with punctuation,
+            lower case postcodes without a space, upper case email domains).
+            If non-zero every contact also gets an Email node
+    """
+
+    rand = random.Random(seed)
+
+    def name(names: list) -> str:
+        chosen = rand.choice(names)
+        return chosen.upper() if rand.random() < upper_case else chosen
+
+    def phones(count: int) -> str:
+        numbers = []
+        for _ in range(count):
+            number = f'0{rand.randrange(1000, 9999)}{rand.randrange(100000, 999999)}'
+            if messy_contacts and rand.random() < messy_contacts:
+                number = f'+44 ({number[1:5]}) {number[5:8]}-{number[8:]}'
+            elif rand.random() < spaced_phones:
+                number = f'{number[:5]} {number[5:]}'
+            numbers.append(f'<Phone>\n<TelephoneType>H</TelephoneType>\n'
+                           f'<PhoneNo>{number}</PhoneNo>\n</Phone>\n')
+        return f'<Phones>\n{"".join(numbers)}</Phones>\n'
+
+    def postcode() -> str:
+        messy = messy_contacts and rand.random() < messy_contacts
+        return 'dt93ap' if messy else 'DT9 3AP'
+
+    def email(forename: str, surname: str) -> str:
+        if not messy_contacts:
+            return ''
+        domain = 'example.co.uk'
+        if rand.random() < messy_contacts:
+            domain = f' {domain.upper()}'
+        return f'<Email>{forename}.{surname}@{domain}</Email>\n'
+
+    def contact(order: int) -> str:
+        title = rand.choice(TITLES)
+        surname, forename = name(SURNAMES), name(FORENAMES)
+        return (f'<Contact>\n<Order>{order + 1}</Order>\n'
+                f'<Title>{title}</Title>\n'
+                f'<Surname>{surname}</Surname>\n'
+                f'<Forename>{forename}</Forename>\n'
+                '<Relationship>PAR</Relationship>\n'
+                '<Responsibility>true</Responsibility>\n'
+                '<Address>\n<AddressAsPupil>true</AddressAsPupil>\n'
+                f'</Address>\n{phones(2)}{email(forename, surname)}'
+                '</Contact>\n')
+
+    birth_year = 2019 - year_group - 5
+    parts = [
+        '<?xml version="1.0" encoding="utf-8"?>\n<CTfile>\n<Header>\n'
+        '<DocumentName>Common Transfer File</DocumentName>\n'
+        '<CTFversion>19.0</CTFversion>\n'
+        '<DateTime>2020-06-19T12:12:27</DateTime>\n'
+        '<DocumentQualifier>full</DocumentQualifier>\n'
+        '<SupplierID>SIMS</SupplierID>\n<SourceSchool>\n<LEA>838</LEA>\n'
+        f'<Estab>3321</Estab>\n<URN>113799</URN>\n'
+        f'<SchoolName>{SOURCE_SCHOOL}</SchoolName>\n'
+        '<AcademicYear>2019</AcademicYear>\n</SourceSchool>\n'
+        '<DestSchool>\n<LEA>838</LEA>\n<Estab>4512</Estab>\n</DestSchool>\n'
+        '</Header>\n<CTFpupilData>\n']
+    for number in range(pupils):
+        surname = name(SURNAMES)
+        surname_node = ('' if rand.random() < missing_surnames else
+                        f'<Surname>{surname}</Surname>\n')
+        contact_nodes = ''.join(contact(order) for order in range(contacts))
+        parts.append(
+            f'<Pupil>\n<UPN>A{number:012}</UPN>\n{surname_node}'
+            f'<Forename>{name(FORENAMES)}</Forename>\n'
+            f'<DOB>{birth_year}-11-13</DOB>\n<Gender>M</Gender>\n'
+            '<BasicDetails>\n'
+            f'<PreferredSurname>{surname}</PreferredSurname>\n'
+            f'<PreferredForename>{name(FORENAMES)}</PreferredForename>\n'
+            f'<MiddleNames>{name(FORENAMES)}</MiddleNames>\n'
+            f'<NCyearActual>{year_group}</NCyearActual>\n'
+            '<Ethnicity>WBRI</Ethnicity>\n<EnrolStatus>C</EnrolStatus>\n'
+            '</BasicDetails>\n<Address>\n<BS7666Address>\n'
+            f'<PAON>{rand.randrange(1, 200)}</PAON>\n'
+            '<Street>High Street</Street>\n<Town>Sherborne</Town>\n'
+            f'</BS7666Address>\n<PostCode>{postcode()}</PostCode>\n'
+            '<Country>United Kingdom</Country>\n</Address>\n'
+            f'{phones(1)}<Contacts>\n{contact_nodes}</Contacts>\n'
+            '<SchoolHistory>\n<School>\n<LEA>838</LEA>\n<Estab>3321</Estab>\n'
+            f'<SchoolName>{SOURCE_SCHOOL}</SchoolName>\n'
+            '<EntryDate>2013-09-01</EntryDate>\n</School>\n</SchoolHistory>\n'
+            '</Pupil>\n')
+    parts.append('</CTFpupilData>\n</CTfile>\n')
+    return ''.join(parts).encode('utf-8')
+
+
+def main(argv: list = None):
+    arg_parser = argparse.ArgumentParser(description='Write a synthetic CTF')
+    arg_parser.add_argument('pupils', type=int)
+    arg_parser.add_argument('output')
+    arg_parser.add_argument('--seed', type=int, default=0)
+    arg_parser.add_argument('--upper-case', type=float, default=0.2)
+    arg_parser.add_argument('--spaced-phones', type=float, default=0.5)
+    arg_parser.add_argument('--missing-surnames', type=float, default=0.0)
+    arg_parser.add_argument('--contacts', type=int, default=2)
+    arg_parser.add_argument('--year-group', type=int, default=6)
+    arg_parser.add_argument('--messy-contacts', type=float, default=0.0)
+    args = arg_parser.parse_args(argv)
+    with open(args.output, 'wb') as ctf_file:
+        ctf_file.write(make_ctf(args.pupils, args.seed, args.upper_case,
+                                args.spaced_phones, args.missing_surnames,
+                                args.contacts, args.year_group,
+                                args.messy_contacts))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
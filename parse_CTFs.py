@@ -1,67 +1,571 @@
 import re
 import os
+import io
+import sys
+import tracemalloc
+import glob
+import csv
 import json
+import time
+import pickle
+import mmap
+import shutil
+import sqlite3
+import hashlib
+import argparse
+import tempfile
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from functools import cached_property, lru_cache
+from itertools import groupby
+from typing import Callable, NamedTuple, Optional
 
-from tkinter import Tk, filedialog
 import xml.etree.ElementTree as ET
+from xml.parsers import expat
 from datetime import date
 
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+# The libraries that can parse, search and write CTFs. `ET` is rebound to the
+# one in use by `use_backend`; the functions working on nodes accept either.
+XML_BACKENDS = {'etree': ET, 'lxml': lxml_etree}
+
+
+ABORT_QUESTION = "Do you want to abort?"
+MID_YEAR_QUESTION = "Are these students joining MID-YEAR?"
+
+# Answers to yes_no_q questions, keyed by question, that are given without
+# asking the user. Set by the command line for headless batch runs.
+PRESET_ANSWERS = {}
+
+# Answers yes_no_q accepts for the questions' settings; 'ask' leaves them to
+# the decision policy (see `DECISION_POLICIES`)
+ANSWER_CHOICES = ('yes', 'no', 'ask')
+
+# Settings for this run, eg from the command line. Settings not given here
+# are read from the config file, see `setting`.
+RUN_SETTINGS = {}
+
+# The config file's settings, once read by `load_config`
+CONFIG = None
+
+# The settings the config file may give: name to (type(s), allowed values)
+CONFIG_SETTINGS = {
+    'destinationParentDir': (str, None),
+    'disabledFixers': (list, None),
+    'nameCaseExceptions': (dict, None),
+    'xmlBackend': (str, ('auto', 'lxml', 'etree')),
+    'outputMode': (str, ('rewrite', 'patch')),
+    'splitByCohort': (bool, None),
+    'manifest': (bool, None),
+    'cacheDir': (str, None),
+    'cacheMaxAgeDays': ((int, float), None),
+    'cacheMaxEntries': (int, None),
+    'memoryLimitMB': ((int, float), None),
+    'shardWorkers': (int, None),
+    'syncWrites': (str, ('each', 'batch', 'off')),
+    'runDate': (str, None),
+    'abortOnPartial': (str, ANSWER_CHOICES),
+    'midYear': (str, ANSWER_CHOICES),
+    'onDuplicate': (str, ('link', 'skip')),
+    'pupilIndex': (str, None),
+    'statsLog': (str, None),
+    'auditDir': (str, None),
+    'profileCTF': (str, None),
+    'traceMemoryCTF': (str, None),
+}
+
+# Timings and counts for the CTF being processed, if instrumentation is enabled
+# by the statsLog setting; None otherwise. See `process_ctf`.
+STATS = None
+
+# Called with a row of AUDIT_COLUMNS for each change made to the CTF being
+# processed, if auditing is enabled by the auditDir setting; None otherwise.
+# See `audit_log`.
+AUDIT = None
+AUDIT_COLUMNS = ('fixer', 'upn', 'path', 'change', 'old', 'new')
+
+# The run's `CohortResolver`, made by `cohort_resolver` when first needed
+COHORTS = None
+
+# Part of the cache key of processed CTFs. Bump when a fixer's output changes.
+FIXERS_VERSION = 6
+
+# Most names whose case each `name_caser` remembers
+NAME_CASE_CACHE_SIZE = 50000
+
+# Most phone numbers, postcodes and email addresses whose canonical form is
+# remembered, each (see `canonical_phone_number` etc)
+CONTACT_CACHE_SIZE = 50000
+
+# Memory taken by a whole parsed CTF per byte of the file, as measured with
+# lxml (xml.etree takes about half as much). See `exceeds_memory_limit`.
+TREE_BYTES_PER_FILE_BYTE = 16
+
+# Pupil records kept in memory before they are spilled to disk, if there is a
+# memory limit. See `CTFContext.spill_pupils`.
+PUPIL_RECORDS_IN_MEMORY = 10000
+
+# Approximate size of the shards of pupils fixed in parallel by
+# `fix_ctf_sharded`. Only CTFs of at least two shards are sharded.
+SHARD_BYTES = 4 << 20
+
+# Folders made (or found to exist) by `make_dirs` during this run
+MADE_DIRS = set()
+
+# Name of the file in a watched inbox recording the CTFs already processed
+WATCH_RECORD_NAME = '.ctf_parser_watch.json'
+
+# Name of the manifest of CTFs output to a folder, see `record_in_manifests`
+MANIFEST_NAME = '.ctf_parser_manifest.jsonl'
+
+# The process's umask, which can only be read by setting it. New outputs get
+# the mode `open` would give them, see `give_output_mode`.
+UMASK = os.umask(0o022)
+os.umask(UMASK)
+
+# Manifests read this run, so each is parsed again only once it has changed:
+# path to ((mtime, size), {key: entry})
+MANIFESTS = {}
+
+NAME_TAGS = ('Surname', 'Forename', 'PreferredSurname', 'PreferredForename',
+             'MiddleNames', 'FormerSurname', 'SchoolName')
+
+HISTORY_SCHOOLS_PATH = './/SchoolHistory/School'
+HISTORY_SCHOOLS_XPATH = (None if lxml_etree is None else lxml_etree.XPath(
+    './/SchoolHistory/School[SchoolName=$name]'))
+# From the '<' of a start tag to its closing '>', skipping quoted attributes
+START_TAG = re.compile(rb'<[^\s/>]+(?:[^>"\']|"[^"]*"|\'[^\']*\')*>')
+XML_DECLARATION = re.compile(
+    rb'(?:\xef\xbb\xbf)?<\?xml[^>]*encoding\s*=\s*["\']([^"\']+)')
+PUPIL_DATA_TAG = re.compile(rb'<CTFpupilData\s*>')
+PUPIL_TAG = re.compile(rb'<Pupil[\s/>]')
+ALL_CAPS_NAME = re.compile(r'[A-Z.\'\-\s]+$')
+# Lower case in a name unless they start it, eg Ludwig van Beethoven
+NAME_PARTICLES = frozenset(('da', 'das', 'de', 'del', 'della', 'den', 'der',
+                            'di', 'dos', 'du', 'la', 'le', 'ten', 'ter', 'van',
+                            'von'))
+# Title casing gets these wrong: McDonald, and the s of Mary's
+MC_PREFIX = re.compile(r"\bMc([a-z])")
+POSSESSIVE_S = re.compile(r"(?<=\w\w)'S\b")
+ISO_DATE = re.compile(r'\d{4}-\d{2}-\d{2}$')
+PHONE_SEPARATORS = re.compile(r'[\s\-().]')
+PHONE_DIGITS = re.compile(r'\+?\d+$')
+# A single phone number once canonical: UK numbers have 10 or 11 digits,
+# international ones at most 15
+PLAUSIBLE_PHONE_NUMBER = re.compile(r'0\d{9,10}$|\+[1-9]\d{6,14}$')
+UK_DIALLING_CODES = ('+440', '+44', '00440', '0044')
+# A UK postcode without spaces: outward code, inward code
+UK_POSTCODE = re.compile(r'([A-Z]{1,2}\d[A-Z\d]?)(\d[A-Z]{2})$')
+YES_ANSWER = re.compile('[yY]')
+NO_ANSWER = re.compile('[nN]')
+
+
+class CTFContext:
+    """What is known about one CTF, each fact being worked out at most once
+
+    Passed to the fixers (as `doc`) and to the functions choosing the output
+    folder, so the source school, its appearances in school histories, the
+    first pupil's year group and the creation date are each looked up once
+    per document. Facts are found in `root` when first used; the streaming
+    engine, which doesn't keep the whole tree, sets them as it passes them.
+
+    Attributes:
+        root: The root node of the CTF
+        source_name: The source school's name, as it was before any fixes
+        nameless_UPNs: UPNs of pupils found to have no surname
+        pupils: A `PupilRecord` for each fixed pupil not yet spilled to
+            disk, if a pupil index is kept (see `PUPIL_INDEXER`). Use
+            `all_pupils` to read them all.
+        pupil_spill: Temporary file of the pupil records spilled to disk
+        ancestors: While fixing, the open nodes from the root down to the
+            parent of the node being fixed (see `fix_elements`)
+    """
+
+    def __init__(self, root: Optional[ET.Element] = None,
+                 source_name: Optional[str] = None):
+        self.root = root
+        self.source_name = source_name
+        self.nameless_UPNs = []
+        self.pupils = []
+        self.pupil_spill = None
+        self.ancestors = []
+
+    def spill_pupils(self):
+        """Move the pupil records in memory to the end of `pupil_spill`"""
+        if self.pupil_spill is None:
+            self.pupil_spill = tempfile.TemporaryFile()
+        pickle.dump(self.pupils, self.pupil_spill)
+        self.pupils = []
+
+    def all_pupils(self):
+        """Iterate over all the pupil records, spilled or not"""
+        if self.pupil_spill is not None:
+            self.pupil_spill.seek(0)
+            while self.pupil_spill.tell() < os.fstat(
+                    self.pupil_spill.fileno()).st_size:
+                yield from pickle.load(self.pupil_spill)
+            self.pupil_spill.close()
+        yield from self.pupils
+
+    @cached_property
+    def source_in_hists(self) -> list:
+        """Appearances of the (fixed) source school in school histories"""
+        return source_school_appearances_in_history(
+            self.root, get_source_school(self.root))
+
+    @cached_property
+    def first_leaving_date(self) -> Optional[str]:
+        if len(self.source_in_hists) == 0:
+            return None
+        return self.source_in_hists[0].findtext('.//LeavingDate')
+
+    @cached_property
+    def leaving_dates(self) -> list:
+        return [source_in_hist.findtext('LeavingDate')
+                for source_in_hist in self.source_in_hists]
+
+    @cached_property
+    def ncyear_actual(self) -> Optional[int]:
+        """The first NCyearActual in the CTF, if any"""
+        year_group = self.root.find('.//NCyearActual')
+        return None if year_group is None else int(year_group.text)
+
+    @cached_property
+    def first_dob(self) -> Optional[date]:
+        dob_node = self.root.find('.//Pupil/DOB')
+        return None if dob_node is None else date.fromisoformat(dob_node.text)
+
+    @cached_property
+    def creation_date(self) -> date:
+        return ctf_creation_date(self.root)
+
+    @cached_property
+    def year_group(self) -> int:
+        """The first pupil's year group, calculated from their DOB if need be
+
+        0 if there is neither an NCyearActual nor a DOB.
+        """
+
+        if self.ncyear_actual is not None:
+            return self.ncyear_actual
+        if self.first_dob is None:
+            return 0
+        return academic_year_of(self.first_dob, self.creation_date)
+
+    def joining_mid_year(self) -> bool:
+        return mid_year_from_leaving_dates(self.first_leaving_date,
+                                           self.leaving_dates)
+
+    @cached_property
+    def cohorts(self) -> 'CohortResolver':
+        return cohort_resolver()
+
+    @cached_property
+    def case_name(self) -> Callable[[str], str]:
+        """The `name_caser` for the current settings"""
+        return name_caser()
+
+
+class DecisionDeferred(Exception):
+    """Raised by the deferring decision policy for a question it can't answer
+
+    Processing of the CTF stops before anything is written, so it can be
+    processed again once the operator has answered (see `settle_deferred`).
+
+    Attributes:
+        question: The question to be answered
+        output: What was printed while processing the CTF, if captured
+    """
+
+    def __init__(self, question: str, output: str = ''):
+        super().__init__(question, output)
+        self.question = question
+        self.output = output
+
+
+class CohortResolver:
+    """Works out pupils' year groups and the cohort folders, remembering both
+
+    Made once per run (see `cohort_resolver`), so routing each pupil of a
+    batch is a dictionary lookup for all but the first pupil with each DOB.
+    The date the run is taken to be on can be given, so output folders don't
+    depend on when tests and benchmarks are run.
+
+    Attributes:
+        today: The date the run is taken to be on (default: today)
+        year_groups: Year groups, keyed by (DOB as in the CTF, CTF date)
+        folders: Cohort folder names, keyed by year group
+    """
+
+    def __init__(self, today: Optional[date] = None):
+        self.today = today or date.today()
+        self.year_groups = {}
+        self.folders = {}
+
+    def year_group(self, dob: str, ctf_date: date) -> int:
+        """The year group of a pupil born on `dob` when the CTF was made"""
+        key = (dob, ctf_date)
+        if key not in self.year_groups:
+            self.year_groups[key] = academic_year_of(date.fromisoformat(dob),
+                                                     ctf_date)
+        return self.year_groups[key]
+
+    @cached_property
+    def next_ac_year(self) -> str:
+        """See `escpd_next_ac_year`"""
+        year = self.today.year
+        if self.today.month < 10:
+            return f'{year}_{year + 1}'
+        return f'{year + 1}_{year + 2}'
+
+    def cohort_folder(self, year_group: int) -> str:
+        """See `cohort_folder`"""
+        if year_group not in self.folders:
+            self.folders[year_group] = \
+                f'CTF_Year{year_group:02}_{self.next_ac_year}'
+        return self.folders[year_group]
+
+
+class Fixer(NamedTuple):
+    """A fix applied to every node matching one of its `tags`
+
+    Attributes:
+        name: Unique name, used to disable the fixer in the config file
+        tags: The tags this fixer handles. A tag may be qualified by its parent
+            tag (eg 'SchoolHistory/School') to only match nodes in that place
+        fix: Called with each matching node (after its children have been
+            fixed) and the document's `CTFContext`; returns the number of fixes
+        report: Formats the count of fixes for the user
+        finish: Optionally called with the `CTFContext` once the whole
+            document has been fixed, eg to raise errors found along the way
+        changes: Paths, relative to the node fixed, of the nodes whose text
+            the fixer may change, add or remove, for the audit log (see
+            `audited`). '.' is the node itself.
+    """
+    name: str
+    tags: tuple
+    fix: Callable[[ET.Element, CTFContext], int]
+    report: Callable[[int], str]
+    finish: Optional[Callable[[CTFContext], None]] = None
+    changes: tuple = ('.',)
+
+
+FIXERS = {}
+
+
+class PupilRecord(NamedTuple):
+    """The fields of a pupil kept in the pupil index, see `index_pupils`
+
+    Attributes:
+        year_group: NCyearActual, or else calculated from the DOB (or 0)
+        source_school: The name of the school the CTF came from
+    """
+    upn: Optional[str]
+    surname: Optional[str]
+    preferred_surname: Optional[str]
+    dob: Optional[str]
+    year_group: int
+    source_school: str
+
+
+def use_backend(name: str = 'auto') -> str:
+    """Choose the XML library used to parse and write CTFs
+
+    lxml parses, searches and writes in C, so is much faster than the
+    standard library's ElementTree, but isn't always installed. Output is
+    equivalent, although lxml keeps comments and writes empty nodes as <a/>
+    rather than <a />.
+    Args:
+        name: 'lxml', 'etree' or 'auto' (lxml if it is installed). If lxml
+            is asked for but isn't installed, etree is used instead.
+    Returns:
+        The name of the backend now in use
+    """
+
+    global ET
+    if name not in ('auto', *XML_BACKENDS):
+        raise ValueError(f'Unknown XML backend: {name}')
+    if name != 'etree' and lxml_etree is None:
+        if name == 'lxml':
+            print('lxml is not installed; using xml.etree instead')
+        name = 'etree'
+    elif name == 'auto':
+        name = 'lxml'
+    ET = XML_BACKENDS[name]
+    return name
+
+
+def parse_xml(ctf_path: str):
+    """Parse a whole CTF with the backend in use"""
+    if ET is lxml_etree:
+        # Never expand entities: a CTF has no business defining any
+        return ET.parse(ctf_path, ET.XMLParser(resolve_entities=False))
+    return ET.parse(ctf_path)
+
+
+def xml_from_bytes(data: bytes) -> ET.Element:
+    """Parse a whole CTF, or part of one, from bytes with the backend in use"""
+    if ET is lxml_etree:
+        return ET.fromstring(data, ET.XMLParser(resolve_entities=False))
+    return ET.fromstring(data)
+
+
+def iterparse_xml(ctf_path, events: tuple):
+    """`iterparse` a CTF (a path or binary file) with the backend in use"""
+    if ET is lxml_etree:
+        return ET.iterparse(ctf_path, events=events, resolve_entities=False)
+    return ET.iterparse(ctf_path, events=events)
+
+
+def register_fixer(name: str, tags, report: Callable[[int], str],
+                   finish: Optional[Callable[[CTFContext], None]] = None,
+                   changes: tuple = ('.',)):
+    """Decorator registering a function as the `fix` of a new `Fixer`
+
+    Fixers run in the order they are registered. School-specific fixers can
+    be added by importing this module and registering them before processing.
+    """
+
+    def register(fix):
+        FIXERS[name] = Fixer(name, tuple(tags), fix, report, finish,
+                             tuple(changes))
+        return fix
+    return register
+
+
+def enabled_fixers() -> list:
+    """The registered fixers, less any listed in the config's disabledFixers"""
+    disabled = load_config().get('disabledFixers', [])
+    return [fixer for name, fixer in FIXERS.items() if name not in disabled]
+
+
+def active_fixers() -> list:
+    """The enabled fixers, and the pupil indexer if a pupil index is kept"""
+    fixers = enabled_fixers()
+    if setting('pupilIndex'):
+        fixers.append(PUPIL_INDEXER)
+    return instrumented(audited(fixers))
 
-def process_ctf(ctf_path: str) -> bool:
+
+def build_dispatch_table(fixers: list) -> dict:
+    """Map each tag to the (parent tag or None, fixer) pairs that handle it"""
+    table = {}
+    for fixer in fixers:
+        for path in fixer.tags:
+            parent_tag, _, tag = path.rpartition('/')
+            table.setdefault(tag, []).append((parent_tag or None, fixer))
+    return table
+
+
+def process_ctf(ctf_path: str, streaming: bool = False) -> bool:
     """Parse the XML tree, call patching methods and write repaired CTF
 
     Tries to open CTF file presumend to be at passed path. Checks whether CTF
     is complete and asks the user whether they want to abort if not.
     Finds the appropriate location and writes a new, fixed CTF there. The
     original is unchanged, but renamed
-    Delegates:
+    Delegates fixing to the enabled fixers (see `FIXERS`), which include:
     Removing any optional nodes that are empty
     Making proper names proper case
+    If a result cache is configured (see `cacheDir` in `setting`) and an
+    identical CTF has been processed before, its output is reused instead.
+    If instrumentation is enabled (see `statsLog` in `setting`), the time
+    spent in each stage and the fixes made are recorded; see `STATS`.
 
     Args:
         ctf_path: The full path of the CTF file to be processed
+        streaming: Whether to fix the CTF in a single streaming pass (see
+            `fix_ctf_streaming`) rather than parsing the whole tree first
 
     Returns:
         A Boolean indicating whether the process was successful (Explicit
         abortion by the user is still considered unsuccessful).
     """
 
-    print('Parsing', ctf_path.rsplit('/', 1)[-1], '...')
+    global STATS
+    use_backend(setting('xmlBackend', 'auto'))
+    STATS = new_stats(ctf_path, streaming) if setting('statsLog') else None
+    with diagnostics(ctf_path):
+        success = run_ctf(ctf_path, streaming)
+    if STATS is not None:
+        STATS['seconds']['total'] = time.perf_counter() - STATS.pop('start')
+        STATS['success'] = success is True
+        append_stats_line(setting('statsLog'), STATS)
+    return success
 
-    try:
-        # Prepare XML tree
-        tree = ET.parse(ctf_path)
-        root_node = tree.getroot()
-        source_name = get_source_school(root_node)
 
-        if is_data_missing(root_node) and yes_no_q("Do you want to abort?"):
-            return False
+def run_ctf(ctf_path: str, streaming: bool) -> bool:
+    """Process a CTF as described in `process_ctf`, without instrumenting it"""
+
+    print('Parsing', ctf_path.rsplit('/', 1)[-1], '...')
 
-        fixed_cases = repair_case_where_appropriate(root_node)
-
-        fixed_empties = trim_empty_nodes(root_node, source_name)
-
-        fixed_phone_numbers = remove_spaces_from_phone_numbers(root_node)
-
-        fixed_surnames = ensure_surnames_are_legal(root_node)
-
-        # Write the new file, rename the original and tell the user what's happened
-        escpd_src_name = escape_source_school(source_name)
-        output_path = determine_output_path(ctf_path, escpd_src_name, root_node)
-        tree.write(output_path, encoding='UTF-8', xml_declaration=True)
-        if fixed_cases > 0:
-            print(f"Case fixed for {fixed_cases} name{plural(fixed_cases)}")
-        if fixed_empties > 0:
-            print(f"Trimmed {fixed_empties} empty field{plural(fixed_empties)}")
-        if fixed_phone_numbers > 0:
-            print(f"Removed whitespace from {fixed_phone_numbers}" +
-                  f" phone number{plural(fixed_phone_numbers)}")
-        if fixed_surnames > 0:
-            s = plural(fixed_surnames)
-            print(f"Replaced {fixed_surnames} surname{s} with legal surname{s}")
-        print('Output to:', output_path, '\n')
-        os.rename(ctf_path,
-                  ctf_path.replace('.', f'_{escpd_src_name}_original.'))
+    try:
+        cache_dir = setting('cacheDir')
+        use_manifest = setting('manifest')
+        key = result = audit_path = None
+        if cache_dir or use_manifest:
+            with timed_stage('cache'):
+                key = cache_key(ctf_path)
+        if use_manifest:
+            with timed_stage('manifest'):
+                result = current_manifest_entry(key)
+            if result is not None:
+                print('Already processed; its output is up to date')
+                use_manifest = False
+        if result is None and cache_dir:
+            with timed_stage('cache'):
+                result = reuse_cached_output(cache_dir, key, ctf_path)
+        if result is None:
+            if not (streaming or setting('splitByCohort') or
+                    should_shard(ctf_path)) and \
+                    exceeds_memory_limit(ctf_path):
+                print('Too big to parse whole within the memory limit, so '
+                      'streaming it')
+                streaming = True
+            if setting('splitByCohort'):
+                engine = fix_ctf_split
+            elif should_shard(ctf_path):
+                engine = fix_ctf_sharded
+            else:
+                engine = fix_ctf_streaming if streaming else fix_ctf
+            with audit_log(ctf_path) as audit:
+                result = engine(ctf_path)
+                audit['written'] = result is not None
+            if result is None:
+                return False
+            audit_path = audit['path']
+            pupils = result.pop('pupils')
+            if cache_dir:
+                store_cached_result(cache_dir, key, result)
+            if setting('pupilIndex'):
+                with timed_stage('index'):
+                    index_pupils(setting('pupilIndex'), pupils, ctf_path,
+                                 result.get('outputs', [result]))
+        if use_manifest:
+            with timed_stage('manifest'):
+                record_in_manifests(key, ctf_path, result)
+
+        # Rename the original and tell the user what's happened
+        escpd_src_name = result['escpd_source_name']
+        report_fixes(result['counts'])
+        if audit_path:
+            print('Changes listed in:', audit_path)
+        outputs = result.get('outputs', [result])
+        for output in outputs[:-1]:
+            print('Output to:', output['output_path'])
+        print('Output to:', outputs[-1]['output_path'], '\n')
+        with timed_stage('rename'):
+            sync_output_dirs([output['output_path'] for output in outputs])
+            os.rename(ctf_path,
+                      ctf_path.replace('.', f'_{escpd_src_name}_original.'))
+            sync_dir(os.path.dirname(ctf_path))
+        if STATS is not None:
+            STATS['fixes'] = result['counts']
         return True
     except ET.ParseError as parse_error:
         print("ERROR. Are you sure this file is a CTF?")
@@ -71,6 +575,1422 @@ def process_ctf(ctf_path: str) -> bool:
         return False
 
 
+def process_ctf_streaming(ctf_path: str) -> bool:
+    """`process_ctf` using the streaming engine, see `fix_ctf_streaming`"""
+    return process_ctf(ctf_path, streaming=True)
+
+
+def fix_ctf(ctf_path: str) -> Optional[dict]:
+    """Parse the whole CTF, fix it and write the fixed CTF to its output dir
+
+    Returns:
+        None if the user chose to abort, else a dict describing the output:
+        `output_path`, `output_dir` (the output sub-folder),
+        `escpd_source_name`, `counts` (fixer name to fix count) and `pupils`
+        (see `CTFContext`)
+    Raises:
+        ValueError if any students don't have surnames.
+        ET.ParseError if the file is not well-formed XML.
+    """
+
+    # Prepare XML tree
+    with timed_stage('parse'):
+        tree = parse_xml(ctf_path)
+    root_node = tree.getroot()
+    source_name = get_source_school(root_node)
+
+    if is_data_missing(root_node) and yes_no_q(ABORT_QUESTION):
+        return None
+
+    fixers = active_fixers()
+    events = tree_events(root_node)
+    patching = setting('outputMode') == 'patch'
+    if patching:
+        fixed, tag_counts = {}, {}
+        events, fixers = track_fixed_nodes(events, fixers, fixed, tag_counts)
+    doc = CTFContext(root_node, source_name)
+    counts = dict.fromkeys((fixer.name for fixer in fixers), 0)
+    with timed_stage('fix'):
+        for _ in fix_elements(events, fixers, doc, counts):
+            pass
+        finish_fixers(fixers, doc)
+
+    # Write the new file
+    escpd_src_name = escape_source_school(source_name)
+    with timed_stage('output_dir'):
+        output_dir = get_output_dir(root_node, ctx=doc)
+        output_path = output_path_for(ctf_path, escpd_src_name, output_dir)
+    with timed_stage('write'), atomic_output(output_path) as out_file:
+        if not (patching and
+                patch_ctf(ctf_path, out_file, fixed, tag_counts)):
+            tree.write(out_file, encoding='UTF-8', xml_declaration=True)
+    return {'output_path': output_path, 'output_dir': output_dir,
+            'escpd_source_name': escpd_src_name, 'counts': counts,
+            'pupils': doc.all_pupils()}
+
+
+def fix_ctf_streaming(ctf_path: str) -> Optional[dict]:
+    """Fix a CTF in a single streaming pass, without holding the whole tree
+
+    Behaves like `fix_ctf`, but the file is read with `ET.iterparse` and
+    each element is fixed as soon as it is closed. Every `Pupil` is written to
+    the output as soon as it is complete and then dropped from memory, so
+    memory use is bounded by the largest pupil rather than the whole file.
+    The output is written to a temporary file beside the output folders and
+    moved into place once its destination folder is known.
+    """
+
+    parent_dir = output_parent_dir()
+    make_dirs(parent_dir)
+    spill = tempfile.NamedTemporaryFile(dir=parent_dir, suffix='.partial',
+                                        delete=False)
+    try:
+        with spill, timed_stage('parse_fix_write'):
+            stream = stream_fixed_ctf(ctf_path, spill)
+            if stream is not None:
+                sync_file(spill)
+        if stream is None:
+            return None
+
+        doc, counts = stream
+        escpd_src_name = escape_source_school(doc.source_name or '')
+        with timed_stage('output_dir'):
+            output_dir = choose_output_dir(doc.year_group,
+                                           doc.joining_mid_year)
+            output_path = output_path_for(ctf_path, escpd_src_name,
+                                          output_dir)
+        with timed_stage('move'):
+            replace_output(spill.name, output_path)
+        return {'output_path': output_path, 'output_dir': output_dir,
+                'escpd_source_name': escpd_src_name, 'counts': counts,
+                'pupils': doc.all_pupils()}
+    finally:
+        if os.path.exists(spill.name):
+            os.remove(spill.name)
+
+
+def should_shard(ctf_path: str) -> bool:
+    """Whether the shardWorkers setting asks for the CTF to be sharded
+
+    See `fix_ctf_sharded`. The patched output mode keeps the original's
+    formatting, which sharding wouldn't, so CTFs are never sharded then.
+    """
+
+    return ((setting('shardWorkers') or 1) > 1 and
+            setting('outputMode') != 'patch' and
+            os.path.getsize(ctf_path) >= 2 * SHARD_BYTES)
+
+
+def fix_ctf_sharded(ctf_path: str) -> Optional[dict]:
+    """Fix a big CTF's pupils in parallel, in shards of about SHARD_BYTES
+
+    The pupils are found by searching the CTF's bytes for their tags (see
+    `pupil_shards`), and the rest of the document (the header and skeleton)
+    is parsed and fixed here first. Each shard is then parsed and fixed in
+    one of `shardWorkers` worker processes (see `fix_pupil_shard`), given
+    the fixed skeleton and the source school's name. The fixed shards are
+    written out in their original order, between the skeleton's halves, so
+    the output is byte-for-byte that of `fix_ctf_streaming`, which is used
+    instead for CTFs that can't be sharded.
+
+    Returns:
+        As `fix_ctf`
+    """
+
+    with open(ctf_path, 'rb') as ctf_file, \
+            mmap.mmap(ctf_file.fileno(), 0, access=mmap.ACCESS_READ) as src:
+        with timed_stage('shard'):
+            shards = pupil_shards(src, SHARD_BYTES)
+        if shards is None:
+            print("Can't shard this CTF, so streaming it")
+            return fix_ctf_streaming(ctf_path)
+        with timed_stage('parse'):
+            root = xml_from_bytes(src[:shards[0][0]] + src[shards[-1][1]:])
+
+    fixers = active_fixers()
+    doc = CTFContext(root)
+    counts = dict.fromkeys((fixer.name for fixer in fixers), 0)
+    with timed_stage('fix'):
+        for _ in fix_elements(tree_events(root), fixers, doc, counts):
+            pass
+    if is_data_missing(root) and yes_no_q(ABORT_QUESTION):
+        return None
+
+    # Split the fixed skeleton where the pupils go
+    pupil_data = root.find('.//CTFpupilData')
+    sentinel = sub_element(pupil_data, 'CTFparserPupils')
+    head, tail = serialise(root, True).split(serialise(sentinel))
+    pupil_data.remove(sentinel)
+    skeleton = serialise(root)
+
+    parent_dir = output_parent_dir()
+    make_dirs(parent_dir)
+    doc.ncyear_actual = doc.first_dob = doc.first_leaving_date = None
+    doc.leaving_dates = []
+    workers = setting('shardWorkers')
+    out_file = tempfile.NamedTemporaryFile(dir=parent_dir, suffix='.partial',
+                                           delete=False)
+    try:
+        with out_file, timed_stage('fix_shards'), ProcessPoolExecutor(
+                workers, initializer=init_shard_worker,
+                initargs=(RUN_SETTINGS,)) as executor:
+            out_file.write(head)
+            # Keep a couple of shards queued per worker, but no more, so the
+            # fixed shards waiting to be written can't fill the memory
+            pending = []
+            for start, end in shards:
+                pending.append(executor.submit(
+                    fix_pupil_shard, ctf_path, start, end, skeleton,
+                    doc.source_name))
+                if len(pending) >= 2 * workers:
+                    add_shard(pending.pop(0).result(), doc, counts, out_file)
+            for future in pending:
+                add_shard(future.result(), doc, counts, out_file)
+            out_file.write(tail)
+            sync_file(out_file)
+        finish_fixers(fixers, doc)
+
+        escpd_src_name = escape_source_school(doc.source_name or '')
+        with timed_stage('output_dir'):
+            output_dir = choose_output_dir(doc.year_group,
+                                           doc.joining_mid_year)
+            output_path = output_path_for(ctf_path, escpd_src_name,
+                                          output_dir)
+        with timed_stage('move'):
+            replace_output(out_file.name, output_path)
+        return {'output_path': output_path, 'output_dir': output_dir,
+                'escpd_source_name': escpd_src_name, 'counts': counts,
+                'pupils': doc.all_pupils()}
+    finally:
+        if os.path.exists(out_file.name):
+            os.remove(out_file.name)
+
+
+def pupil_shards(src: mmap.mmap, shard_bytes: int) -> Optional[list]:
+    """Split the pupils of a CTF into shards by searching for their tags
+
+    Returns:
+        [(start, end)] byte offsets of consecutive runs of Pupil nodes (and
+        the whitespace after them), each at least `shard_bytes` long bar the
+        last, or None if the pupils can't safely be found this way: it needs
+        UTF-8 without namespaces, and comments, CDATA, DTDs and processing
+        instructions could hide or fake a tag
+    """
+
+    declaration = XML_DECLARATION.match(src)
+    if (not is_utf8(src) or src.find(b'<!') != -1 or
+            src.find(b'<?', declaration.end() if declaration else 0) != -1):
+        return None
+    opening = PUPIL_DATA_TAG.search(src)
+    closing = src.rfind(b'</CTFpupilData')
+    if opening is None or closing < opening.end() or \
+            src.find(b'xmlns', 0, opening.start()) != -1:
+        return None
+    starts = [match.start() for match in
+              PUPIL_TAG.finditer(src, opening.end(), closing)]
+    if not starts:
+        return None
+    shard_starts = [starts[0]]
+    for start in starts:
+        if start - shard_starts[-1] >= shard_bytes:
+            shard_starts.append(start)
+    return list(zip(shard_starts, shard_starts[1:] + [closing]))
+
+
+def init_shard_worker(settings: dict):
+    """Set up a worker process of `fix_ctf_sharded` for the CTF's settings"""
+    global STATS, AUDIT
+    STATS = AUDIT = None
+    RUN_SETTINGS.update(settings)
+    use_backend(setting('xmlBackend', 'auto'))
+
+
+def fix_pupil_shard(ctf_path: str, start: int, end: int, skeleton: bytes,
+                    source_name: Optional[str]) -> dict:
+    """Fix a shard of a CTF's pupils in a worker of `fix_ctf_sharded`
+
+    Args:
+        ctf_path: The CTF
+        start, end: The shard's byte offsets in the CTF
+        skeleton: The fixed CTF without its pupils, for the fixers' context
+        source_name: The source school's name, as it was before any fixes
+    Returns:
+        A dict of the shard's fixed pupils as `xml`, serialised as by
+        `stream_fixed_ctf`, its `counts`, its audit log rows as `changes`
+        (see `audit_log`), its `nameless_UPNs` and `pupils` (see
+        `CTFContext`), plus the `ncyear_actual`, `first_dob`,
+        `first_leaving_date` and `leaving_dates` found in it, as
+        `stream_fixed_ctf` finds them
+    Raises:
+        ValueError if the shard isn't a run of well-formed Pupil nodes
+    """
+
+    global AUDIT
+    with open(ctf_path, 'rb') as ctf_file:
+        ctf_file.seek(start)
+        pupils = ctf_file.read(end - start)
+    changes = []
+    AUDIT = changes.append if setting('auditDir') else None
+    fixers = active_fixers()
+    doc = CTFContext(xml_from_bytes(skeleton), source_name)
+    fixed_source_name = get_source_school(doc.root) or ''
+    counts = dict.fromkeys((fixer.name for fixer in fixers), 0)
+    shard = {'ncyear_actual': None, 'first_dob': None,
+             'first_leaving_date': None, 'leaving_dates': []}
+    out_file = io.BytesIO()
+
+    events = iterparse_xml(io.BytesIO(b'<CTFpupilData>' + pupils +
+                                      b'</CTFpupilData>'), ('start', 'end'))
+    held = None  # As in `stream_fixed_ctf`
+    try:
+        for node, stack in fix_elements(events, fixers, doc, counts):
+            if held is not None:
+                write_pupil(*held, out_file)
+                held = None
+            tag = node.tag
+            parent_tag = stack[-1].tag if stack else None
+            if tag == 'NCyearActual' and shard['ncyear_actual'] is None:
+                shard['ncyear_actual'] = int(node.text)
+            elif tag == 'DOB' and parent_tag == 'Pupil' and \
+                    shard['first_dob'] is None:
+                shard['first_dob'] = date.fromisoformat(node.text)
+            elif tag == 'School' and parent_tag == 'SchoolHistory':
+                if node.findtext('SchoolName') == fixed_source_name:
+                    shard['leaving_dates'].append(
+                        node.findtext('LeavingDate'))
+                    if len(shard['leaving_dates']) == 1:
+                        shard['first_leaving_date'] = node.findtext(
+                            './/LeavingDate')
+            elif tag == 'Pupil' and len(stack) == 1:
+                if doc.nameless_UPNs:
+                    stack[0].remove(node)
+                    node.clear()
+                else:
+                    held = (node, stack[0])
+            elif not stack and (tag != 'CTFpupilData' or len(node) or
+                                (node.text or '').strip()):
+                raise ValueError(
+                    f'The bytes {start}-{end} are not a run of pupils')
+    except ET.ParseError as parse_error:
+        # Sent as a ValueError, as lxml's errors can't be pickled
+        raise ValueError(f'The pupils at bytes {start}-{end} are not '
+                         f'well-formed XML: {parse_error}') from None
+    return {'xml': out_file.getvalue(), 'counts': counts,
+            'changes': changes, 'nameless_UPNs': doc.nameless_UPNs,
+            'pupils': list(doc.all_pupils()), **shard}
+
+
+def add_shard(shard: dict, doc: CTFContext, counts: dict, out_file):
+    """Write a fixed shard from `fix_pupil_shard` and add to what's known"""
+    out_file.write(shard['xml'])
+    for name, count in shard['counts'].items():
+        counts[name] += count
+    if AUDIT is not None:
+        for change in shard['changes']:
+            AUDIT(change)
+    doc.nameless_UPNs += shard['nameless_UPNs']
+    for pupil in shard['pupils']:
+        doc.pupils.append(pupil)
+        if (len(doc.pupils) >= PUPIL_RECORDS_IN_MEMORY and
+                setting('memoryLimitMB')):
+            doc.spill_pupils()
+    if doc.ncyear_actual is None:
+        doc.ncyear_actual = shard['ncyear_actual']
+    if doc.first_dob is None:
+        doc.first_dob = shard['first_dob']
+    if not doc.leaving_dates:
+        doc.first_leaving_date = shard['first_leaving_date']
+    doc.leaving_dates += shard['leaving_dates']
+
+
+def fix_ctf_split(ctf_path: str) -> Optional[dict]:
+    """Fix a CTF in a streaming pass, filing each pupil by their year group
+
+    Like `fix_ctf_streaming`, but rather than the whole CTF going to the
+    folder chosen for its first pupil, each pupil goes to the folder chosen
+    for their own year group (see `choose_output_dir`). A CTF with pupils in
+    several year groups, eg from an all-through school, becomes one CTF per
+    folder, each with the same header. Whether the year 11s are joining
+    mid-year is decided once, from all of their leaving dates.
+    Pupils are spilled to a temporary file per year group as they are fixed
+    (6, 11 or 0 for any other), as the year 11s' folder isn't known until
+    the end. Year groups that turn out to share a folder, eg mid-year year
+    11s and the pupils not in an incoming cohort, are written to one CTF,
+    a year group after another.
+
+    Returns:
+        As `fix_ctf`, plus `outputs`: an {`output_path`, `output_dir`,
+        `year_groups`} dict for each CTF written, `year_groups` listing the
+        year groups (6, 11 or 0) whose pupils it holds. The first is also
+        given as `output_path` and `output_dir`.
+    """
+
+    parent_dir = output_parent_dir()
+    make_dirs(parent_dir)
+    skeleton = io.BytesIO()
+    spills = {}
+    prefix_len = []
+    year_11_leaving_dates = []
+
+    def pupil_file(pupil: ET.Element, doc: CTFContext):
+        if not prefix_len:
+            # The skeleton holds everything before the first pupil so far
+            prefix_len.append(skeleton.tell())
+        year_group = pupil_year_group(pupil, doc)
+        if year_group not in (6, 11):
+            year_group = 0
+        elif year_group == 11:
+            year_11_leaving_dates.extend(
+                school.findtext('LeavingDate') for school in
+                source_school_appearances_in_history(
+                    pupil, get_source_school(doc.root)))
+        if year_group not in spills:
+            spills[year_group] = tempfile.TemporaryFile(dir=parent_dir)
+        return spills[year_group]
+
+    def year_11s_joining_mid_year() -> bool:
+        return mid_year_from_leaving_dates(
+            year_11_leaving_dates[0] if year_11_leaving_dates else None,
+            year_11_leaving_dates)
+
+    partial_paths = []
+    try:
+        with timed_stage('parse_fix_write'):
+            stream = stream_fixed_ctf(ctf_path, skeleton, pupil_file)
+        if stream is None:
+            return None
+
+        doc, counts = stream
+        escpd_src_name = escape_source_school(doc.source_name or '')
+        head = skeleton.getvalue()
+        if not spills:
+            # No pupils, so nothing to split
+            spills[doc.year_group] = io.BytesIO()
+            prefix_len.append(len(head))
+        spills_by_dir = {}
+        with timed_stage('output_dir'):
+            for year_group, spill in spills.items():
+                output_dir = choose_output_dir(year_group,
+                                               year_11s_joining_mid_year)
+                spills_by_dir.setdefault(output_dir, {})[year_group] = spill
+        outputs = []
+        for output_dir, dir_spills in spills_by_dir.items():
+            with timed_stage('output_dir'):
+                output_path = output_path_for(ctf_path, escpd_src_name,
+                                              output_dir)
+            with timed_stage('write'), tempfile.NamedTemporaryFile(
+                    dir=parent_dir, suffix='.partial',
+                    delete=False) as out_file:
+                partial_paths.append(out_file.name)
+                out_file.write(head[:prefix_len[0]])
+                for spill in dir_spills.values():
+                    spill.seek(0)
+                    shutil.copyfileobj(spill, out_file)
+                out_file.write(head[prefix_len[0]:])
+                sync_file(out_file)
+            outputs.append({'output_path': output_path,
+                            'output_dir': output_dir,
+                            'year_groups': list(dir_spills)})
+        with timed_stage('move'):
+            for partial_path, output in zip(partial_paths, outputs):
+                replace_output(partial_path, output['output_path'])
+        return {'output_path': outputs[0]['output_path'],
+                'output_dir': outputs[0]['output_dir'], 'outputs': outputs,
+                'escpd_source_name': escpd_src_name, 'counts': counts,
+                'pupils': doc.all_pupils()}
+    finally:
+        for spill in spills.values():
+            spill.close()
+        for partial_path in partial_paths:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+
+
+def merge_ctfs(ctf_paths: list, output_path: str) -> list:
+    """Merge CTFs bound for the same folder into one CTF to import at once
+
+    Pupils are streamed from each CTF in turn, so only one pupil is held in
+    memory at a time. Everything outside the pupils, including the header,
+    is taken from the first CTF with a header; CTFs without one, or whose
+    `merge_key` differs from the first's, are left out. So every pupil keeps
+    the SourceSchool they came from.
+
+    Returns:
+        The paths of the CTFs that were merged
+    Raises:
+        ET.ParseError if a CTF is not well-formed XML.
+    """
+
+    sentinel = ET.Element('CTFparserPupils')
+    skeleton = first_header = None
+    placed = False
+    merged = []
+    out_dir = os.path.dirname(os.path.abspath(output_path))
+    os.makedirs(out_dir, exist_ok=True)
+    with tempfile.TemporaryFile(dir=out_dir) as spill:
+        for ctf_path in ctf_paths:
+            root, header, stack = None, None, []
+            for event, node in iterparse_xml(ctf_path, ('start', 'end')):
+                if event == 'start':
+                    if root is None:
+                        root = node
+                    stack.append(node)
+                    continue
+                stack.pop()
+                if node.tag == 'Header' and header is None:
+                    header = merge_key(node)
+                    if first_header is None:
+                        # The first CTF with a header is the skeleton
+                        first_header, skeleton = header, root
+                    elif header != first_header:
+                        break
+                elif node.tag == 'Pupil' and stack:
+                    if header is None:
+                        break
+                    parent = stack[-1]
+                    if root is skeleton and not placed:
+                        # Where the first CTF's pupils were, the rest go
+                        parent.insert(list(parent).index(node), sentinel)
+                        placed = True
+                    parent.remove(node)
+                    spill.write(serialise(node))
+            if header is not None and header == first_header:
+                merged.append(ctf_path)
+            else:
+                print(f'Not merging {ctf_path}: ' + (
+                    'it has no header' if header is None else
+                    "its header doesn't match the first CTF's"))
+
+        if skeleton is None:
+            return merged
+        if not placed:
+            pupil_data = skeleton.find('CTFpupilData')
+            if pupil_data is None:
+                pupil_data = sub_element(skeleton, 'CTFpupilData')
+            pupil_data.append(sentinel)
+        prefix, suffix = serialise(skeleton, True).split(serialise(sentinel))
+        spill.seek(0)
+        with atomic_output(output_path) as out_file:
+            out_file.write(prefix)
+            shutil.copyfileobj(spill, out_file)
+            out_file.write(suffix)
+    return merged
+
+
+def merge_key(header: ET.Element) -> tuple:
+    """What CTFs must share to be merged: version, type, destination and
+    source school, as the MIS takes the pupils to come from the header's
+    SourceSchool"""
+    return (header.findtext('CTFversion'),
+            header.findtext('DocumentQualifier'),
+            *((school.findtext('LEA'), school.findtext('Estab'))
+              if school is not None else None
+              for school in (header.find('DestSchool'),
+                             header.find('SourceSchool'))))
+
+
+def merge_groups(ctf_paths: list) -> list:
+    """Group CTFs that can be merged, ie that have the same `merge_key`
+
+    Returns:
+        (source school name, CTF paths) for each group, in the order of their
+        first CTFs. CTFs without a header are reported and left out.
+    """
+
+    groups = {}
+    for ctf_path in ctf_paths:
+        header = None
+        with open(ctf_path, 'rb') as ctf_file:
+            for _, node in iterparse_xml(ctf_file, ('end',)):
+                if node.tag == 'Header':
+                    header = node
+                    break
+        if header is None:
+            print(f'Not merging {ctf_path}: it has no header')
+            continue
+        school = header.findtext('SourceSchool/SchoolName') or ''
+        groups.setdefault(merge_key(header), (school, []))[1].append(ctf_path)
+    return list(groups.values())
+
+
+def merge_folders(folders: list) -> list:
+    """Merge the CTFs in each folder into one, in a sibling CTF_Merged folder
+
+    CTFs from different source schools (or otherwise with different headers,
+    see `merge_key`) can't be merged, so one CTF is written for each school,
+    named after it.
+
+    Returns:
+        The paths of the merged CTFs
+    """
+
+    merged_paths = []
+    stamp = time.strftime('%Y%m%d_%H%M%S')
+    for folder in folders:
+        ctf_paths = expand_ctf_paths([folder])
+        if not ctf_paths:
+            print('No CTFs to merge in', folder)
+            continue
+        name = os.path.basename(os.path.normpath(folder))
+        out_dir = os.path.join(os.path.dirname(os.path.normpath(folder)),
+                               'CTF_Merged')
+        groups = merge_groups(ctf_paths)
+        names = []
+        for school, group in groups:
+            output_name = f'{name}_{stamp}'
+            if len(groups) > 1:
+                output_name += f'_{escape_source_school(school)}'
+            names.append(output_name)
+            if names.count(output_name) > 1:
+                output_name += f'_{names.count(output_name)}'
+            output_path = os.path.join(out_dir, output_name + '.xml')
+            merged = merge_ctfs(group, output_path)
+            print(f'Merged {len(merged)} CTF{plural(len(merged))} from '
+                  f'{folder} into {output_path}')
+            merged_paths.append(output_path)
+    sync_batch_dirs(merged_paths)
+    return merged_paths
+
+
+def tree_events(node: ET.Element):
+    """Yields the ('start'/'end', node) events `ET.iterparse` would for a tree
+
+    Children are listed before they are visited, so fixers may add or remove
+    children of the node being closed.
+    """
+
+    yield 'start', node
+    for child in list(node):
+        yield from tree_events(child)
+    yield 'end', node
+
+
+def fix_elements(events, fixers: list, doc: CTFContext, counts: dict):
+    """Run the fixers over a stream of parse events in a single traversal
+
+    Every closed node is dispatched on its tag to the fixers that handle it.
+    The raw name of the source school is recorded in `doc.source_name`
+    before any fixer sees it, unless it is already known.
+
+    Args:
+        events: ('start'/'end', node) pairs, from `ET.iterparse` or
+            `tree_events`
+        fixers: The fixers to apply
+        doc: The context shared by the fixers for this document
+        counts: Fixer name to fix count; incremented as fixes are made
+    Yields:
+        (node, ancestors) for each node, once its fixers have run. `ancestors`
+        is the list of open nodes from the root down to the node's parent.
+    """
+
+    table = build_dispatch_table(fixers)
+    stack = []
+    doc.ancestors = stack
+    if STATS is not None:
+        events = counted_events(events)
+    for event, node in events:
+        if event == 'start':
+            if doc.root is None:
+                doc.root = node
+            stack.append(node)
+            continue
+
+        stack.pop()
+        tag = node.tag
+        if (tag == 'SchoolName' and doc.source_name is None
+                and any(n.tag == 'SourceSchool' for n in stack)):
+            doc.source_name = node.text
+        handlers = table.get(tag)
+        if handlers:
+            parent_tag = stack[-1].tag if stack else None
+            for parent, fixer in handlers:
+                if parent is None or parent == parent_tag:
+                    counts[fixer.name] += fixer.fix(node, doc)
+        yield node, stack
+
+
+def finish_fixers(fixers: list, doc: CTFContext):
+    """Call the `finish` hook of each fixer that has one"""
+    for fixer in fixers:
+        if fixer.finish is not None:
+            fixer.finish(doc)
+
+
+def stream_fixed_ctf(ctf_path: str, out_file,
+                     pupil_file: Optional[Callable] = None) -> Optional[tuple]:
+    """Fix the CTF at `ctf_path` element by element, writing it to `out_file`
+
+    Each element is dispatched on its tag as it is closed, so child nodes are
+    always fixed before their parents, as they are by `process_ctf`.
+    Everything outside `Pupil` nodes (the header and the document skeleton)
+    is small, so it is kept and serialised around the streamed pupils.
+
+    Args:
+        ctf_path: The full path of the CTF file to be processed
+        out_file: A binary file object the fixed CTF is written to
+        pupil_file: If given, called with each fixed Pupil node and the
+            `CTFContext` to choose the binary file the pupil is written to,
+            instead of `out_file`
+
+    Returns:
+        None if the user chose to abort, else a (CTFContext, counts) tuple.
+        The context holds the facts needed to choose the output folder, and
+        counts maps fixer names to fix counts.
+    Raises:
+        ValueError if any students don't have surnames.
+        ET.ParseError if the file is not well-formed XML.
+    """
+
+    sentinel = ET.Element('CTFparserPupils')
+    sentinel_bytes = serialise(sentinel)
+    fixers = active_fixers()
+    doc = CTFContext()
+    doc.ncyear_actual = doc.first_dob = doc.creation_date = None
+    doc.first_leaving_date = None
+    doc.leaving_dates = []
+    counts = dict.fromkeys((fixer.name for fixer in fixers), 0)
+    fixed_source_name = None
+    doc_qualifier_checked = False
+    pupil_parent = None
+    # Each pupil is written once the next node closes, as the whitespace
+    # after it (its tail) mightn't have been parsed yet when it closed, and
+    # lxml gives its parent any tail parsed after it is removed
+    held = None
+
+    events = iterparse_xml(ctf_path, ('start', 'end'))
+    for node, stack in fix_elements(events, fixers, doc, counts):
+        if held is not None:
+            write_pupil(*held)
+            held = None
+        tag = node.tag
+        parent_tag = stack[-1].tag if stack else None
+        if tag == 'SchoolName' and fixed_source_name is None:
+            if any(n.tag == 'SourceSchool' for n in stack):
+                fixed_source_name = node.text
+        elif tag == 'NCyearActual' and doc.ncyear_actual is None:
+            doc.ncyear_actual = int(node.text)
+        elif tag == 'DOB' and parent_tag == 'Pupil' and doc.first_dob is None:
+            doc.first_dob = date.fromisoformat(node.text)
+        elif tag == 'DateTime' and doc.creation_date is None:
+            doc.creation_date = date.fromisoformat(
+                node.text[0:node.text.find('T')])
+        elif tag == 'School' and parent_tag == 'SchoolHistory':
+            if node.findtext('SchoolName') == (fixed_source_name or ''):
+                doc.leaving_dates.append(node.findtext('LeavingDate'))
+                if len(doc.leaving_dates) == 1:
+                    doc.first_leaving_date = node.findtext('.//LeavingDate')
+        elif tag == 'Header' and not doc_qualifier_checked:
+            doc_qualifier_checked = True
+            if is_data_missing(doc.root) and yes_no_q(ABORT_QUESTION):
+                return None
+        elif tag == 'Pupil':
+            if pupil_parent is None and stack:
+                # The first pupil: everything before it can now be written
+                pupil_parent = stack[-1]
+                pupil_parent.insert(list(pupil_parent).index(node), sentinel)
+                out_file.write(
+                    serialise(doc.root, True).split(sentinel_bytes)[0])
+            elif not (stack and stack[-1] is pupil_parent):
+                continue
+            if doc.nameless_UPNs:
+                pupil_parent.remove(node)
+                node.clear()
+            else:
+                held = (node, pupil_parent, pupil_file(node, doc)
+                        if pupil_file else out_file)
+
+    if held is not None:
+        write_pupil(*held)
+    if not doc_qualifier_checked:
+        if is_data_missing(doc.root) and yes_no_q(ABORT_QUESTION):
+            return None
+    finish_fixers(fixers, doc)
+
+    if pupil_parent is None:
+        out_file.write(serialise(doc.root, True))
+    else:
+        out_file.write(serialise(doc.root, True).split(sentinel_bytes)[1])
+    return doc, counts
+
+
+def write_pupil(pupil: ET.Element, parent: ET.Element, out_file):
+    """Remove a streamed pupil from its parent, write it and free it"""
+    parent.remove(pupil)
+    out_file.write(serialise(pupil))
+    pupil.clear()
+
+
+def serialise(node: ET.Element, xml_declaration: bool = False) -> bytes:
+    """Serialise a node exactly as `ElementTree.write` does for `process_ctf`"""
+    buffer = io.BytesIO()
+    ET.ElementTree(node).write(buffer, encoding='UTF-8',
+                               xml_declaration=xml_declaration)
+    return buffer.getvalue()
+
+
+def track_fixed_nodes(events, fixers: list, fixed: dict,
+                      tag_counts: dict) -> tuple:
+    """Wrap the parse events and fixers to record the nodes that get fixed
+
+    Every node a fixer reports fixing is recorded in `fixed` with its
+    position among the elements sharing its tag, so that `patch_ctf` can find
+    it in the original file. The tags of every fixer are counted in
+    `tag_counts`.
+    Returns:
+        (events, fixers) to pass to `fix_elements`
+    """
+
+    for fixer in fixers:
+        for tag in fixer.tags:
+            tag_counts[tag.rpartition('/')[2]] = 0
+    open_positions, closed_positions = [], {}
+
+    def numbered(events):
+        for event, node in events:
+            tag = node.tag
+            if tag in tag_counts:
+                if event == 'start':
+                    open_positions.append(tag_counts[tag])
+                    tag_counts[tag] += 1
+                else:
+                    closed_positions[tag] = open_positions.pop()
+            yield event, node
+
+    def tracked(fix: Callable) -> Callable:
+        def fix_tracked(node: ET.Element, doc: CTFContext) -> int:
+            count = fix(node, doc)
+            if count:
+                fixed[node] = closed_positions[node.tag]
+            return count
+        return fix_tracked
+
+    return numbered(events), [fixer._replace(fix=tracked(fixer.fix))
+                              for fixer in fixers]
+
+
+def find_fixed_nodes(src: mmap.mmap, fixed: dict,
+                     tag_counts: dict) -> Optional[dict]:
+    """Find the fixed nodes in the CTF's bytes by searching for their tags
+
+    Returns:
+        {node: (start, end)} byte offsets, or None if the nodes can't be found
+        this way: comments, CDATA and DTDs could hide a tag, and a node could
+        be nested in another with the same tag
+    """
+
+    if src.find(b'<!') != -1:
+        return None
+    by_tag = {}
+    for node, position in fixed.items():
+        by_tag.setdefault(node.tag, []).append((position, node))
+    spans = {}
+    for tag, nodes in by_tag.items():
+        name = re.escape(tag.encode())
+        starts = [match.start() for match in
+                  re.finditer(b'<' + name + rb'[\s/>]', src)]
+        end_tag = re.compile(b'</' + name + rb'\s*>')
+        if len(starts) != tag_counts[tag]:
+            return None
+        for position, node in nodes:
+            start = starts[position]
+            tag_end = START_TAG.match(src, start).end()
+            if src[tag_end - 2:tag_end] == b'/>':
+                spans[node] = (start, tag_end)
+                continue
+            end = end_tag.search(src, tag_end)
+            if end is None or (position + 1 < len(starts) and
+                               starts[position + 1] < end.start()):
+                return None
+            spans[node] = (start, end.end())
+    return spans
+
+
+def scan_fixed_nodes(ctf_path: str, src: mmap.mmap, fixed: dict) -> dict:
+    """Like `find_fixed_nodes`, but parses the CTF to find the nodes"""
+    wanted = {(node.tag, position): node for node, position in fixed.items()}
+    tag_counts, open_nodes, spans = {}, [], {}
+    parser = expat.ParserCreate()
+
+    def start_element(tag, _):
+        position = tag_counts.get(tag, 0)
+        tag_counts[tag] = position + 1
+        open_nodes.append((tag, position, parser.CurrentByteIndex))
+
+    def end_element(_):
+        tag, position, start = open_nodes.pop()
+        node = wanted.get((tag, position))
+        if node is not None:
+            # At the end tag, or just past the node if it is self-closing
+            end = parser.CurrentByteIndex
+            tag_end = START_TAG.match(src, start).end()
+            spans[node] = (start, tag_end if src[tag_end - 2:tag_end] == b'/>'
+                           else src.find(b'>', end) + 1)
+
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    with open(ctf_path, 'rb') as ctf_file:
+        parser.ParseFile(ctf_file)
+    return spans
+
+
+def patch_ctf(ctf_path: str, out_file, fixed: dict,
+              tag_counts: dict) -> bool:
+    """Write a fixed CTF by patching the original rather than serialising it
+
+    The original file is copied through as it is (keeping its formatting,
+    quoting and comments) except for the nodes that were fixed, which are
+    serialised in place. This relies on fixers only changing the node they
+    are given (or its descendants) and counting every change they make.
+    Args:
+        ctf_path: The original CTF
+        out_file: The file to write the fixed CTF to, open for bytes
+        fixed, tag_counts: As recorded by `track_fixed_nodes`
+    Returns:
+        Whether the CTF was written: False if the CTF isn't UTF-8 or the fixed
+        nodes couldn't be found in it, when the whole tree must be serialised
+        (nothing has been written to out_file then)
+    """
+
+    from xml.sax.saxutils import escape  # Slow to import: uses urllib
+
+    if not fixed:
+        with open(ctf_path, 'rb') as ctf_file:
+            shutil.copyfileobj(ctf_file, out_file)
+        return True
+
+    with open(ctf_path, 'rb') as ctf_file, \
+            mmap.mmap(ctf_file.fileno(), 0, access=mmap.ACCESS_READ) as src:
+        if not is_utf8(src):
+            return False
+        if any('}' in node.tag for node in fixed):
+            return False  # Serialising would rename the namespaces
+        spans = (find_fixed_nodes(src, fixed, tag_counts) or
+                 scan_fixed_nodes(ctf_path, src, fixed))
+        if len(spans) != len(fixed):
+            return False
+
+        with memoryview(src) as source:
+            copied_to = 0
+            for node, (start, end) in sorted(spans.items(),
+                                             key=lambda span: span[1]):
+                if start < copied_to:
+                    continue  # Inside a fixed node already written
+                out_file.write(source[copied_to:start])
+                if node.text and len(node) == 0 and not node.attrib:
+                    tag = node.tag.encode()
+                    out_file.write(b'<' + tag + b'>' +
+                                   escape(node.text).encode() +
+                                   b'</' + tag + b'>')
+                else:
+                    tail, node.tail = node.tail, None
+                    out_file.write(serialise(node))
+                    node.tail = tail
+                copied_to = end
+            out_file.write(source[copied_to:])
+    return True
+
+
+def is_utf8(src: mmap.mmap) -> bool:
+    """Whether a CTF's bytes are UTF-8, by its BOM and XML declaration"""
+    declaration = XML_DECLARATION.match(src)
+    return src[:2] not in (b'\xff\xfe', b'\xfe\xff') and not (
+        declaration and
+        declaration.group(1).upper() not in (b'UTF-8', b'UTF8'))
+
+
+def record_in_manifests(key: str, ctf_path: str, result: dict):
+    """Record a processed CTF in the manifest of each folder it was output to
+
+    The entry is the result (see `fix_ctf`) plus the CTF's key (see
+    `cache_key`, which covers the fixers used), its name, the fixer
+    signature, the time, and the modification time and size of each output.
+    Entries are appended to the manifest as single lines, so worker
+    processes can record CTFs output to the same folder at once, and a crash
+    loses at most the entry being written.
+    """
+
+    entry = dict(result, key=key, input=os.path.basename(ctf_path),
+                 fixers=fixer_signature(),
+                 processed=time.strftime('%Y-%m-%dT%H:%M:%S'))
+    outputs = entry.get('outputs', [entry])
+    for output in outputs:
+        output['stamp'] = file_stamp(output['output_path'])
+    line = json.dumps(entry) + '\n'
+    for folder in {os.path.dirname(output['output_path'])
+                   for output in outputs}:
+        with open(os.path.join(folder, MANIFEST_NAME), 'a') as manifest:
+            manifest.write(line)
+
+
+def current_manifest_entry(key: str) -> Optional[dict]:
+    """The manifest entry of an identical CTF whose outputs are unchanged
+
+    Looks in the manifests of all the output folders, which are under the
+    manifestParentDir setting if given, else the usual output parent dir.
+    Returns:
+        The entry (see `record_in_manifests`), or None if there isn't one or
+        any of its outputs have been changed or removed since
+    """
+
+    parent_dir = setting('manifestParentDir') or output_parent_dir()
+    for manifest_path in glob.glob(os.path.join(glob.escape(parent_dir), '*',
+                                                MANIFEST_NAME)):
+        entry = read_manifest(manifest_path).get(key)
+        if entry is not None and all(
+                file_stamp(output['output_path']) == output['stamp']
+                for output in entry.get('outputs', [entry])):
+            return entry
+    return None
+
+
+def read_manifest(manifest_path: str) -> dict:
+    """{key: entry} for a manifest, later entries replacing earlier ones"""
+    stamp = file_stamp(manifest_path)
+    if manifest_path in MANIFESTS and MANIFESTS[manifest_path][0] == stamp:
+        return MANIFESTS[manifest_path][1]
+    entries = {}
+    with open(manifest_path) as manifest:
+        for line in manifest:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # Cut short by a crash
+            entries[entry['key']] = entry
+    MANIFESTS[manifest_path] = (stamp, entries)
+    return entries
+
+
+def file_stamp(path: str) -> Optional[list]:
+    """[modification time in ns, size] of a file, or None if it's missing"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def exceeds_memory_limit(ctf_path: str) -> bool:
+    """Whether parsing the whole CTF might exceed the memoryLimitMB setting
+
+    Then the CTF should be streamed (see `fix_ctf_streaming`), which keeps
+    one pupil in memory at a time, and spills the pupil records kept for the
+    pupil index to disk, so the memory used doesn't depend on the file size.
+    """
+
+    limit = setting('memoryLimitMB')
+    return bool(limit) and (os.path.getsize(ctf_path) *
+                            TREE_BYTES_PER_FILE_BYTE > limit * 1e6)
+
+
+def fixer_signature() -> str:
+    """Identifies the fixes that will be made, for invalidating cached results
+
+    Bump FIXERS_VERSION whenever a fixer's behaviour changes. CTFs split by
+    cohort are cached separately, as their output is different.
+    """
+
+    exceptions = setting('nameCaseExceptions')
+    return f"{FIXERS_VERSION}:" + ','.join(
+        fixer.name for fixer in enabled_fixers()) + (
+        ':split' if setting('splitByCohort') else '') + (
+        ':' + json.dumps(exceptions, sort_keys=True) if exceptions else '')
+
+
+def cache_key(ctf_path: str) -> str:
+    """Hash of the CTF's bytes and the fixer signature, read in one pass"""
+    digest = hashlib.sha256(fixer_signature().encode())
+    with open(ctf_path, 'rb') as ctf_file:
+        for chunk in iter(lambda: ctf_file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def reuse_cached_output(cache_dir: str, key: str,
+                        ctf_path: str) -> Optional[dict]:
+    """Reuse the output of an identical CTF processed before, if there is one
+
+    Depending on the onDuplicate setting the previous output is either
+    hard-linked (or copied, where links aren't possible) to this CTF's output
+    path ('link', the default) or left as this CTF's output ('skip').
+    Returns:
+        None if there's no cached result whose output still exists, else the
+        result as returned by `fix_ctf`
+    """
+
+    try:
+        with open(os.path.join(cache_dir, key + '.json')) as entry_file:
+            result = json.load(entry_file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    outputs = result.get('outputs', [result])
+    if not all(os.path.exists(output['output_path']) for output in outputs):
+        return None
+
+    print('Identical to a CTF processed before; reusing its output')
+    if setting('onDuplicate', 'link') == 'link':
+        for output in outputs:
+            output_path = output_path_for(
+                ctf_path, result['escpd_source_name'], output['output_dir'])
+            if not os.path.exists(output_path):
+                try:
+                    os.link(output['output_path'], output_path)
+                    sync_dir(os.path.dirname(output_path))
+                except OSError:
+                    with open(output['output_path'], 'rb') as cached, \
+                            atomic_output(output_path) as out_file:
+                        shutil.copyfileobj(cached, out_file)
+            output['output_path'] = output_path
+        result['output_path'] = outputs[0]['output_path']
+    return result
+
+
+def store_cached_result(cache_dir: str, key: str, result: dict):
+    """Cache the result of processing a CTF
+
+    Old entries are evicted at the end of the batch, see `evict_batch_cache`,
+    rather than scanning the whole cache after every CTF.
+    """
+
+    os.makedirs(cache_dir, exist_ok=True)
+    entry_path = os.path.join(cache_dir, key + '.json')
+    with open(entry_path + '.tmp', 'w') as entry_file:
+        json.dump(result, entry_file)
+    os.replace(entry_path + '.tmp', entry_path)
+
+
+def evict_batch_cache():
+    """Evict old entries from the result cache, if there is one, once a batch
+    (or, when watching an inbox, each poll) has stored its results"""
+    cache_dir = setting('cacheDir')
+    if cache_dir and os.path.isdir(cache_dir):
+        evict_cache(cache_dir, setting('cacheMaxEntries', 10000),
+                    setting('cacheMaxAgeDays', 90))
+
+
+def evict_cache(cache_dir: str, max_entries: int, max_age_days: float):
+    """Delete cache entries older than max_age_days, then the oldest entries
+    until there are no more than max_entries"""
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith('.json'):
+            entries.append((entry.stat().st_mtime, entry.path))
+    entries.sort(reverse=True)
+    oldest_allowed = time.time() - max_age_days * 24 * 60 * 60
+    for position, (mtime, path) in enumerate(entries):
+        if position >= max_entries or mtime < oldest_allowed:
+            os.remove(path)
+
+
+def clear_cache(cache_dir: str):
+    """Delete every cached result, eg after changing a fixer"""
+    evict_cache(cache_dir, 0, 0)
+
+
+def new_stats(ctf_path: str, streaming: bool) -> dict:
+    return {'file': ctf_path, 'engine': 'streaming' if streaming else 'tree',
+            'start': time.perf_counter(), 'seconds': {}, 'fixer_seconds': {},
+            'nodes': 0, 'fixes': {}, 'success': False}
+
+
+@contextlib.contextmanager
+def timed_stage(name: str):
+    """Adds the time spent in the block to STATS['seconds'][name], if
+    instrumentation is enabled"""
+    if STATS is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = STATS['seconds']
+        seconds[name] = seconds.get(name, 0) + time.perf_counter() - start
+
+
+def instrumented(fixers: list) -> list:
+    """The fixers, wrapped to time each call if instrumentation is enabled
+
+    When it isn't the fixers are returned unchanged, so cost nothing extra.
+    """
+
+    if STATS is None:
+        return fixers
+    return [fixer._replace(fix=timed_fix(fixer.name, fixer.fix))
+            for fixer in fixers]
+
+
+def timed_fix(name: str, fix: Callable) -> Callable:
+    fixer_seconds = STATS['fixer_seconds']
+    fixer_seconds.setdefault(name, 0)
+
+    def timed(node: ET.Element, doc: CTFContext) -> int:
+        start = time.perf_counter()
+        try:
+            return fix(node, doc)
+        finally:
+            fixer_seconds[name] += time.perf_counter() - start
+    return timed
+
+
+def audited(fixers: list) -> list:
+    """The fixers, wrapped to record the changes they make if auditing
+
+    When auditing is off (see `audit_log`) the fixers are returned
+    unchanged, so cost nothing extra.
+    """
+
+    if AUDIT is None:
+        return fixers
+    return [fixer._replace(fix=audited_fix(fixer)) if fixer.changes
+            else fixer for fixer in fixers]
+
+
+def audited_fix(fixer: Fixer) -> Callable:
+    """`fixer.fix`, passing a row of AUDIT_COLUMNS to AUDIT for each change
+
+    The texts at the fixer's `changes` paths are compared before and after
+    each fix, so fixers needn't know about auditing.
+    """
+
+    record = AUDIT
+
+    def audited(node: ET.Element, doc: CTFContext) -> int:
+        before = node_texts(node, fixer.changes)
+        count = fixer.fix(node, doc)
+        if count:
+            upn, path = audit_location(node, doc.ancestors)
+            for sub_path, old, new in zip(fixer.changes, before,
+                                          node_texts(node, fixer.changes)):
+                if old == new:
+                    continue
+                change = ('added' if old is None else
+                          'removed' if new is None else 'changed')
+                record((fixer.name, upn, path if sub_path == '.' else
+                        f'{path}/{sub_path}', change, old, new))
+        return count
+    return audited
+
+
+def node_texts(node: ET.Element, paths: tuple) -> list:
+    """The text of the node at each path ('' if it has none), or None if
+    there is no node there"""
+    texts = []
+    for path in paths:
+        found = node if path == '.' else node.find(path)
+        texts.append(None if found is None else found.text or '')
+    return texts
+
+
+def audit_location(node: ET.Element, ancestors: list) -> tuple:
+    """(UPN, path) of a node for the audit log
+
+    The UPN is that of the pupil the node is in ('' if it isn't in one) and
+    the path runs from that pupil, or from the root if there isn't one.
+    """
+
+    nodes = ancestors + [node]
+    for depth, ancestor in enumerate(nodes):
+        if ancestor.tag == 'Pupil':
+            return (ancestor.findtext('UPN') or '',
+                    '/'.join(n.tag for n in nodes[depth:]))
+    return '', '/'.join(n.tag for n in nodes)
+
+
+@contextlib.contextmanager
+def audit_log(ctf_path: str):
+    """Record the changes made to a CTF in the block in its own audit log
+
+    If the auditDir setting is given, each change the fixers make is
+    written as it is made to a CSV file in that folder named after the CTF
+    (see `audit_log_path`), with the columns AUDIT_COLUMNS. The file is
+    kept only if the block sets 'written' in the yielded dict, ie the fixed
+    CTF was written, when the dict's 'path' is set to the audit log's path.
+    """
+
+    global AUDIT
+    audit = {'written': False, 'path': None}
+    audit_dir = setting('auditDir')
+    if not audit_dir:
+        yield audit
+        return
+    make_dirs(audit_dir)
+    # With a BOM, so Excel reads names with accents correctly
+    log_file = tempfile.NamedTemporaryFile(
+        'w', newline='', encoding='utf-8-sig', dir=audit_dir,
+        suffix='.partial', delete=False)
+    try:
+        with log_file:
+            writer = csv.writer(log_file)
+            writer.writerow(AUDIT_COLUMNS)
+            AUDIT = writer.writerow
+            yield audit
+        if audit['written']:
+            audit['path'] = audit_log_path(ctf_path)
+            give_output_mode(log_file.name, audit['path'])
+            os.replace(log_file.name, audit['path'])
+    finally:
+        AUDIT = None
+        if os.path.exists(log_file.name):
+            os.remove(log_file.name)
+
+
+def audit_log_path(ctf_path: str) -> str:
+    """The audit log of a CTF, in the auditDir folder
+
+    It is named after the CTF and a short hash of the CTF's folder, so CTFs
+    of the same name from different folders (eg each feeder school's
+    export.xml) have their own logs. The folder is the auditSourceDir
+    setting if given, for CTFs processed from a staged copy.
+    """
+
+    folder = setting('auditSourceDir') or os.path.dirname(ctf_path)
+    digest = hashlib.sha256(os.path.normcase(os.path.abspath(folder))
+                            .encode()).hexdigest()
+    name = os.path.splitext(os.path.basename(ctf_path))[0]
+    return os.path.join(setting('auditDir'), f'{name}_{digest[:8]}.audit.csv')
+
+
+def audit_log_stamps(ctf_paths: list) -> dict:
+    """The `file_stamp` of each CTF's audit log, if auditing, by log path"""
+    if not setting('auditDir'):
+        return {}
+    return {log_path: file_stamp(log_path) for log_path in
+            map(audit_log_path, ctf_paths)}
+
+
+def write_batch_audit(ctf_paths: list, stamps: dict) -> Optional[str]:
+    """Combine the audit logs of a batch's CTFs into one, and summarise it
+
+    Args:
+        ctf_paths: The CTFs in the batch
+        stamps: `audit_log_stamps` from before the batch. Audit logs that
+            haven't changed since (eg of CTFs whose earlier output was
+            reused) are left out.
+    Returns:
+        The path of the combined log, which has the CTF's path as an extra
+        first column, or None if there was nothing to combine
+    """
+
+    audit_dir = setting('auditDir')
+    log_paths = [(ctf_path, audit_log_path(ctf_path))
+                 for ctf_path in ctf_paths] if audit_dir else []
+    log_paths = [(ctf_path, log_path) for ctf_path, log_path in log_paths
+                 if file_stamp(log_path) not in (None, stamps.get(log_path))]
+    if not log_paths:
+        return None
+    batch_path = os.path.join(
+        audit_dir, f"batch_{time.strftime('%Y%m%d_%H%M%S')}.audit.csv")
+    changes, pupils = 0, set()
+    with open(batch_path + '.partial', 'w', newline='',
+              encoding='utf-8-sig') as batch_file:
+        writer = csv.writer(batch_file)
+        writer.writerow(('ctf',) + AUDIT_COLUMNS)
+        for ctf_path, log_path in log_paths:
+            with open(log_path, newline='', encoding='utf-8-sig') as log_file:
+                rows = csv.reader(log_file)
+                next(rows)
+                for row in rows:
+                    writer.writerow([ctf_path] + row)
+                    changes += 1
+                    if row[1]:
+                        pupils.add((ctf_path, row[1]))
+    os.replace(batch_path + '.partial', batch_path)
+    print(f'Audit: {changes} change{plural(changes)} to {len(pupils)} '
+          f'pupil{plural(len(pupils))} in {len(log_paths)} '
+          f'CTF{plural(len(log_paths))}, listed in {batch_path}')
+    return batch_path
+
+
+def counted_events(events):
+    """Passes on parse events, counting the nodes closed in STATS['nodes']"""
+    stats = STATS
+    for event, node in events:
+        if event == 'end':
+            stats['nodes'] += 1
+        yield event, node
+
+
+def append_stats_line(stats_log: str, stats: dict):
+    """Append the stats for one CTF to the log as a line of JSON"""
+    with open(stats_log, 'a') as log_file:
+        log_file.write(json.dumps(stats) + '\n')
+
+
+@contextlib.contextmanager
+def diagnostics(ctf_path: str):
+    """Profile or trace the memory of the block if the CTF is the one named
+    by the profileCTF or traceMemoryCTF setting
+
+    The profile is saved beside the CTF as <name>.prof and summarised, as is
+    the memory trace, on stdout.
+    """
+
+    name = os.path.basename(ctf_path)
+    if name == setting('profileCTF'):
+        import cProfile
+        import pstats
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            profile.dump_stats(ctf_path + '.prof')
+            print('Profile saved to', ctf_path + '.prof')
+            pstats.Stats(profile, stream=sys.stdout).sort_stats(
+                'cumulative').print_stats(15)
+    elif name == setting('traceMemoryCTF'):
+        tracemalloc.start()
+        try:
+            yield
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f'Peak traced memory: {peak / 1e6:.1f} MB. Top allocations:')
+            for line in snapshot.statistics('lineno')[:10]:
+                print(' ', line)
+    else:
+        yield
+
+
+def print_stats_report(all_stats: list):
+    """Summarise the stats of every CTF in a batch"""
+    if not all_stats:
+        return
+    seconds, fixer_seconds, fixes = {}, {}, {}
+    for stats in all_stats:
+        for totals, values in [(seconds, stats['seconds']),
+                               (fixer_seconds, stats['fixer_seconds']),
+                               (fixes, stats['fixes'])]:
+            for name, value in values.items():
+                totals[name] = totals.get(name, 0) + value
+    nodes = sum(stats['nodes'] for stats in all_stats)
+    slowest = max(all_stats, key=lambda stats: stats['seconds']['total'])
+    print(f"Stats for {len(all_stats)} file{plural(len(all_stats))}: "
+          f"{seconds.pop('total'):.3f}s in total, {nodes} nodes visited")
+    for name, total in seconds.items():
+        print(f'  {name:16} {total:9.3f}s')
+    for name, total in fixer_seconds.items():
+        per_node = f' ({total / nodes * 1e6:.2f} µs/node)' if nodes else ''
+        print(f'  fixer {name:10} {total:9.3f}s, {fixes.get(name, 0)} '
+              f'fixes{per_node}')
+    print(f"  slowest: {slowest['file']} "
+          f"({slowest['seconds']['total']:.3f}s)")
+
+
+def report_fixes(counts: dict):
+    """Tell the user how many of each kind of fix were made
+
+    Args:
+        counts: Fixer name to the number of fixes it made
+    """
+
+    for name, count in counts.items():
+        if count > 0:
+            print(FIXERS[name].report(count))
+
+
 def is_data_missing(root_node: ET.Element) -> bool:
     """Checks whether a XML tree claims to be a `full` CTF file
 
@@ -101,26 +2021,54 @@ def is_data_missing(root_node: ET.Element) -> bool:
 
 
 def yes_no_q(question: str) -> bool:
-    """Asks user a yes/no question 3 times, assumes no on 3rd failure
+    """Answers a yes/no question arising while processing a CTF
 
+    If the question has an answer in `PRESET_ANSWERS` that is returned.
+    Otherwise the decision policy named by the decisions setting (see
+    `DECISION_POLICIES`) answers it: by default, by asking the user.
     Args:
         question: A yes/no question to put to the user. Do not include options;
             '(y/n)' will be appended to the question automatically
+    Returns:
+        Boolean representing the decision
+    Raises:
+        DecisionDeferred if the decision is deferred until the end of a batch
+    """
+
+    if question in PRESET_ANSWERS:
+        return PRESET_ANSWERS[question]
+    return DECISION_POLICIES[setting('decisions', 'interactive')](question)
+
+
+def ask_user(question: str) -> bool:
+    """Asks user a yes/no question 3 times, assumes no on 3rd failure
+
     Returns:
         Boolean representing the user's choice, or False if they fail 3 times
         to answer with a 'y' or 'no'.
     """
 
-    yes_regex = re.compile('[yY]')
-    no_regex = re.compile('[nN]')
-    attempts = 0
-    while True:
+    for _ in range(3):
         user_choice = input(f'{question} (y/n)\n')
-        if yes_regex.search(user_choice) or attempts > 3:
+        if YES_ANSWER.search(user_choice):
             return True
 
-        if no_regex.search(user_choice):
+        if NO_ANSWER.search(user_choice):
             return False
+    return False
+
+
+def defer_decision(question: str) -> bool:
+    """Decision policy leaving the question for the operator to answer at the
+    end of the batch, see `settle_deferred`"""
+    raise DecisionDeferred(question)
+
+
+# How yes_no_q decides questions without a preset answer, by the decisions
+# setting: ask the user there and then, answer no, or defer the CTF
+DECISION_POLICIES = {'interactive': ask_user,
+                     'preset': lambda question: False,
+                     'defer': defer_decision}
 
 
 def repair_case_where_appropriate(parent_node: ET.Element) -> int:
@@ -133,13 +2081,99 @@ def repair_case_where_appropriate(parent_node: ET.Element) -> int:
         Integer count of the number of nodes whose case has been fixed
     """
 
-    fixed_cnt = 0
+    nodes_by_name = {}
     for name_node in list_suspectly_cased_nodes(parent_node):
         name = name_node.text
-        if name is not None and re.match(r'[A-Z.\'\-\s]+$', name):
-            name_node.text = name.title()
-            fixed_cnt += 1
-    return fixed_cnt
+        if name is not None and ALL_CAPS_NAME.match(name):
+            nodes_by_name.setdefault(name, []).append(name_node)
+
+    case_name = name_caser()
+    for name, name_nodes in nodes_by_name.items():
+        cased = case_name(name)
+        for name_node in name_nodes:
+            name_node.text = cased
+    return sum(map(len, nodes_by_name.values()))
+
+
+@register_fixer('case', NAME_TAGS,
+                lambda count: f"Case fixed for {count} name{plural(count)}")
+def fix_name_case(name_node: ET.Element, doc: CTFContext) -> int:
+    return repair_name_case(name_node, doc.case_name)
+
+
+def repair_name_case(name_node: ET.Element,
+                     case_name: Optional[Callable[[str], str]] = None) -> bool:
+    """Title case the passed name node if it is entirely upper case
+
+    Args:
+        case_name: A `name_caser`, if one has already been got
+    Returns:
+        True if the node's case was fixed
+    """
+
+    name = name_node.text
+    if name is not None and ALL_CAPS_NAME.match(name):
+        name_node.text = (case_name or name_caser())(name)
+        return True
+    return False
+
+
+def name_caser() -> Callable[[str], str]:
+    """`title_case_name` with the nameCaseExceptions setting, memoised
+
+    The most recently used NAME_CASE_CACHE_SIZE names are remembered, so
+    names repeated throughout a CTF, or a batch, are each cased once.
+    """
+
+    exceptions = setting('nameCaseExceptions') or {}
+    return exceptions_name_caser(json.dumps(exceptions, sort_keys=True))
+
+
+@lru_cache(maxsize=1)
+def exceptions_name_caser(exceptions_json: str) -> Callable[[str], str]:
+    """The `name_caser` for some exceptions, given as JSON"""
+    exceptions = {name.upper(): cased
+                  for name, cased in json.loads(exceptions_json).items()}
+
+    @lru_cache(maxsize=NAME_CASE_CACHE_SIZE)
+    def case_name(name: str) -> str:
+        return title_case_name(name, exceptions)
+
+    return case_name
+
+
+def title_case_name(name: str, exceptions: Optional[dict] = None) -> str:
+    """Title case an upper-case name, observing the conventions of names
+
+    Unlike `str.title`, leaves particles such as van and de lower case
+    (unless they start the name), capitalises the letter after Mc and
+    doesn't capitalise a possessive s.
+    Args:
+        name: The name to case
+        exceptions: Correctly cased names or words, keyed by their upper case
+            form, eg {"MACDONALD": "MacDonald"}. A whole name is looked up
+            before its words, and a word before the parts of it joined by
+            hyphens, eg MACDONALD-JONES.
+    Returns:
+        The name, cased
+    """
+
+    exceptions = exceptions or {}
+    if name.upper() in exceptions:
+        return exceptions[name.upper()]
+    words = name.split(' ')
+    for index, word in enumerate(words):
+        if word.upper() in exceptions:
+            words[index] = exceptions[word.upper()]
+        elif index and word.lower() in NAME_PARTICLES:
+            words[index] = word.lower()
+        else:
+            cased = POSSESSIVE_S.sub("'s", MC_PREFIX.sub(
+                lambda match: 'Mc' + match.group(1).upper(), word.title()))
+            words[index] = '-'.join(
+                exceptions.get(part.upper(), cased_part) for part, cased_part
+                in zip(word.split('-'), cased.split('-')))
+    return ' '.join(words)
 
 
 def list_suspectly_cased_nodes(parent_node: ET.Element) -> list:
@@ -152,27 +2186,170 @@ def list_suspectly_cased_nodes(parent_node: ET.Element) -> list:
         List of all nodes containing proper names
     """
 
-    name_nodes = []
-    for tag in ['Surname', 'Forename', 'PreferredSurname', 'PreferredForename',
-                'MiddleNames', 'FormerSurname', 'SchoolName']:
-        name_nodes += parent_node.findall('.//' + tag)
-    return name_nodes
+    return [node for node in parent_node.iter() if node.tag in NAME_TAGS
+            and node is not parent_node]
+
+
+def sub_element(parent: ET.Element, tag: str) -> ET.Element:
+    """Like `ET.SubElement`, but works whichever backend made the parent"""
+    node = parent.makeelement(tag, {})
+    parent.append(node)
+    return node
+
+
+def trim_empty_nodes(parent_node: ET.Element, source_name: str) -> int:
+    """Remove any empty LeavingDate and RemovalGrounds nodes
+
+    Each learner MAY have the source school as a School node under their
+    SchoolHistory node. And these nodes MAY have LeavingDate and RemovalGrounds
+    child nodes, but if they're blank Progresso gets upset. So we look for
+    blanks and delete them.
+    Args:
+        parent_node: An XML node that may contain child-nodes containing
+            people's names
+        source_name: String representing the name (not path) of the XML file
+    Returns:
+        Integer count of the number of nodes trimmed
+    """
+
+    fixed_cnt = 0
+    for source_in_hist in source_school_appearances_in_history(parent_node,
+                                                               source_name):
+        fixed_cnt += trim_empty_history_nodes(source_in_hist)
+    return fixed_cnt
+
+
+@register_fixer('empty_nodes', ['SchoolHistory/School'],
+                lambda count: f"Trimmed {count} empty field{plural(count)}",
+                changes=('LeavingDate', 'RemovalGrounds'))
+def fix_empty_history_nodes(school_node: ET.Element, doc: CTFContext) -> int:
+    """Trim the node if it is an appearance of the source school"""
+    if school_node.findtext('SchoolName') != (doc.source_name or ''):
+        return 0
+    return trim_empty_history_nodes(school_node)
+
+
+def trim_empty_history_nodes(school_node: ET.Element) -> int:
+    """Remove empty LeavingDate and RemovalGrounds nodes from a School node"""
+    fixed_cnt = 0
+    for tag in ['LeavingDate', 'RemovalGrounds']:
+        bad_node = school_node.find(tag)
+        if bad_node is not None and bad_node.text is None:
+            school_node.remove(bad_node)
+            fixed_cnt += 1
+    return fixed_cnt
+
+
+def remove_spaces_from_phone_numbers(xml_tree: ET.Element) -> int:
+    """Canonicalises the phone numbers in nodes named 'PhoneNo'
+
+    See `canonical_phone_number`.
+    Args:
+        xml_tree: An XML node that may have children with 'PhoneNo' tags
+    Returns:
+        count of the phone numbers that have been changed
+    """
+    fix_count = 0
+    for phone_node in xml_tree.iter('PhoneNo'):
+        fix_count += canonicalise_node(phone_node, canonical_phone_number)
+    return fix_count
+
+
+def normalise_contact_details(xml_tree: ET.Element) -> int:
+    """Canonicalises every phone number, postcode and email address in one
+    pass over the node's descendants
+
+    Returns:
+        count of the nodes that have been changed
+    """
+
+    fix_count = 0
+    for node in xml_tree.iter():
+        canonical = CONTACT_CANONICALISERS.get(node.tag)
+        if canonical is not None:
+            fix_count += canonicalise_node(node, canonical)
+    return fix_count
+
+
+def canonicalise_node(node: ET.Element,
+                      canonical: Callable[[str], str]) -> bool:
+    """Replace a node's text with its canonical form; empty nodes are left
+
+    Returns:
+        True if the node's text was changed
+    """
+
+    if node.text is None:
+        return False
+    canonical_text = canonical(node.text)
+    if canonical_text != node.text:
+        node.text = canonical_text
+        return True
+    return False
+
+
+@register_fixer('phone_numbers', ['PhoneNo'],
+                lambda count: f"Tidied {count} phone number{plural(count)}")
+def fix_phone_number(phone_node: ET.Element, doc: CTFContext) -> int:
+    return canonicalise_node(phone_node, canonical_phone_number)
+
+
+@register_fixer('postcodes', ['PostCode'],
+                lambda count: f"Tidied {count} postcode{plural(count)}")
+def fix_postcode(postcode_node: ET.Element, doc: CTFContext) -> int:
+    return canonicalise_node(postcode_node, canonical_postcode)
+
+
+@register_fixer('emails', ['Email'],
+                lambda count: f"Tidied {count} email address"
+                              f"{'es' if count != 1 else ''}")
+def fix_email(email_node: ET.Element, doc: CTFContext) -> int:
+    return canonicalise_node(email_node, canonical_email)
+
+
+@lru_cache(maxsize=CONTACT_CACHE_SIZE)
+def canonical_phone_number(number: str) -> str:
+    """A phone number without separators, UK numbers as dialled in the UK
+
+    eg ' +44 (0)7835-979 025' gives '07835979025'. Anything that doesn't
+    come to a single plausible number, eg a number with an extension or two
+    numbers ('01935 123456 / 07700 900123'), only loses its whitespace.
+    """
+
+    digits = PHONE_SEPARATORS.sub('', number)
+    if PHONE_DIGITS.match(digits):
+        for code in UK_DIALLING_CODES:
+            if digits.startswith(code):
+                digits = '0' + digits[len(code):]
+                break
+        if PLAUSIBLE_PHONE_NUMBER.match(digits):
+            return digits
+    return ''.join(number.split())
+
+
+@lru_cache(maxsize=CONTACT_CACHE_SIZE)
+def canonical_postcode(postcode: str) -> str:
+    """A UK postcode in capitals with a space before the inward code
+
+    eg 'dt93ap ' gives 'DT9 3AP'. Anything else only loses its padding.
+    """
+
+    match = UK_POSTCODE.match(''.join(postcode.split()).upper())
+    return f'{match[1]} {match[2]}' if match else postcode.strip()
+
 
+@lru_cache(maxsize=CONTACT_CACHE_SIZE)
+def canonical_email(email: str) -> str:
+    """An email address without whitespace, its domain in lower case"""
+    email = ''.join(email.split())
+    local, at, domain = email.rpartition('@')
+    return local + at + domain.lower() if at else email
 
-def remove_spaces_from_phone_numbers(xml_tree: ET.Element) -> int:
-    """Removes all padding and internal spaces from nodes named 'PhoneNo'
 
-    Args:
-        xml_tree: An XML node that may have children with 'PhoneNo' tags
-    Returns:
-        count of the phone numbers with spaces in that have been removed
-    """
-    fix_count = 0
-    for phone_node in xml_tree.findall('.//PhoneNo'):
-        if phone_node.text.find(' ') >= 0:
-            fix_count += 1
-            phone_node.text = phone_node.text.replace(' ', '')
-    return fix_count
+# Canonical forms of contact details, by tag. See `normalise_contact_details`.
+CONTACT_CANONICALISERS = {'PhoneNo': canonical_phone_number,
+                          'PostCode': canonical_postcode,
+                          'Email': canonical_email}
 
 
 def ensure_surnames_are_legal(tree: ET.Element) -> int:
@@ -199,21 +2376,10 @@ def ensure_surnames_are_legal(tree: ET.Element) -> int:
     if not fix_count:
         return 0
     for pupil_node in all_pupils:
-        surname_node = pupil_node.find('Surname')
-        pref_surname_node = pupil_node.find('./BasicDetails/PreferredSurname')
-        if surname_node is not None and pref_surname_node is not None:
-            if surname_node.text != pref_surname_node.text:
-                pref_surname_node.text = surname_node.text
-            else:
-                fix_count -= 1
-        elif surname_node is not None:
-            pref_surname_node = ET.SubElement(pupil_node.find('BasicDetails'),
-                                              'PreferredSurname')
-            pref_surname_node.text = surname_node.text
-        elif pref_surname_node is not None:
-            surname_node = ET.SubElement(pupil_node, 'Surname')
-            surname_node.text = pref_surname_node.text
-        else:
+        legal = legalise_pupil_surname(pupil_node)
+        if legal is False:
+            fix_count -= 1
+        elif legal is None:
             # Neither Surname nor Preferred Surname found -> error
             upn_node = pupil_node.find('.//UPN')
             upn = 'UPN-missing' if upn_node is None else upn_node.text
@@ -224,73 +2390,428 @@ def ensure_surnames_are_legal(tree: ET.Element) -> int:
     return fix_count
 
 
-def trim_empty_nodes(parent_node: ET.Element, source_name: str) -> int:
-    """Remove any empty LeavingDate and RemovalGrounds nodes
+def report_nameless_pupils(doc: CTFContext):
+    """Raises ValueError if `fix_pupil_surname` found any nameless pupils"""
+    nameless_UPNs = doc.nameless_UPNs
+    if len(nameless_UPNs) > 0:
+        raise ValueError('Students with these UPNs have no surnames: ' +
+                         f"{', '.join(nameless_UPNs)}. This CTF is invalid.")
 
-    Each learner MAY have the source school as a School node under their
-    SchoolHistory node. And these nodes MAY have LeavingDate and RemovalGrounds
-    child nodes, but if they're blank Progresso gets upset. So we look for
-    blanks and delete them.
+
+@register_fixer('surnames', ['Pupil'],
+                lambda count: f"Replaced {count} surname{plural(count)} with "
+                              f"legal surname{plural(count)}",
+                finish=report_nameless_pupils,
+                changes=('Surname', 'BasicDetails/PreferredSurname'))
+def fix_pupil_surname(pupil_node: ET.Element, doc: CTFContext) -> int:
+    """Legalise a pupil's surnames, noting the UPN of pupils with neither"""
+    legal = legalise_pupil_surname(pupil_node)
+    if legal is None:
+        upn_node = pupil_node.find('.//UPN')
+        doc.nameless_UPNs.append(
+            'UPN-missing' if upn_node is None else upn_node.text)
+    return legal is not False
+
+
+def legalise_pupil_surname(pupil_node: ET.Element) -> Optional[bool]:
+    """Make a single Pupil's Surname and PreferredSurname nodes agree
+
+    See `ensure_surnames_are_legal`.
+    Returns:
+        True if a node was updated or created, False if the surnames already
+        agreed, or None if the pupil has neither surname node.
+    """
+
+    surname_node = pupil_node.find('Surname')
+    pref_surname_node = pupil_node.find('./BasicDetails/PreferredSurname')
+    if surname_node is not None and pref_surname_node is not None:
+        if surname_node.text == pref_surname_node.text:
+            return False
+        pref_surname_node.text = surname_node.text
+    elif surname_node is not None:
+        pref_surname_node = sub_element(pupil_node.find('BasicDetails'),
+                                        'PreferredSurname')
+        pref_surname_node.text = surname_node.text
+    elif pref_surname_node is not None:
+        surname_node = sub_element(pupil_node, 'Surname')
+        surname_node.text = pref_surname_node.text
+    else:
+        return None
+    return True
+
+
+def record_pupil(pupil_node: ET.Element, doc: CTFContext) -> int:
+    """Add a fixed pupil's `PupilRecord` to `doc.pupils`; fixes nothing"""
+    doc.pupils.append(PupilRecord(
+        pupil_node.findtext('UPN'), pupil_node.findtext('Surname'),
+        pupil_node.findtext('BasicDetails/PreferredSurname'),
+        pupil_node.findtext('DOB'),
+        pupil_year_group(pupil_node, doc),
+        get_source_school(doc.root)))
+    if (len(doc.pupils) >= PUPIL_RECORDS_IN_MEMORY and
+            setting('memoryLimitMB')):
+        doc.spill_pupils()
+    return 0
+
+
+# Records each pupil for the pupil index. Not registered in FIXERS, as it
+# doesn't change the CTF; added to the fixers run by `active_fixers`.
+PUPIL_INDEXER = Fixer('pupil_index', ('CTFpupilData/Pupil',), record_pupil,
+                      lambda count: '', changes=())
+
+
+def index_pupils(db_path: str, pupils: list, ctf_path: str, outputs: list):
+    """Add the pupils of a processed CTF to the SQLite pupil index
+
+    The index keeps a row per pupil of each CTF, by their position in it, so
+    pupils sharing a UPN within a CTF are all recorded. The CTF's rows are
+    replaced if it is processed again, rather than duplicated.
     Args:
-        parent_node: An XML node that may contain child-nodes containing
-            people's names
-        source_name: String representing the name (not path) of the XML file
+        db_path: The index file, created if need be
+        pupils: `PupilRecord`s of the CTF's pupils
+        ctf_path: The CTF
+        outputs: The CTF's outputs, as in the result of `fix_ctf_split`
+    """
+
+    outputs_by_year = {year_group: output['output_path']
+                       for output in outputs
+                       for year_group in output.get('year_groups', [0])}
+
+    def output_path(pupil: PupilRecord) -> str:
+        if len(outputs) == 1:
+            return outputs[0]['output_path']
+        return outputs_by_year[pupil.year_group
+                               if pupil.year_group in (6, 11) else 0]
+
+    with contextlib.closing(open_pupil_index(db_path)) as db, db:
+        db.execute('DELETE FROM pupils WHERE ctf_path = ?', (ctf_path,))
+        db.executemany(
+            'INSERT INTO pupils VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (pupil + (ctf_path, output_path(pupil), position)
+             for position, pupil in enumerate(pupils)))
+
+
+def open_pupil_index(db_path: str) -> sqlite3.Connection:
+    """Connect to the pupil index, creating it if need be
+
+    Connections wait for each other, so worker processes can share an index.
+    """
+
+    db = sqlite3.connect(db_path, timeout=60)
+    with db:
+        db.execute('CREATE TABLE IF NOT EXISTS pupils (upn TEXT, '
+                   'surname TEXT, preferred_surname TEXT, dob TEXT, '
+                   'year_group INTEGER, source_school TEXT, ctf_path TEXT, '
+                   'output_path TEXT, position INTEGER, '
+                   'PRIMARY KEY (ctf_path, position))')
+        db.execute('CREATE INDEX IF NOT EXISTS pupils_by_upn ON pupils (upn)')
+    return db
+
+
+def pupil_index_report(db_path: str) -> list:
+    """Describe each UPN found more than once in the pupil index
+
+    Duplicates are flagged if they came from different schools or have
+    different surnames or DOBs. Only the duplicated rows are read, in UPN
+    order, so the report scales with the number of duplicates rather than
+    the size of the index.
     Returns:
-        Integer count of the number of nodes trimmed
+        The lines of the report
     """
 
-    fixed_cnt = 0
-    for source_in_hist in source_school_appearances_in_history(parent_node,
-                                                               source_name):
-        for tag in ['LeavingDate', 'RemovalGrounds']:
-            bad_node = source_in_hist.find(tag)
-            if bad_node and bad_node.text is None:
-                source_in_hist.remove(bad_node)
-                fixed_cnt += 1
-    return fixed_cnt
+    query = ('SELECT upn, surname, dob, source_school, output_path, ctf_path '
+             'FROM pupils WHERE upn IN (SELECT upn FROM pupils '
+             'WHERE upn IS NOT NULL GROUP BY upn HAVING COUNT(*) > 1) '
+             'ORDER BY upn, output_path, position')
+    lines = []
+    with contextlib.closing(open_pupil_index(db_path)) as db:
+        for upn, rows in groupby(db.execute(query), lambda row: row[0]):
+            rows = list(rows)
+            conflicts = [name for name, column in
+                         (('schools', 3), ('surnames', 1), ('DOBs', 2))
+                         if len({row[column] for row in rows}) > 1]
+            ctfs = len({row[5] for row in rows})
+            if ctfs == len(rows):
+                lines.append(f'UPN {upn} is in {ctfs} CTFs')
+            else:
+                lines.append(f'UPN {upn} is used by {len(rows)} pupils in '
+                             f'{ctfs} CTF{plural(ctfs)}')
+            if conflicts:
+                lines[-1] += f' with different {", ".join(conflicts)}'
+            lines += [f'    {surname}, born {dob}, from {school}: {path}'
+                      for _, surname, dob, school, path, _ in rows]
+    return lines
+
+
+def print_pupil_index_report(db_path: str):
+    lines = pupil_index_report(db_path)
+    if lines:
+        print(f'\nDuplicate pupils in {db_path}:')
+        print('\n'.join(lines))
+    else:
+        print(f'\nNo duplicate pupils in {db_path}')
 
 
 def determine_output_path(input_path: str,
                           source_name: str,
                           root_node: ET.Element) -> str:
     """Returns string of the relative path of the output file"""
+    return output_path_for(input_path, source_name, get_output_dir(root_node))
+
+
+def output_path_for(input_path: str, source_name: str, output_dir: str) -> str:
+    """Returns the output path for a CTF bound for the named output folder
+
+    The folder is created under the output parent dir if it doesn't exist.
+    """
+
     output_name = (input_path.rsplit('/', 1)[-1]
                    .replace('.', f'_{source_name}.'))
-    output_dir = os.path.join((config_parent_dir() or 'T:/CMIS/CTF Files/'),
-                              get_output_dir(root_node))
-    os.makedirs(output_dir, exist_ok=True)
+    output_dir = os.path.join(output_parent_dir(), output_dir)
+    make_dirs(output_dir)
     return os.path.join(output_dir, output_name)
 
 
-def config_parent_dir() -> str:
+def make_dirs(path: str):
+    """`os.makedirs`, unless the folder has already been made this run
+
+    Each call can take a while on a network share, and most CTFs go to one
+    of the same few folders.
+    """
+
+    if path not in MADE_DIRS:
+        if not os.path.isdir(path):
+            os.makedirs(path, exist_ok=True)
+            # Even with syncWrites 'batch', as originals are renamed once
+            # their outputs are in it (see `sync_output_dirs`)
+            if setting('syncWrites', 'each') != 'off':
+                fsync_dir(os.path.dirname(os.path.normpath(path)))
+        MADE_DIRS.add(path)
+
+
+@contextlib.contextmanager
+def atomic_output(output_path: str):
+    """Write an output to a temporary file, moving it into place once complete
+
+    Yields the temporary file, open for writing bytes, which is made in the
+    output's folder so it can be renamed over the output in one step. If the
+    block fails the temporary file is removed, so a crash or error never
+    leaves a truncated CTF where the MIS would import it.
+    """
+
+    out_file = tempfile.NamedTemporaryFile(
+        dir=os.path.dirname(output_path) or '.', suffix='.partial',
+        delete=False)
+    try:
+        with out_file:
+            yield out_file
+            sync_file(out_file)
+        replace_output(out_file.name, output_path)
+    finally:
+        if os.path.exists(out_file.name):
+            os.remove(out_file.name)
+
+
+def replace_output(partial_path: str, output_path: str):
+    """Move a complete output (already synced, see `sync_file`) into place"""
+    give_output_mode(partial_path, output_path)
+    os.replace(partial_path, output_path)
+    sync_dir(os.path.dirname(output_path))
+
+
+def give_output_mode(partial_path: str, output_path: str):
+    """Give a temporary file the mode of the output it is to replace, or if
+    there isn't one the mode of a new file
+
+    Temporary files can only be read by their owner, which would stop eg
+    the MIS's service account importing outputs from a shared folder.
+    """
+
+    try:
+        mode = os.stat(output_path).st_mode & 0o7777
+    except FileNotFoundError:
+        mode = 0o666 & ~UMASK
+    os.chmod(partial_path, mode)
+
+
+def sync_file(out_file):
+    """Flush a file being output to disk, unless syncWrites is 'off'
+
+    Done before the file is renamed into place, so that after a crash the
+    output is either complete or not there at all.
+    """
+
+    if setting('syncWrites', 'each') != 'off':
+        out_file.flush()
+        os.fsync(out_file.fileno())
+
+
+def sync_dir(path: str):
+    """Flush the entries of a folder, eg an output just moved into it, to
+    disk, if syncWrites is 'each'. With 'batch' they are flushed once at the
+    end of the batch instead, see `sync_batch_dirs`."""
+    if setting('syncWrites', 'each') == 'each':
+        fsync_dir(path)
+
+
+def sync_output_dirs(output_paths: list):
+    """Flush the folders a CTF's outputs were moved to, before its original
+    is renamed, if syncWrites is 'batch'
+
+    Renamed originals aren't processed again (see `expand_ctf_paths`), so
+    after a crash either the outputs are on disk or the original still has
+    its name. With 'each' the folders were flushed as each output was moved.
+    """
+
+    if setting('syncWrites', 'each') == 'batch':
+        for folder in sorted({os.path.dirname(path) for path in output_paths}):
+            fsync_dir(folder)
+
+
+def sync_batch_dirs(paths: list):
+    """Flush the folders a batch wrote to, if syncWrites is 'batch'
+
+    These are the folders of `paths` (the CTFs the batch renamed or wrote),
+    and the output parent folder and its sub-folders, where the outputs were
+    moved (already flushed before the originals were renamed, see
+    `sync_output_dirs`, but not since for CTFs that failed). Each is synced
+    once however many CTFs the batch (or, when watching an inbox, each poll)
+    wrote to it.
+    """
+
+    if setting('syncWrites', 'each') != 'batch':
+        return
+    folders = {os.path.dirname(os.path.abspath(path)) for path in paths}
+    parent_dir = output_parent_dir()
+    if os.path.isdir(parent_dir):
+        folders.add(parent_dir)
+        folders.update(entry.path for entry in os.scandir(parent_dir)
+                       if entry.is_dir())
+    for folder in sorted(folders):
+        fsync_dir(folder)
+
+
+def fsync_dir(path: str):
+    """Flush a folder's entries to disk, where the OS allows it (not Windows,
+    whose renames are written through anyway)"""
+    try:
+        dir_fd = os.open(path or '.', os.O_RDONLY)
+    except OSError:
+        return
     try:
+        os.fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(dir_fd)
+
+
+def output_parent_dir() -> str:
+    """The dir under which the output sub-folders are created"""
+    return config_parent_dir() or 'T:/CMIS/CTF Files/'
+
+
+def config_parent_dir() -> str:
+    return setting('destinationParentDir', '')
+
+
+def setting(name: str, default=None):
+    """A run-wide setting, from RUN_SETTINGS or else the config file"""
+    if name in RUN_SETTINGS:
+        return RUN_SETTINGS[name]
+    return load_config().get(name, default)
+
+
+def load_config() -> dict:
+    """The contents of CTF_parser_config.json, or {} if there isn't one
+
+    The file is read and checked (see `check_config`) once per process.
+    Raises:
+        ValueError: If the file isn't valid JSON or a setting is invalid
+    """
+
+    global CONFIG
+    if CONFIG is None:
         full_path = os.path.join(os.path.dirname(__file__),
                                  'CTF_parser_config.json')
-        with open(full_path) as config_file:
-            config = json.load(config_file)
-            return config['destinationParentDir']
-    except (FileNotFoundError, KeyError):
-        return ''
+        try:
+            with open(full_path) as config_file:
+                config = json.load(config_file)
+        except FileNotFoundError:
+            config = {}
+        except json.JSONDecodeError as error:
+            raise ValueError(f'{full_path} is not valid JSON: {error}')
+        check_config(config)
+        CONFIG = config
+    return CONFIG
+
 
+def check_config(config: dict):
+    """Check the config file gives only known settings, of the right types
 
-def get_output_dir(root: ET.Element, default_dir: str = 'CTF_In') -> str:
+    Raises:
+        ValueError: Listing every problem found
+    """
+
+    if not isinstance(config, dict):
+        raise ValueError('CTF_parser_config.json must hold a JSON object')
+    problems = []
+    for name, value in config.items():
+        if name not in CONFIG_SETTINGS:
+            problems.append(f'unknown setting "{name}"')
+            continue
+        types, allowed = CONFIG_SETTINGS[name]
+        if not isinstance(value, types) or (
+                isinstance(value, bool) and types is not bool):
+            problems.append(f'"{name}" has the wrong type')
+        elif allowed and value not in allowed:
+            problems.append(f'"{name}" must be one of ' + ', '.join(allowed))
+    if isinstance(config.get('runDate'), str) and not ISO_DATE.match(
+            config['runDate']):
+        problems.append('"runDate" must be a date, as YYYY-MM-DD')
+    disabled = config.get('disabledFixers', [])
+    if isinstance(disabled, list) and set(disabled) - set(FIXERS):
+        problems.append('unknown fixers in "disabledFixers": ' + ', '.join(
+            sorted(map(str, set(disabled) - set(FIXERS)))))
+    if problems:
+        raise ValueError('Invalid CTF_parser_config.json: ' +
+                         '; '.join(problems))
+
+
+def get_output_dir(root: ET.Element, default_dir: str = 'CTF_In',
+                   ctx: Optional[CTFContext] = None) -> str:
     """Finds the name of the appropriate folder to store the outputted CTF in
 
     If the first student with a specified year is in year 6, returns the
     new-cohort folder for this year, otherwise returns in-year folder: 'CTF_In'
     Falls back on calculating a student's year if all year tags are missing.
+    Facts already known about the CTF are taken from `ctx`, if given.
+    """
+
+    ctx = ctx or CTFContext(root)
+    return choose_output_dir(ctx.year_group, ctx.joining_mid_year, default_dir)
+
+
+def choose_output_dir(year_group: int,
+                      joining_mid_year,
+                      default_dir: str = 'CTF_In') -> str:
+    """Chooses the output folder for a CTF whose first pupil is in `year_group`
+
+    Args:
+        year_group: The (actual or calculated) year group of the first pupil
+        joining_mid_year: Callable returning whether the pupils are joining
+            this academic year. Only called for year 11s.
+        default_dir: The folder for CTFs that aren't for an incoming cohort
     """
 
-    year_group = root.find('.//NCyearActual')
-    year_group = ac_year(root) if year_group is None else int(year_group.text)
     if year_group == 6:
         return cohort_folder(7)
-    if year_group == 11 and not are_joining_mid_year(root):
+    if year_group == 11 and not joining_mid_year():
         return cohort_folder(12)
     return default_dir
 
 
-def ac_year(root_node: ET.Element) -> int:
+def ac_year(root_node: ET.Element, ctx: Optional[CTFContext] = None) -> int:
     """Returns the academic year of the first student under the passed node
 
     Raises:
@@ -298,49 +2819,79 @@ def ac_year(root_node: ET.Element) -> int:
             CTF if this is the case.
     """
 
-    dob_node = root_node.find('.//Pupil/DOB')
-    if dob_node is None:
+    ctx = ctx or CTFContext(root_node)
+    if ctx.first_dob is None:
         # returning 0 will mean the CTF is placed in the default output dir
         return 0
-    dob = date.fromisoformat(dob_node.text)
+    return academic_year_of(ctx.first_dob, ctx.creation_date)
+
+
+def pupil_year_group(pupil_node: ET.Element, doc: CTFContext) -> int:
+    """A pupil's year group, calculated from their DOB if need be
+
+    0 if they have neither an NCyearActual nor a DOB. The CTF's creation
+    date is only read to calculate it, so CTFs with year groups needn't
+    have one.
+    """
+
+    year_group = pupil_node.findtext('.//NCyearActual')
+    if year_group:
+        return int(year_group)
+    dob = pupil_node.findtext('DOB')
+    if not dob:
+        return 0
+    return doc.cohorts.year_group(dob, doc.creation_date)
+
+
+def academic_year_of(dob: date, ctf_date: date) -> int:
+    """The year group of a student born on `dob` when the CTF was created"""
     year_started_school = dob.year + (4 if dob.month < 9 else 5)
-    ctf_date = ctf_creation_date(root_node)
     ac_start_year = ctf_date.year - (1 if ctf_date.month < 9 else 0)
     return ac_start_year - year_started_school
 
 
-def are_joining_mid_year(root: ET.Element) -> bool:
+def are_joining_mid_year(root: ET.Element,
+                         ctx: Optional[CTFContext] = None) -> bool:
     """Return True if students are joining this academic year (not next year)
 
     This need only be called for year 11s - the only ambiguous case.
     """
 
-    # List the nodes where the source school appears in a pupil's school history
-    source_in_hists = source_school_appearances_in_history(root,
-                                                           get_source_school(root))
-    if len(source_in_hists) > 0:
-        leaving_date_node = source_in_hists[0].find('.//LeavingDate')
-        if leaving_date_node is not None:
-            leaving_date = leaving_date_node.text
-            # Assume next cohort if LeavingDates are after May & before Sep
-            if date.fromisoformat(leaving_date).month % 9 > 5:
-                return False
-            if len(source_in_hists) > 1:
-                # Assume mid-year if any students' LeavingDates differ
-                for source_in_hist in source_in_hists:
-                    this_l_d = source_in_hist.find('LeavingDate')
-                    if this_l_d is not None and this_l_d.text != leaving_date:
-                        return True
+    return (ctx or CTFContext(root)).joining_mid_year()
+
+
+def mid_year_from_leaving_dates(first_leaving_date: Optional[str],
+                                leaving_dates: list) -> bool:
+    """Decide whether students are joining mid-year from their leaving dates
+
+    Args:
+        first_leaving_date: The LeavingDate of the first appearance of the
+            source school in a student's school history (or None)
+        leaving_dates: The LeavingDate (or None) of every such appearance
+    """
+
+    if first_leaving_date is not None:
+        # Assume next cohort if LeavingDates are after May & before Sep
+        if date.fromisoformat(first_leaving_date).month % 9 > 5:
+            return False
+        if len(leaving_dates) > 1:
+            # Assume mid-year if any students' LeavingDates differ
+            for this_l_d in leaving_dates:
+                if this_l_d is not None and this_l_d != first_leaving_date:
+                    return True
     # Otherwise, ask
-    return yes_no_q("Are these students joining MID-YEAR?")
+    return yes_no_q(MID_YEAR_QUESTION)
 
 
 def source_school_appearances_in_history(root_node: ET.Element,
                                          source_name: str) -> list:
     """List source school appearances in students' school histories"""
-    return root_node.findall(
-        # use " over ' in Xpath predicate because some school names include '
-        f".//SchoolHistory/School/[SchoolName=\"{source_name}\"]")
+    if HISTORY_SCHOOLS_XPATH is not None and hasattr(root_node, 'xpath'):
+        return HISTORY_SCHOOLS_XPATH(root_node, name=source_name)
+    # A fixed path (which ElementTree compiles once) filtered here, rather than
+    # a predicate naming the school that would be compiled for every school
+    return [school for school in root_node.iterfind(HISTORY_SCHOOLS_PATH)
+            if school.findtext('SchoolName') == source_name]
 
 
 def cohort_folder(year_group: int) -> str:
@@ -352,19 +2903,34 @@ def cohort_folder(year_group: int) -> str:
         Fullpath (as String) of the directory conventionally containing CTFs for
         the incoming cohort of year 7s or 12s."""
 
-    return f'CTF_Year{year_group:02}_{escpd_next_ac_year()}'
+    return cohort_resolver().cohort_folder(year_group)
 
 
 def escpd_next_ac_year() -> str:
     """eg Aug '19 and Sep '19 give 2019_2020, but Oct '19 gives 2020_2021
 
     Desirable because occasionally we get CTFs in September for members of new
-    cohort who already started that month.
+    cohort who already started that month. The date is the run's (see
+    `cohort_resolver`).
+    """
+
+    return cohort_resolver().next_ac_year
+
+
+def cohort_resolver() -> CohortResolver:
+    """The run's `CohortResolver`
+
+    The run is taken to be on the date given by the runDate setting
+    (YYYY-MM-DD), if any, or else today. A new resolver is made if that date
+    changes, eg when a watch runs past midnight.
     """
 
-    d = date.today()
-    year = d.year
-    return f'{year}_{year + 1}' if d.month < 10 else f'{year + 1}_{year + 2}'
+    global COHORTS
+    run_date = setting('runDate')
+    today = date.fromisoformat(run_date) if run_date else date.today()
+    if COHORTS is None or COHORTS.today != today:
+        COHORTS = CohortResolver(today)
+    return COHORTS
 
 
 def get_source_school(root_node: ET.Element) -> str:
@@ -385,31 +2951,915 @@ def ctf_creation_date(root_node: ET.Element) -> date:
     return date.fromisoformat(datetime[0:datetime.find('T')])
 
 
-if __name__ == '__main__':
-    tk_root = Tk()
-    tk_root.withdraw()
-    ctf_s = filedialog.askopenfilenames(initialdir="..",
-                                        title="Select CTFs",
-                                        filetypes=(("xml files", "*.xml"),))
-    if len(ctf_s) == 0:
-        print("CTF parsing aborted")
+def expand_ctf_paths(patterns: list) -> list:
+    """List the CTFs named by a list of files, directories and glob patterns
+
+    Directories contribute the .xml files directly inside them, except the
+    originals renamed by a previous run. Duplicates are dropped.
+    """
+
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            matches = [path for path in glob.glob(os.path.join(pattern, '*.xml'))
+                       if '_original.' not in os.path.basename(path)]
+        else:
+            matches = glob.glob(pattern) or [pattern]
+        paths += sorted(path.replace(os.sep, '/') for path in matches)
+    return list(dict.fromkeys(paths))
+
+
+def validate_ctf(ctf_path: str, schema_path: Optional[str] = None) -> dict:
+    """Check a CTF without writing any output or renaming it: a dry run
+
+    Checks that the CTF is well-formed XML, is a full CTF, has a valid
+    creation date and that each pupil has a UPN, a valid DOB and a surname,
+    and that school history dates are valid. The enabled fixers are run on
+    the parsed tree to count the fixes processing would make.
+    Args:
+        ctf_path: The CTF to check
+        schema_path: If given, a local copy of the DfE's CTF XSD to validate
+            the CTF against too. Needs lxml.
+    Returns:
+        A report: a dict of `ctf_path`, `valid` (whether processing would
+        succeed), `errors` and `warnings` (lists of messages) and `fixes`
+        (fixer name to the number of fixes processing would make)
+    """
+
+    report = {'ctf_path': ctf_path, 'valid': False, 'errors': [],
+              'warnings': [], 'fixes': {}}
+    errors = report['errors']
+    try:
+        root_node = parse_xml(ctf_path).getroot()
+    except ET.ParseError as parse_error:
+        errors.append(f'Not well-formed XML: {parse_error}')
+        return report
+    except OSError as os_error:
+        errors.append(f"Can't be read: {os_error}")
+        return report
+
+    if schema_path:
+        if lxml_etree is None:
+            errors.append('Validating against an XSD needs lxml')
+        else:
+            try:
+                schema = load_schema(schema_path)
+            except (OSError, lxml_etree.Error) as schema_error:
+                schema = None
+                errors.append(f"The schema can't be loaded: {schema_error}")
+            if schema is not None and not schema.validate(lxml_etree.parse(
+                    ctf_path, lxml_etree.XMLParser(resolve_entities=False))):
+                errors += [f'Schema, line {error.line}: {error.message}'
+                           for error in schema.error_log]
+
+    doc_qual = root_node.findtext('.//DocumentQualifier')
+    if doc_qual == 'partial':
+        report['warnings'].append(
+            "DocumentQualifier is 'partial': contact data may be missing")
+    elif doc_qual != 'full':
+        errors.append('DocumentQualifier is missing' if doc_qual is None else
+                      f'DocumentQualifier is non-standard: {doc_qual}')
+    date_time = root_node.findtext('.//DateTime')
+    if date_time is None or 'T' not in date_time:
+        errors.append('Header DateTime is missing or has no time')
     else:
-        # Process each CTF, collecting a record of successes and failures
-        outcomes = list(map(process_ctf, ctf_s))
-        good_count = outcomes.count(True)
-        out_count = len(outcomes)
-        bad_count = out_count - good_count
-        if good_count == out_count:
-            print(f"All ({out_count}) files processed successfully")
+        check_date(date_time[0:date_time.find('T')], 'Header DateTime',
+                   errors)
+    for pupil in root_node.iter('Pupil'):
+        upn = pupil.findtext('UPN')
+        if not upn:
+            errors.append('A pupil has no UPN')
+            upn = 'UPN-missing'
+        dob = pupil.findtext('DOB')
+        if dob is None:
+            errors.append(f'Pupil {upn} has no DOB')
         else:
-            if good_count > 0:
-                print(
-                    f'{good_count} file{plural(good_count)} processed successfully.'
-                )
-                prep = ''
+            check_date(dob, f'Pupil {upn} DOB', errors)
+        for school in pupil.iterfind('.//SchoolHistory/School'):
+            for tag in ('EntryDate', 'LeavingDate'):
+                if school.findtext(tag) is not None:
+                    check_date(school.findtext(tag), f'Pupil {upn} {tag}',
+                               errors)
+
+    fixers = enabled_fixers()
+    doc = CTFContext(root_node, get_source_school(root_node))
+    report['fixes'] = dict.fromkeys((fixer.name for fixer in fixers), 0)
+    for _ in fix_elements(tree_events(root_node), fixers, doc,
+                          report['fixes']):
+        pass
+    try:
+        finish_fixers(fixers, doc)
+    except ValueError as err:
+        errors.append(str(err))
+    report['valid'] = not errors
+    return report
+
+
+def check_date(text: str, what: str, errors: list):
+    """Add an error to `errors` unless `text` is a valid YYYY-MM-DD date"""
+    try:
+        if ISO_DATE.match(text):
+            date.fromisoformat(text)
+            return
+    except ValueError:
+        pass
+    errors.append(f'{what} is not a valid date: {text}')
+
+
+@lru_cache(maxsize=4)
+def load_schema(schema_path: str):
+    """The lxml XMLSchema in a local XSD file, loaded once per process"""
+    return lxml_etree.XMLSchema(lxml_etree.parse(schema_path))
+
+
+def validate_ctf_quietly(ctf_path: str, schema_path: Optional[str],
+                         settings: dict) -> dict:
+    """`validate_ctf` with the given run settings, for worker processes"""
+    RUN_SETTINGS.update(settings)
+    use_backend(setting('xmlBackend', 'auto'))
+    return validate_ctf(ctf_path, schema_path)
+
+
+def validate_batch(ctf_paths: list, schema_path: Optional[str] = None,
+                   workers: Optional[int] = None) -> list:
+    """Check many CTFs in parallel worker processes, see `validate_ctf`
+
+    Args:
+        workers: The maximum number of worker processes (default: CPU count).
+            1 checks the files in this process.
+    Returns:
+        The report of each CTF, in order
+    """
+
+    if workers == 1:
+        use_backend(setting('xmlBackend', 'auto'))
+        return [validate_ctf(ctf_path, schema_path) for ctf_path in ctf_paths]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(
+            validate_ctf_quietly, ctf_paths, [schema_path] * len(ctf_paths),
+            [dict(RUN_SETTINGS)] * len(ctf_paths)))
+
+
+def print_validation_reports(reports: list):
+    """Summarise `validate_ctf` reports for the user"""
+    for report in reports:
+        print(os.path.basename(report['ctf_path']) + ':',
+              'valid' if report['valid'] else 'INVALID')
+        for error in report['errors']:
+            print('  Error:', error)
+        for warning in report['warnings']:
+            print('  Warning:', warning)
+        for name, count in report['fixes'].items():
+            if count > 0:
+                print('  Would fix:', FIXERS[name].report(count))
+    invalid = sum(not report['valid'] for report in reports)
+    print(f'{len(reports) - invalid} of {len(reports)} CTFs valid')
+
+
+def process_ctf_quietly(ctf_path: str, streaming: bool, answers: dict,
+                        settings: Optional[dict] = None) -> tuple:
+    """Process a CTF with preset answers, capturing what it prints
+
+    Used by the batch command line so the output of files processed in
+    parallel isn't interleaved.
+    Args:
+        settings: Run settings (see `RUN_SETTINGS`) to use for this CTF
+
+    Returns:
+        (success, printed output, stats) tuple. stats is None unless
+        instrumentation is enabled; see `STATS`.
+    Raises:
+        DecisionDeferred, with the printed output, if the decision policy
+        deferred a question
+    """
+
+    previous_answers = dict(PRESET_ANSWERS)
+    previous_settings = dict(RUN_SETTINGS)
+    PRESET_ANSWERS.update(answers)
+    RUN_SETTINGS.update(settings or {})
+    output = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(output):
+            success = process_ctf(ctf_path, streaming)
+    except DecisionDeferred as deferral:
+        raise DecisionDeferred(deferral.question, output.getvalue()) from None
+    finally:
+        PRESET_ANSWERS.clear()
+        PRESET_ANSWERS.update(previous_answers)
+        RUN_SETTINGS.clear()
+        RUN_SETTINGS.update(previous_settings)
+    return success is True, output.getvalue(), STATS
+
+
+def process_batch(ctf_paths: list, streaming: bool = False,
+                  answers: Optional[dict] = None,
+                  workers: Optional[int] = None,
+                  all_stats: Optional[list] = None,
+                  deferred: Optional[list] = None) -> list:
+    """Process many CTFs in parallel worker processes
+
+    Each file's messages are printed in one block as it finishes.
+    Args:
+        ctf_paths: The CTF files to process
+        streaming: Whether to use `process_ctf_streaming`
+        answers: Preset answers to yes_no_q questions, see `PRESET_ANSWERS`
+        workers: The maximum number of worker processes (default: CPU count).
+            1 processes the files in this process.
+        all_stats: If given, each file's stats are added to it (when
+            instrumentation is enabled)
+        deferred: If given, a (CTF path, question) tuple is added to it for
+            each file whose decision was deferred (see `defer_decision`).
+            Those files are left unprocessed and count as unsuccessful.
+    Returns:
+        List of Booleans indicating the success of each file, in order
+    """
+
+    answers = answers or {}
+    if all_stats is None:
+        all_stats = []
+    if deferred is None:
+        deferred = []
+    if workers == 1:
+        results = []
+        for ctf_path in ctf_paths:
+            try:
+                result = process_ctf_quietly(ctf_path, streaming, answers,
+                                             RUN_SETTINGS)
+            except DecisionDeferred as deferral:
+                result = defer_ctf(ctf_path, deferral, deferred)
+            except Exception as error:  # pylint: disable=broad-except
+                result = failed_ctf(ctf_path, error)
+            results.append(result)
+            print(result[1], end='')
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(process_ctf_quietly, ctf_path,
+                                       streaming, answers, RUN_SETTINGS):
+                       ctf_path for ctf_path in ctf_paths}
+            results = {}
+            for future in as_completed(futures):
+                try:
+                    results[future] = future.result()
+                except DecisionDeferred as deferral:
+                    results[future] = defer_ctf(futures[future], deferral,
+                                                deferred)
+                except Exception as error:  # pylint: disable=broad-except
+                    results[future] = failed_ctf(futures[future], error)
+                print(results[future][1], end='')
+            results = [results[future] for future in futures]
+    all_stats += [stats for _, _, stats in results if stats is not None]
+    return [success for success, _, _ in results]
+
+
+def defer_ctf(ctf_path: str, deferral: DecisionDeferred,
+              deferred: list) -> tuple:
+    """Add a CTF whose decision was deferred to `deferred`
+
+    Returns:
+        The CTF's (success, printed output, stats) tuple, as from
+        `process_ctf_quietly`
+    """
+
+    deferred.append((ctf_path, deferral.question))
+    return (False, deferral.output +
+            f'Left until the end of the batch: "{deferral.question}"\n\n',
+            None)
+
+
+def failed_ctf(ctf_path: str, error: Exception) -> tuple:
+    """The result of a CTF whose processing raised an unexpected error (or
+    whose worker process died), so the rest of the batch carries on
+
+    Returns:
+        A failed (success, printed output, stats) tuple, as from
+        `process_ctf_quietly`
+    """
+
+    return (False, f'ERROR processing {ctf_path}: '
+                   f'{type(error).__name__}: {error}\n\n', None)
+
+
+def settle_deferred(deferred: list, streaming: bool = False,
+                    answers: Optional[dict] = None,
+                    all_stats: Optional[list] = None) -> dict:
+    """Ask the questions deferred during a batch, then process those CTFs
+
+    All the outstanding questions are asked together, then the CTFs are
+    processed again with their answers. Should a CTF raise another question,
+    that is asked in the next round.
+    Args:
+        deferred: (CTF path, question) tuples, as collected by
+            `process_batch`
+        answers: The batch's preset answers to yes_no_q questions
+        all_stats: If given, each file's stats are added to it
+    Returns:
+        The success of each deferred CTF, keyed by its path
+    """
+
+    file_answers = {ctf_path: dict(answers or {}) for ctf_path, _ in deferred}
+    outcomes = {}
+    while deferred:
+        print(f'{len(deferred)} CTF{plural(len(deferred))} need a decision:')
+        for ctf_path, question in deferred:
+            file_answers[ctf_path][question] = ask_user(
+                f'{os.path.basename(ctf_path)}: {question}')
+        deferred, still_deferred = [], deferred
+        for ctf_path, _ in still_deferred:
+            try:
+                result = process_ctf_quietly(ctf_path, streaming,
+                                             file_answers[ctf_path],
+                                             RUN_SETTINGS)
+            except DecisionDeferred as deferral:
+                result = defer_ctf(ctf_path, deferral, deferred)
+            except Exception as error:  # pylint: disable=broad-except
+                result = failed_ctf(ctf_path, error)
+            print(result[1], end='')
+            outcomes[ctf_path] = result[0]
+            if all_stats is not None and result[2] is not None:
+                all_stats.append(result[2])
+    return outcomes
+
+
+def process_batch_async(ctf_paths: list, streaming: bool = False,
+                        answers: Optional[dict] = None,
+                        workers: Optional[int] = None,
+                        in_flight: Optional[int] = None,
+                        all_stats: Optional[list] = None,
+                        deferred: Optional[list] = None) -> list:
+    """Process many CTFs on a slow (eg network) share, overlapping the I/O
+
+    Like `process_batch`, but each CTF is copied to a local staging folder
+    before being fixed in a worker process, and its output is moved to the
+    share (and the original renamed) afterwards. Copying and moving happen
+    in threads, so the next CTFs are read and the last ones written while
+    others are being fixed. The result cache isn't used, as it would record
+    the staging paths.
+    Args:
+        in_flight: The most CTFs being read, fixed or written at once
+            (default: twice the number of workers)
+    Returns:
+        List of Booleans indicating the success of each file, in order
+    """
+
+    import asyncio
+
+    if all_stats is None:
+        all_stats = []
+    results = asyncio.run(pipeline_batch(
+        ctf_paths, streaming, answers or {}, workers,
+        in_flight or 2 * (workers or os.cpu_count() or 1),
+        [] if deferred is None else deferred))
+    all_stats += [stats for _, _, stats in results if stats is not None]
+    return [success for success, _, _ in results]
+
+
+async def pipeline_batch(ctf_paths: list, streaming: bool, answers: dict,
+                         workers: Optional[int], in_flight: int,
+                         deferred: list) -> list:
+    """Run each CTF through `process_batch_async`'s stages"""
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(in_flight)
+    parent_dir = output_parent_dir()
+    # Staged outputs needn't be synced: they are synced as they're published
+    settings = dict(RUN_SETTINGS, cacheDir='', manifestParentDir=parent_dir,
+                    syncWrites='off')
+
+    with tempfile.TemporaryDirectory() as staging, \
+            ProcessPoolExecutor(max_workers=workers) as executor:
+        async def pipeline_ctf(index: int, ctf_path: str) -> tuple:
+            async with slots:
+                work_dir = os.path.join(staging, str(index))
+                out_dir = os.path.join(work_dir, 'out')
+                try:
+                    local_path = await loop.run_in_executor(
+                        None, stage_ctf, ctf_path, work_dir)
+                    try:
+                        result = await loop.run_in_executor(
+                            executor, process_ctf_quietly, local_path,
+                            streaming, answers,
+                            dict(settings, destinationParentDir=out_dir,
+                                 auditSourceDir=os.path.dirname(ctf_path)))
+                    except DecisionDeferred as deferral:
+                        result = defer_ctf(ctf_path, deferral, deferred)
+                    await loop.run_in_executor(None, publish_ctf, ctf_path,
+                                               local_path, parent_dir,
+                                               result[0])
+                except Exception as error:  # pylint: disable=broad-except
+                    result = failed_ctf(ctf_path, error)
+                print(result[1], end='')
+                return result
+
+        return await asyncio.gather(*(pipeline_ctf(index, ctf_path)
+                                      for index, ctf_path
+                                      in enumerate(ctf_paths)))
+
+
+def stage_ctf(ctf_path: str, work_dir: str) -> str:
+    """Copy a CTF into `work_dir`/in, returning the copy's path"""
+    in_dir = os.path.join(work_dir, 'in')
+    os.makedirs(in_dir)
+    local_path = os.path.join(in_dir, os.path.basename(ctf_path))
+    shutil.copyfile(ctf_path, local_path)
+    return local_path.replace(os.sep, '/')
+
+
+def publish_ctf(ctf_path: str, local_path: str, parent_dir: str,
+                success: bool):
+    """Move a staged CTF's output to `parent_dir`, and rename the original
+
+    Each output is copied to a temporary file on the share and renamed into
+    place (see `atomic_output`). The original is renamed as its staged copy
+    was, if it was processed, and its pupils' paths in the pupil index are
+    changed to those on the share.
+    """
+
+    work_dir = os.path.dirname(os.path.dirname(local_path))
+    out_dir = os.path.join(work_dir, 'out')
+    output_paths = []
+    for dir_path, _, names in os.walk(out_dir):
+        target_dir = os.path.normpath(
+            os.path.join(parent_dir, os.path.relpath(dir_path, out_dir)))
+        for name in names:
+            make_dirs(target_dir)
+            if name == MANIFEST_NAME:
+                publish_manifest(os.path.join(dir_path, name), target_dir,
+                                 out_dir, parent_dir)
             else:
-                prep = 'all ' if out_count > 1 else 'the '
+                staged_path = os.path.join(dir_path, name)
+                with open(staged_path, 'rb') as staged, \
+                        atomic_output(os.path.join(target_dir,
+                                                   name)) as out_file:
+                    shutil.copyfileobj(staged, out_file)
+                    out_file.flush()
+                    # As the manifest recorded it
+                    shutil.copystat(staged_path, out_file.name)
+                os.remove(staged_path)
+                output_paths.append(os.path.join(target_dir, name))
+    if success:
+        sync_output_dirs(output_paths)
+        [renamed] = os.listdir(os.path.join(work_dir, 'in'))
+        os.rename(ctf_path, os.path.join(os.path.dirname(ctf_path), renamed))
+        sync_dir(os.path.dirname(ctf_path))
+    if success and setting('pupilIndex'):
+        db = open_pupil_index(setting('pupilIndex'))
+        with contextlib.closing(db), db:
+            db.execute('UPDATE OR REPLACE pupils SET ctf_path = ?, '
+                       'output_path = ? || substr(output_path, ?) '
+                       'WHERE ctf_path = ?',
+                       (ctf_path, parent_dir, len(out_dir) + 1, local_path))
+
+
+def publish_manifest(staged_path: str, target_dir: str, out_dir: str,
+                     parent_dir: str):
+    """Append a staged manifest's entries to the manifest on the share"""
+    with open(staged_path) as staged, \
+            open(os.path.join(target_dir, MANIFEST_NAME), 'a') as manifest:
+        for line in staged:
+            entry = json.loads(line)
+            for output in [entry] + entry.get('outputs', []):
+                output['output_path'] = os.path.join(
+                    parent_dir, os.path.relpath(output['output_path'],
+                                                out_dir))
+            manifest.write(json.dumps(entry) + '\n')
+
+
+def watch_folder(inbox: str, streaming: bool = False,
+                 answers: Optional[dict] = None,
+                 workers: Optional[int] = None,
+                 poll_interval: float = 5.0,
+                 stop: Optional[Callable[[], bool]] = None):
+    """Process CTFs as they arrive in the inbox folder, until stopped
+
+    The inbox is polled every `poll_interval` seconds. A CTF is only
+    processed once its size and modification time are unchanged between two
+    polls, so files that are still being written are left alone. At most
+    twice as many files as there are workers are queued at once; the rest
+    wait for a later poll. Every file processed is noted in a record file in
+    the inbox, so a restarted watch doesn't reprocess files that failed
+    (unless they have since changed).
+
+    Args:
+        inbox: The directory to watch
+        streaming: Whether to use `process_ctf_streaming`
+        answers: Preset answers to yes_no_q questions, see `PRESET_ANSWERS`
+        workers: The maximum number of worker processes (default: CPU count)
+        poll_interval: Seconds between polls of the inbox
+        stop: Called before each poll; the watch ends when it returns True.
+            By default the watch runs until interrupted.
+    """
+
+    record = load_watch_record(inbox)
+    last_seen = {}
+    in_flight = {}
+    max_in_flight = 2 * (workers or os.cpu_count() or 1)
+    print('Watching', inbox, 'for CTFs. Press Ctrl+C to stop.')
+    executor = ProcessPoolExecutor(max_workers=workers)
+
+    def submit(name: str):
+        return executor.submit(process_ctf_quietly, os.path.join(inbox, name),
+                               streaming, answers or {}, RUN_SETTINGS)
+
+    try:
+        try:
+            while stop is None or not stop():
+                finished = []
+                for future in [f for f in in_flight if f.done()]:
+                    name, stamp = in_flight.pop(future)
+                    success, output, _ = watched_result(future, inbox, name)
+                    print(output, end='')
+                    record[name] = stamp + [success]
+                    save_watch_record(inbox, record)
+                    finished.append(os.path.join(inbox, name))
+                if finished:
+                    sync_batch_dirs(finished)
+                    evict_batch_cache()
+
+                queued = {name for name, _ in in_flight.values()}
+                for name, stamp in settled_ctfs(inbox, last_seen, record):
+                    if len(in_flight) >= max_in_flight:
+                        break
+                    if name not in queued:
+                        try:
+                            future = submit(name)
+                        except BrokenProcessPool:
+                            # A worker died (eg out of memory), failing the
+                            # CTFs it had; carry on with new workers
+                            executor.shutdown(wait=False)
+                            executor = ProcessPoolExecutor(max_workers=workers)
+                            future = submit(name)
+                        in_flight[future] = (name, stamp)
+                time.sleep(poll_interval)
+        except KeyboardInterrupt:
+            print('Stopping. Waiting for queued CTFs to finish...')
+        for future, (name, stamp) in in_flight.items():
+            success, output, _ = watched_result(future, inbox, name)
+            print(output, end='')
+            record[name] = stamp + [success]
+        save_watch_record(inbox, record)
+        if in_flight:
+            sync_batch_dirs([os.path.join(inbox, name)
+                             for name, _ in in_flight.values()])
+            evict_batch_cache()
+    finally:
+        executor.shutdown()
+
+
+def watched_result(future, inbox: str, name: str) -> tuple:
+    """The result of processing a watched CTF, failed if processing raised
+    an unexpected error (see `failed_ctf`) so that the watch carries on"""
+    try:
+        return future.result()
+    except Exception as error:  # pylint: disable=broad-except
+        return failed_ctf(os.path.join(inbox, name), error)
+
+
+def settled_ctfs(inbox: str, last_seen: dict, record: dict) -> list:
+    """List the CTFs in the inbox that are ready to be processed
+
+    Args:
+        inbox: The directory being watched
+        last_seen: CTF name to its [size, mtime] at the previous poll.
+            Updated in place.
+        record: CTF name to [size, mtime, success] of processed CTFs
+    Returns:
+        (name, [size, mtime]) of each CTF not already processed whose size
+        and modification time haven't changed since the previous poll
+    """
+
+    settled = []
+    seen = {}
+    for path in expand_ctf_paths([inbox]):
+        name = os.path.basename(path)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        stamp = [stat.st_size, stat.st_mtime_ns]
+        seen[name] = stamp
+        if last_seen.get(name) == stamp and record.get(name, [])[:2] != stamp:
+            settled.append((name, stamp))
+    last_seen.clear()
+    last_seen.update(seen)
+    return settled
+
+
+def load_watch_record(inbox: str) -> dict:
+    try:
+        with open(os.path.join(inbox, WATCH_RECORD_NAME)) as record_file:
+            return json.load(record_file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def save_watch_record(inbox: str, record: dict):
+    """Save the record of processed CTFs, replacing the old one atomically"""
+    record_path = os.path.join(inbox, WATCH_RECORD_NAME)
+    with open(record_path + '.tmp', 'w') as record_file:
+        json.dump(record, record_file, indent=1)
+    os.replace(record_path + '.tmp', record_path)
+
+
+def print_summary(outcomes: list):
+    """Tell the user how many files were processed successfully"""
+    good_count = outcomes.count(True)
+    out_count = len(outcomes)
+    bad_count = out_count - good_count
+    if good_count == out_count:
+        print(f"All ({out_count}) files processed successfully")
+    else:
+        if good_count > 0:
             print(
-                f'Parsing FAILED for {prep}{bad_count} file{plural(bad_count)}.'
+                f'{good_count} file{plural(good_count)} processed successfully.'
             )
-    input('Press Enter to Exit... ')
+            prep = ''
+        else:
+            prep = 'all ' if out_count > 1 else 'the '
+        print(
+            f'Parsing FAILED for {prep}{bad_count} file{plural(bad_count)}.'
+        )
+
+
+def parse_args(argv: Optional[list] = None) -> argparse.Namespace:
+    arg_parser = argparse.ArgumentParser(
+        description='Fix formatting in Common Transfer Files. With no CTFs '
+                    'given, a dialog is opened to choose them.')
+    arg_parser.add_argument('ctfs', nargs='*', metavar='CTF',
+                            help='CTF files, directories of CTFs or globs')
+    arg_parser.add_argument('-w', '--workers', type=int, default=None,
+                            help='number of worker processes '
+                                 '(default: number of CPUs)')
+    arg_parser.add_argument('--async-io', action='store_true',
+                            help='copy CTFs to a local folder to fix them, '
+                                 'reading and writing the next and last ones '
+                                 'meanwhile; faster for network shares')
+    arg_parser.add_argument('--in-flight', type=int, default=None,
+                            help='with --async-io, the most CTFs being read, '
+                                 'fixed or written at once (default: twice '
+                                 'the number of workers)')
+    arg_parser.add_argument('--watch', metavar='INBOX',
+                            help='keep processing CTFs as they arrive in the '
+                                 'INBOX directory')
+    arg_parser.add_argument('--poll-interval', type=float, default=5.0,
+                            help='seconds between checks of the watched '
+                                 'inbox (default: 5)')
+    arg_parser.add_argument('--cache', metavar='DIR',
+                            help='reuse the output of CTFs identical to ones '
+                                 'processed before, caching results in DIR')
+    arg_parser.add_argument('--on-duplicate', choices=('link', 'skip'),
+                            help='link the earlier output to the new output '
+                                 'path, or skip writing it (default: link)')
+    arg_parser.add_argument('--validate', action='store_true',
+                            help='check the CTFs and report what processing '
+                                 'would fix and what would fail, without '
+                                 'writing or renaming anything')
+    arg_parser.add_argument('--schema', metavar='XSD',
+                            help='with --validate, also validate the CTFs '
+                                 'against this copy of the CTF schema (needs '
+                                 'lxml)')
+    arg_parser.add_argument('--report', metavar='FILE',
+                            help='with --validate, save the reports to FILE '
+                                 "as JSON ('-' for stdout)")
+    arg_parser.add_argument('--manifest', action='store_true',
+                            help='record each CTF processed in a manifest in '
+                                 'its output folder, and skip CTFs whose '
+                                 'output there is up to date')
+    arg_parser.add_argument('--clear-cache', action='store_true',
+                            help='empty the result cache first, eg after '
+                                 'changing which fixers are enabled')
+    arg_parser.add_argument('--stats', metavar='FILE',
+                            help='record the time spent in each stage and '
+                                 'the fixes made, as a line of JSON per CTF '
+                                 'appended to FILE, and summarise them')
+    arg_parser.add_argument('--audit', metavar='DIR',
+                            help='list every change made to each CTF (the '
+                                 "pupil's UPN, where, the old and new "
+                                 'values) in a CSV file in DIR, and all the '
+                                 "batch's changes in another")
+    arg_parser.add_argument('--pupil-index', metavar='DB',
+                            help="record every pupil's UPN, surnames, DOB, "
+                                 'year group and school in the SQLite file '
+                                 'DB, and report duplicates across all the '
+                                 'CTFs recorded there')
+    arg_parser.add_argument('--index-report', metavar='DB',
+                            help='report the duplicates in a pupil index, '
+                                 'then exit')
+    arg_parser.add_argument('--profile', metavar='NAME',
+                            help='profile the CTF with this file name using '
+                                 'cProfile')
+    arg_parser.add_argument('--trace-memory', metavar='NAME',
+                            help='trace the memory allocated processing the '
+                                 'CTF with this file name')
+    arg_parser.add_argument('--backend', choices=('auto', 'lxml', 'etree'),
+                            help='XML library to use (default: auto, ie lxml '
+                                 'if it is installed)')
+    arg_parser.add_argument('--streaming', action='store_true',
+                            help='fix each CTF in a single streaming pass')
+    arg_parser.add_argument('--shard-workers', type=int, metavar='N',
+                            help='fix the pupils of CTFs over 8 MB in '
+                                 'parallel, in shards, in N worker processes '
+                                 'per CTF')
+    arg_parser.add_argument('--sync', choices=('each', 'batch', 'off'),
+                            help='flush each output to disk before moving it '
+                                 'into place, then its folder (each, the '
+                                 'default); flush the folders once at the '
+                                 'end of the batch (batch); or neither (off)')
+    arg_parser.add_argument('--memory-limit', type=float, metavar='MB',
+                            help='stream CTFs too big to parse whole within '
+                                 'this much memory')
+    arg_parser.add_argument('--run-date', metavar='YYYY-MM-DD',
+                            help='take the run to be on this date when '
+                                 "naming the next cohort's folders")
+    arg_parser.add_argument('--split', action='store_true',
+                            help='file each pupil in the folder for their '
+                                 'own year group, splitting CTFs with pupils '
+                                 'bound for several folders')
+    arg_parser.add_argument('--merge', metavar='FOLDER', nargs='+',
+                            help='merge the CTFs in each FOLDER into one CTF '
+                                 'to import, saved in a CTF_Merged folder '
+                                 'beside it, then exit')
+    arg_parser.add_argument('--patch', action='store_true',
+                            help="copy each CTF, changing only what's fixed, "
+                                 'rather than rewriting it (not with '
+                                 '--streaming)')
+    arg_parser.add_argument('--abort-on-partial', choices=ANSWER_CHOICES,
+                            help=f'answer to "{ABORT_QUESTION}" for '
+                                 'incomplete CTFs (default: no); ask defers '
+                                 'it to the end of the batch')
+    arg_parser.add_argument('--mid-year', choices=ANSWER_CHOICES,
+                            help=f'answer to "{MID_YEAR_QUESTION}" when it '
+                                 "can't be inferred (default: no); ask "
+                                 'defers it to the end of the batch')
+    args = arg_parser.parse_args(argv)
+    if args.validate and not args.ctfs:
+        arg_parser.error('--validate needs the CTFs to check')
+    return args
+
+
+def preset_answers(args: argparse.Namespace,
+                   default: Optional[str] = None) -> dict:
+    """Answers to yes_no_q questions from the command line or config file
+
+    Args:
+        args: The parsed command line
+        default: The answer to questions given neither place
+    Returns:
+        Question to Boolean answer, for use as `PRESET_ANSWERS`. Questions
+        answered 'ask' are left out, to be decided by the decision policy.
+    """
+
+    answers = {}
+    for question, given, name in (
+            (ABORT_QUESTION, args.abort_on_partial, 'abortOnPartial'),
+            (MID_YEAR_QUESTION, args.mid_year, 'midYear')):
+        answer = given or setting(name) or default
+        if answer in ('yes', 'no'):
+            answers[question] = answer == 'yes'
+    return answers
+
+
+def choose_ctfs() -> tuple:
+    """Ask the user to choose CTFs in a file dialog
+
+    tkinter is imported here, not with the other modules, so that batch runs
+    and worker processes start quicker and work where Tk isn't installed.
+    """
+
+    from tkinter import Tk, filedialog
+
+    tk_root = Tk()
+    tk_root.withdraw()
+    return filedialog.askopenfilenames(initialdir="..", title="Select CTFs",
+                                       filetypes=(("xml files", "*.xml"),))
+
+
+def main(argv: Optional[list] = None):
+    """Process the CTFs named on the command line, or chosen in a dialog
+
+    CTFs named on the command line, or arriving in a watched inbox, are
+    processed in parallel without asking any questions: the answers are taken
+    from the command line options or the config file. Questions answered
+    'ask' are deferred until the end of a batch (see `settle_deferred`), and
+    answered no in a watch.
+    """
+
+    args = parse_args(argv)
+    try:
+        load_config()
+    except ValueError as error:
+        print(error)
+        if not (args.ctfs or args.watch or args.merge or args.index_report):
+            input('Press Enter to Exit... ')
+        return
+    if args.merge:
+        merge_folders(args.merge)
+        return
+    if args.index_report:
+        print_pupil_index_report(args.index_report)
+        return
+    if args.pupil_index:
+        RUN_SETTINGS['pupilIndex'] = args.pupil_index
+    if args.split:
+        RUN_SETTINGS['splitByCohort'] = True
+    if args.manifest:
+        RUN_SETTINGS['manifest'] = True
+    if args.memory_limit:
+        RUN_SETTINGS['memoryLimitMB'] = args.memory_limit
+    if args.shard_workers:
+        RUN_SETTINGS['shardWorkers'] = args.shard_workers
+    if args.sync:
+        RUN_SETTINGS['syncWrites'] = args.sync
+    if args.run_date:
+        RUN_SETTINGS['runDate'] = args.run_date
+    if args.cache:
+        RUN_SETTINGS['cacheDir'] = args.cache
+    if args.on_duplicate:
+        RUN_SETTINGS['onDuplicate'] = args.on_duplicate
+    if args.backend:
+        RUN_SETTINGS['xmlBackend'] = args.backend
+    if args.patch:
+        RUN_SETTINGS['outputMode'] = 'patch'
+    if args.stats:
+        RUN_SETTINGS['statsLog'] = args.stats
+    if args.audit:
+        RUN_SETTINGS['auditDir'] = args.audit
+    if args.profile:
+        RUN_SETTINGS['profileCTF'] = args.profile
+    if args.trace_memory:
+        RUN_SETTINGS['traceMemoryCTF'] = args.trace_memory
+    if args.clear_cache and setting('cacheDir'):
+        if os.path.isdir(setting('cacheDir')):
+            clear_cache(setting('cacheDir'))
+    if args.watch:
+        RUN_SETTINGS['decisions'] = 'preset'
+        answers = preset_answers(args, 'no')
+        watch_folder(args.watch, args.streaming, answers, args.workers,
+                     args.poll_interval)
+        return
+
+    if not args.ctfs:
+        PRESET_ANSWERS.update(preset_answers(args))
+        ctf_s = choose_ctfs()
+        if len(ctf_s) == 0:
+            print("CTF parsing aborted")
+        else:
+            # Process each CTF, collecting a record of successes and failures
+            outcomes, all_stats = [], []
+            audit_stamps = audit_log_stamps(ctf_s)
+            for ctf in ctf_s:
+                outcomes.append(process_ctf(ctf, args.streaming))
+                if STATS is not None:
+                    all_stats.append(STATS)
+            sync_batch_dirs(ctf_s)
+            evict_batch_cache()
+            print_summary(outcomes)
+            print_stats_report(all_stats)
+            write_batch_audit(ctf_s, audit_stamps)
+            if setting('pupilIndex'):
+                print_pupil_index_report(setting('pupilIndex'))
+        input('Press Enter to Exit... ')
+        return
+
+    ctf_s = expand_ctf_paths(args.ctfs)
+    if len(ctf_s) == 0:
+        print("No CTFs found")
+        return
+    if args.validate:
+        reports = validate_batch(ctf_s, args.schema, args.workers)
+        if args.report == '-':
+            json.dump(reports, sys.stdout, indent=1)
+            return
+        print_validation_reports(reports)
+        if args.report:
+            with open(args.report, 'w') as report_file:
+                json.dump(reports, report_file, indent=1)
+        return
+    RUN_SETTINGS['decisions'] = 'defer'
+    answers = preset_answers(args, 'no')
+    all_stats, deferred = [], []
+    audit_stamps = audit_log_stamps(ctf_s)
+    if args.async_io:
+        outcomes = process_batch_async(ctf_s, args.streaming, answers,
+                                       args.workers, args.in_flight, all_stats,
+                                       deferred)
+    else:
+        outcomes = process_batch(ctf_s, args.streaming, answers, args.workers,
+                                 all_stats, deferred)
+    if deferred:
+        settled = settle_deferred(deferred, args.streaming, answers, all_stats)
+        outcomes = [settled.get(ctf_path, outcome)
+                    for ctf_path, outcome in zip(ctf_s, outcomes)]
+    sync_batch_dirs(ctf_s)
+    evict_batch_cache()
+    print_summary(outcomes)
+    print_stats_report(all_stats)
+    write_batch_audit(ctf_s, audit_stamps)
+    if setting('pupilIndex'):
+        print_pupil_index_report(setting('pupilIndex'))
+
+
+use_backend()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+import os
+from test_setup import pytest, parser, MockerFixture
+
+BACKENDS = [name for name, module in parser.XML_BACKENDS.items() if module]
+
+# The sample CTFs
+CTF_DIR = os.path.join(os.path.dirname(__file__), 'CTFs')
+
+
+@pytest.fixture(autouse=True, params=BACKENDS)
+def xml_backend(request):
+    """Run every test with each installed XML backend"""
+    previous = 'lxml' if parser.ET is parser.lxml_etree else 'etree'
+    parser.use_backend(request.param)
+    parser.RUN_SETTINGS['xmlBackend'] = request.param
+    yield request.param
+    parser.RUN_SETTINGS.pop('xmlBackend', None)
+    parser.use_backend(previous)
+
+
+@pytest.fixture
+def out_dir(mocker: MockerFixture, tmp_path) -> str:
+    """Output to tmp_path/out, made afresh, answering no to any question"""
+    out_dir = str(tmp_path / 'out')
+    mocker.patch.dict(parser.RUN_SETTINGS, {'destinationParentDir': out_dir})
+    mocker.patch.object(parser, 'MADE_DIRS', set())
+    mocker.patch('parse_CTFs.yes_no_q', return_value=False)
+    return out_dir
+
+
+def copy_ctf(tmp_path, name: str = 'y7_2_students.xml', edit=None) -> str:
+    """Copy a sample CTF to tmp_path/in, edited by `edit` if given"""
+    (tmp_path / 'in').mkdir(parents=True, exist_ok=True)
+    with open(os.path.join(CTF_DIR, name)) as ctf_file:
+        text = ctf_file.read()
+    path = tmp_path / 'in' / name
+    path.write_text(edit(text) if edit else text)
+    return str(path)
@@ -0,0 +1,59 @@
+import re
+import os
+import shutil
+from test_setup import parser, pytest, mocker, MockerFixture
+from test.conftest import CTF_DIR
+
+
+def test_pipeline_writes_outputs_to_share(mocker: MockerFixture, tmp_path):
+    share = tmp_path / 'share'
+    shutil.copytree(CTF_DIR, share / 'in')
+    mocker.patch.dict(parser.RUN_SETTINGS,
+                      {'destinationParentDir': str(share / 'out')})
+    ctf_paths = parser.expand_ctf_paths([str(share / 'in')])
+    partial = ctf_paths.index(f'{share}/in/y7_partial.xml')
+    outcomes = parser.process_batch_async(
+        ctf_paths, answers={parser.ABORT_QUESTION: True,
+                            parser.MID_YEAR_QUESTION: False},
+        workers=2, in_flight=2)
+    assert outcomes == [index != partial for index in range(len(ctf_paths))]
+    assert len(list((share / 'out').rglob('*.xml'))) == len(ctf_paths) - 1
+    renamed = sorted(os.listdir(share / 'in'))
+    assert 'y7_partial.xml' in renamed
+    assert len([name for name in renamed if '_original.' in name]) == \
+        len(ctf_paths) - 1
+
+
+def test_unexpected_error_fails_only_its_ctf(mocker: MockerFixture, tmp_path,
+                                             capsys):
+    share = tmp_path / 'share'
+    (share / 'in').mkdir(parents=True)
+    shutil.copy(os.path.join(CTF_DIR, 'y12.xml'), share / 'in')
+    # No creation date or year groups, so processing raises
+    text = open(os.path.join(CTF_DIR, 'y7_2_students.xml')).read()
+    undatable = share / 'in' / 'undatable.xml'
+    undatable.write_text(
+        re.sub(r'<(DateTime|NCyearActual)>.*?</\1>\n', '', text))
+    mocker.patch.dict(parser.RUN_SETTINGS,
+                      {'destinationParentDir': str(share / 'out')})
+    outcomes = parser.process_batch_async(
+        [str(undatable), str(share / 'in' / 'y12.xml'),
+         str(share / 'in' / 'missing.xml')],
+        answers={parser.MID_YEAR_QUESTION: True}, workers=1)
+    assert [False, True, False] == outcomes
+    printed = capsys.readouterr().out
+    assert f'ERROR processing {undatable}: AttributeError' in printed
+    assert 'ERROR processing ' + str(share / 'in' / 'missing.xml') + \
+        ': FileNotFoundError' in printed
+    assert 1 == len(list((share / 'out').rglob('*.xml')))
+    assert 'undatable.xml' in os.listdir(share / 'in')
+
+
+def test_output_dirs_made_once(mocker: MockerFixture, tmp_path):
+    makedirs = mocker.patch('os.makedirs')
+    mocker.patch.object(parser, 'MADE_DIRS', set())
+    mocker.patch('parse_CTFs.config_parent_dir', return_value=str(tmp_path))
+    for name in ('a.xml', 'b.xml'):
+        parser.output_path_for(name, 'school', 'CTF_In')
+    makedirs.assert_called_once_with(os.path.join(str(tmp_path), 'CTF_In'),
+                                     exist_ok=True)
@@ -0,0 +1,137 @@
+import os
+from test_setup import pytest, parser, mocker, MockerFixture
+from test.conftest import CTF_DIR, copy_ctf
+
+
+def files_in(folder: str) -> list:
+    return sorted(os.path.relpath(os.path.join(path, name), folder)
+                  for path, _, names in os.walk(folder) for name in names)
+
+
+@pytest.mark.parametrize('settings, streaming', [
+    ({}, False), ({}, True), ({'outputMode': 'patch'}, False),
+    ({'splitByCohort': True}, False), ({'shardWorkers': 2}, False)])
+def test_failed_write_leaves_nothing_behind(
+        mocker: MockerFixture, tmp_path, out_dir: str, settings: dict,
+        streaming: bool):
+    mocker.patch.dict(parser.RUN_SETTINGS, settings)
+    mocker.patch.object(parser, 'SHARD_BYTES', 200)
+    mocker.patch('parse_CTFs.sync_file',
+                 side_effect=OSError(28, 'No space left on device'))
+    ctf_path = copy_ctf(tmp_path)
+    with pytest.raises(OSError):
+        parser.process_ctf(ctf_path, streaming)
+    assert [] == files_in(out_dir)
+    assert ['y7_2_students.xml'] == files_in(str(tmp_path / 'in'))
+
+
+def test_failed_write_keeps_previous_output(tmp_path):
+    output_path = str(tmp_path / 'output.xml')
+    with open(output_path, 'w') as output:
+        output.write('<CTfile/>')
+    with pytest.raises(ValueError):
+        with parser.atomic_output(output_path) as out_file:
+            out_file.write(b'<CTfile>')
+            raise ValueError('Not a CTF')
+    assert ['output.xml'] == files_in(str(tmp_path))
+    assert '<CTfile/>' == open(output_path).read()
+
+
+@pytest.mark.parametrize('streaming', [False, True])
+def test_output_synced_before_original_renamed(
+        mocker: MockerFixture, tmp_path, out_dir: str, streaming: bool):
+    events = []
+    mocker.patch('parse_CTFs.fsync_dir', side_effect=lambda path:
+                 events.append(('sync folder', os.path.normpath(path))))
+    mocker.patch.object(os, 'fsync',
+                        side_effect=lambda fd: events.append('sync file'))
+    replace, rename = os.replace, os.rename
+    mocker.patch.object(os, 'replace', side_effect=lambda src, dst: (
+        events.append(('move', dst)), replace(src, dst)))
+    mocker.patch.object(os, 'rename', side_effect=lambda src, dst: (
+        events.append('rename original'), rename(src, dst)))
+    ctf_path = copy_ctf(tmp_path)
+    assert parser.process_ctf(ctf_path, streaming)
+    [output] = files_in(out_dir)
+    output_path = os.path.join(out_dir, output)
+    assert [('move', output_path),
+            ('sync folder', os.path.dirname(output_path)), 'rename original',
+            ('sync folder', os.path.dirname(ctf_path))] == events[-4:]
+    assert events.index('sync file') < events.index(('move', output_path))
+
+
+
+@pytest.mark.parametrize('settings, streaming', [
+    ({}, False), ({}, True), ({'splitByCohort': True}, False),
+    ({'shardWorkers': 2}, False)])
+def test_outputs_readable_as_new_files_are(
+        mocker: MockerFixture, tmp_path, out_dir: str, settings: dict,
+        streaming: bool):
+    mocker.patch.dict(parser.RUN_SETTINGS, settings)
+    mocker.patch.object(parser, 'SHARD_BYTES', 200)
+    mocker.patch.object(parser, 'UMASK', 0o027)
+    assert parser.process_ctf(copy_ctf(tmp_path), streaming)
+    [output] = files_in(out_dir)
+    assert 0o640 == os.stat(os.path.join(out_dir, output)).st_mode & 0o777
+
+
+def test_replaced_output_keeps_its_mode(tmp_path):
+    output_path = str(tmp_path / 'output.xml')
+    with open(output_path, 'w') as output:
+        output.write('<CTfile/>')
+    os.chmod(output_path, 0o664)
+    with parser.atomic_output(output_path) as out_file:
+        out_file.write(b'<CTfile></CTfile>')
+    assert 0o664 == os.stat(output_path).st_mode & 0o777
+
+def test_batch_syncs_each_folder_once(mocker: MockerFixture, tmp_path,
+                                      out_dir: str):
+    mocker.patch.dict(parser.RUN_SETTINGS, {'syncWrites': 'batch'})
+    events = []
+    fsync_dir = mocker.patch('parse_CTFs.fsync_dir', side_effect=lambda path:
+                             events.append(('sync folder',
+                                            os.path.normpath(path))))
+    rename = os.rename
+    mocker.patch.object(os, 'rename', side_effect=lambda src, dst: (
+        events.append(('rename', src)), rename(src, dst)))
+    fsync = mocker.spy(os, 'fsync')
+    ctf_paths = [copy_ctf(tmp_path, name) for name in sorted(
+        os.listdir(CTF_DIR))]
+    assert [True] * 4 == parser.process_batch(ctf_paths, workers=1)
+    assert 4 == fsync.call_count
+    # Each output's folder is flushed before its original is renamed, but
+    # the inbox only at the end
+    for ctf_path in ctf_paths:
+        action, folder = events[events.index(('rename', ctf_path)) - 1]
+        assert 'sync folder' == action
+        assert os.path.dirname(folder) == out_dir
+    assert ('sync folder', str(tmp_path / 'in')) not in events
+
+    fsync_dir.reset_mock()
+    parser.sync_batch_dirs(ctf_paths)
+    out_folders = [os.path.join(out_dir, folder)
+                   for folder in os.listdir(out_dir)]
+    assert sorted([str(tmp_path / 'in'), out_dir] + out_folders) == \
+        [call.args[0] for call in fsync_dir.call_args_list]
+
+
+def test_no_syncing_when_off(mocker: MockerFixture, tmp_path, out_dir: str):
+    mocker.patch.dict(parser.RUN_SETTINGS, {'syncWrites': 'off'})
+    fsync_dir = mocker.patch('parse_CTFs.fsync_dir')
+    fsync = mocker.spy(os, 'fsync')
+    assert parser.process_ctf(copy_ctf(tmp_path))
+    parser.sync_batch_dirs([])
+    fsync.assert_not_called()
+    fsync_dir.assert_not_called()
+    assert 1 == len(files_in(out_dir))
+
+
+def test_sync_option(mocker: MockerFixture, tmp_path):
+    mocker.patch.dict(parser.RUN_SETTINGS)
+    mocker.patch('parse_CTFs.config_parent_dir',
+                 return_value=str(tmp_path / 'out'))
+    sync_batch_dirs = mocker.patch('parse_CTFs.sync_batch_dirs')
+    ctf_path = copy_ctf(tmp_path)
+    parser.main([ctf_path, '--workers', '1', '--sync', 'batch'])
+    assert 'batch' == parser.RUN_SETTINGS['syncWrites']
+    sync_batch_dirs.assert_called_once_with([ctf_path])
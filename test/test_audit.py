@@ -0,0 +1,130 @@
+import csv
+import os
+import shutil
+from test_setup import pytest, parser, mocker, MockerFixture
+from test.conftest import CTF_DIR
+
+CTF = ('<CTfile><Header><DocumentQualifier>full</DocumentQualifier>'
+       '<SourceSchool><SchoolName>Oak Primary</SchoolName></SourceSchool>'
+       '</Header><CTFpupilData><Pupil><UPN>A1</UPN><Surname>SMITH</Surname>'
+       '<BasicDetails/><Phones><Phone><PhoneNo>01935 812345</PhoneNo>'
+       '</Phone><Phone><PhoneNo>01935812345</PhoneNo></Phone></Phones>'
+       '<SchoolHistory><School><SchoolName>Oak Primary</SchoolName>'
+       '<LeavingDate/></School></SchoolHistory></Pupil></CTFpupilData>'
+       '</CTfile>')
+
+
+def read_log(path: str) -> list:
+    with open(path, newline='', encoding='utf-8-sig') as log_file:
+        return list(csv.reader(log_file))
+
+
+@pytest.fixture
+def auditing(mocker: MockerFixture, tmp_path) -> str:
+    audit_dir = str(tmp_path / 'audit')
+    mocker.patch.dict(parser.RUN_SETTINGS, {'auditDir': audit_dir})
+    mocker.patch('parse_CTFs.config_parent_dir',
+                 return_value=str(tmp_path / 'out'))
+    mocker.patch('parse_CTFs.yes_no_q', return_value=False)
+    return audit_dir
+
+
+@pytest.mark.parametrize('streaming', [False, True])
+def test_lists_each_change(tmp_path, auditing: str, capsys, streaming: bool):
+    ctf = tmp_path / 'oak.xml'
+    ctf.write_text(CTF)
+    assert parser.process_ctf(str(ctf), streaming)
+    log_path = parser.audit_log_path(str(ctf))
+    assert f'Changes listed in: {log_path}' in capsys.readouterr().out
+    assert [list(parser.AUDIT_COLUMNS),
+            ['case', 'A1', 'Pupil/Surname', 'changed', 'SMITH', 'Smith'],
+            ['phone_numbers', 'A1', 'Pupil/Phones/Phone/PhoneNo', 'changed',
+             '01935 812345', '01935812345'],
+            ['empty_nodes', 'A1', 'Pupil/SchoolHistory/School/LeavingDate',
+             'removed', '', ''],
+            ['surnames', 'A1', 'Pupil/BasicDetails/PreferredSurname',
+             'added', '', 'Smith'],
+            ] == read_log(log_path)
+
+
+def test_header_changes_have_no_upn(tmp_path, auditing: str):
+    ctf = tmp_path / 'oak.xml'
+    ctf.write_text(CTF.replace('Oak Primary', 'OAK PRIMARY'))
+    assert parser.process_ctf(str(ctf))
+    assert ['case', '', 'CTfile/Header/SourceSchool/SchoolName', 'changed',
+            'OAK PRIMARY', 'Oak Primary'] in read_log(
+        parser.audit_log_path(str(ctf)))
+
+
+def test_no_log_without_output(tmp_path, auditing: str):
+    ctf = tmp_path / 'nameless.xml'
+    ctf.write_text(CTF.replace('<Surname>SMITH</Surname>', ''))
+    assert not parser.process_ctf(str(ctf))
+    assert [] == os.listdir(auditing)
+
+
+def test_fixers_unwrapped_unless_auditing():
+    fixers = parser.enabled_fixers()
+    assert fixers == parser.audited(fixers)
+
+
+def test_sharded_log_matches_serial_log(mocker: MockerFixture, tmp_path,
+                                        auditing: str):
+    start, end = CTF.index('<Pupil>'), CTF.index('</CTFpupilData>')
+    pupils = ''.join(CTF[start:end].replace('A1', f'A{number}')
+                     for number in range(20))
+    for name in ('serial', 'sharded'):
+        (tmp_path / f'{name}.xml').write_text(CTF[:start] + pupils +
+                                              CTF[end:])
+    assert parser.process_ctf(str(tmp_path / 'serial.xml'))
+    mocker.patch.object(parser, 'SHARD_BYTES', 200)
+    mocker.patch.dict(parser.RUN_SETTINGS, {'shardWorkers': 2})
+    assert parser.process_ctf(str(tmp_path / 'sharded.xml'))
+    serial = read_log(parser.audit_log_path(str(tmp_path / 'serial.xml')))
+    assert 81 == len(serial)
+    assert serial == read_log(
+        parser.audit_log_path(str(tmp_path / 'sharded.xml')))
+
+
+@pytest.mark.parametrize('async_io', [False, True])
+def test_batch_log_combines_new_logs(mocker: MockerFixture, tmp_path,
+                                     capsys, async_io: bool):
+    in_dir = tmp_path / 'in'
+    shutil.copytree(CTF_DIR, in_dir)
+    audit_dir = tmp_path / 'audit'
+    audit_dir.mkdir()
+    mocker.patch.dict(parser.RUN_SETTINGS, {'auditDir': str(audit_dir)})
+    # An old log, for a CTF that fails this time, isn't combined
+    with open(parser.audit_log_path(str(in_dir / 'y7_partial.xml')),
+              'w') as old_log:
+        old_log.write('old\n')
+    mocker.patch('parse_CTFs.config_parent_dir',
+                 return_value=str(tmp_path / 'out'))
+    parser.main([str(in_dir), '--workers', '2', '--mid-year', 'yes',
+                 '--abort-on-partial', 'yes', '--audit', str(audit_dir)] +
+                (['--async-io'] if async_io else []))
+    [batch_path] = audit_dir.glob('batch_*.audit.csv')
+    assert f'in 3 CTFs, listed in {batch_path}' in capsys.readouterr().out
+    rows = read_log(str(batch_path))
+    assert ['ctf'] + list(parser.AUDIT_COLUMNS) == rows[0]
+    ctf_paths = [f'{in_dir}/{name}' for name in (
+        'y12.xml', 'y7_2_students.xml', 'y7_spaced_numbers.xml')]
+    expected = [[ctf_path] + row for ctf_path in ctf_paths
+                for row in read_log(parser.audit_log_path(ctf_path))[1:]]
+    assert expected == rows[1:]
+
+
+def test_same_named_ctfs_have_their_own_logs(tmp_path, auditing: str):
+    for school in ('oak', 'ash'):
+        (tmp_path / school).mkdir()
+        (tmp_path / school / 'export.xml').write_text(
+            CTF.replace('SMITH', school.upper()))
+    log_paths = {parser.audit_log_path(str(tmp_path / school / 'export.xml'))
+                 for school in ('oak', 'ash')}
+    assert 2 == len(log_paths)
+    for school in ('oak', 'ash'):
+        assert parser.process_ctf(str(tmp_path / school / 'export.xml'))
+    assert log_paths == {os.path.join(auditing, name)
+                         for name in os.listdir(auditing)}
+    assert ['Ash', 'Oak'] == sorted(
+        read_log(log_path)[1][5] for log_path in log_paths)
@@ -0,0 +1,119 @@
+import os
+import re
+import shutil
+from test_setup import pytest, parser, mocker, MockerFixture
+from test.conftest import CTF_DIR
+
+
+@pytest.fixture
+def ctf_copies(tmp_path) -> str:
+    in_dir = tmp_path / 'in'
+    shutil.copytree(CTF_DIR, in_dir)
+    (in_dir / 'done_school_original.xml').write_text('<CTfile/>')
+    return str(in_dir)
+
+
+def test_expands_dirs_and_globs(ctf_copies: str):
+    from_dir = parser.expand_ctf_paths([ctf_copies])
+    assert sorted(os.listdir(CTF_DIR)) == [os.path.basename(path)
+                                           for path in from_dir]
+    from_glob = parser.expand_ctf_paths([os.path.join(ctf_copies, 'y7*.xml'),
+                                         from_dir[-1]])
+    assert from_dir[1:] == from_glob
+
+
+def test_batch_uses_preset_answers_in_workers(tmp_path):
+    not_xml = tmp_path / 'not_xml.xml'
+    not_xml.write_text('not XML')
+    partial = os.path.join(CTF_DIR, 'y7_partial.xml')
+    assert [False, False] == parser.process_batch(
+        [str(not_xml), partial], answers={parser.ABORT_QUESTION: True},
+        workers=2)
+    assert os.path.exists(partial)
+
+
+def test_headless_main_prints_summary(mocker: MockerFixture, ctf_copies: str,
+                                      tmp_path, capsys):
+    mocker.patch.dict(parser.RUN_SETTINGS)
+    mocker.patch('parse_CTFs.config_parent_dir',
+                 return_value=str(tmp_path / 'out'))
+    mocker.patch('parse_CTFs.input', create=True,
+                 side_effect=AssertionError('Asked the user'))
+    parser.main([ctf_copies, '--workers', '1', '--mid-year', 'yes'])
+    out = capsys.readouterr().out
+    assert 'All (4) files processed successfully' in out
+    assert 4 == len([path for path in (tmp_path / 'out').rglob('*.xml')])
+
+
+@pytest.mark.parametrize('workers, async_io', [('1', False), ('2', False),
+                                               ('2', True)])
+def test_deferred_questions_asked_at_end(mocker: MockerFixture,
+                                         ctf_copies: str, tmp_path, capsys,
+                                         workers: str, async_io: bool):
+    mocker.patch.dict(parser.RUN_SETTINGS)
+    mocker.patch('parse_CTFs.config_parent_dir',
+                 return_value=str(tmp_path / 'out'))
+    asked = mocker.patch('parse_CTFs.input', create=True, return_value='n')
+    parser.main([ctf_copies, '--workers', workers, '--mid-year', 'yes',
+                 '--abort-on-partial', 'ask'] +
+                (['--async-io'] if async_io else []))
+    asked.assert_called_once_with(
+        f'y7_partial.xml: {parser.ABORT_QUESTION} (y/n)\n')
+    out = capsys.readouterr().out
+    assert out.index('Left until the end of the batch') < out.index(
+        '1 CTF need a decision')
+    assert 'All (4) files processed successfully' in out
+    assert not os.path.exists(os.path.join(ctf_copies, 'y7_partial.xml'))
+
+
+def test_user_asked_three_times(mocker: MockerFixture):
+    asked = mocker.patch('parse_CTFs.input', create=True,
+                         side_effect=['?', 'what', '', 'y'])
+    assert not parser.ask_user(parser.MID_YEAR_QUESTION)
+    assert asked.call_count == 3
+
+
+def test_deferred_ctf_left_untouched(mocker: MockerFixture, tmp_path):
+    mocker.patch.dict(parser.RUN_SETTINGS, {
+        'decisions': 'defer', 'destinationParentDir': str(tmp_path / 'out')})
+    partial = tmp_path / 'y7_partial.xml'
+    shutil.copy(os.path.join(CTF_DIR, 'y7_partial.xml'), partial)
+    deferred = []
+    assert [False] == parser.process_batch([str(partial)], workers=1,
+                                           deferred=deferred)
+    assert deferred == [(str(partial), parser.ABORT_QUESTION)]
+    assert partial.exists()
+    assert not list((tmp_path / 'out').rglob('*.xml'))
+
+
+def undatable_ctf(tmp_path) -> str:
+    """A CTF with no creation date or year groups, which processing can't
+    file, so raises an unexpected error"""
+    text = open(os.path.join(CTF_DIR, 'y7_2_students.xml')).read()
+    path = tmp_path / 'undatable.xml'
+    path.write_text(re.sub(r'<(DateTime|NCyearActual)>.*?</\1>\n', '', text))
+    return str(path)
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_unexpected_error_fails_only_its_ctf(mocker: MockerFixture, tmp_path,
+                                             capsys, workers: int):
+    mocker.patch('parse_CTFs.config_parent_dir',
+                 return_value=str(tmp_path / 'out'))
+    good = shutil.copy(os.path.join(CTF_DIR, 'y7_2_students.xml'), tmp_path)
+    bad = undatable_ctf(tmp_path)
+    assert [False, True] == parser.process_batch([bad, good],
+                                                 workers=workers)
+    assert f'ERROR processing {bad}: AttributeError: ' in \
+        capsys.readouterr().out
+    assert os.path.exists(bad)
+
+
+def test_unexpected_error_after_deferral(mocker: MockerFixture, tmp_path,
+                                         capsys):
+    mocker.patch('parse_CTFs.input', create=True, return_value='n')
+    bad = undatable_ctf(tmp_path)
+    assert {bad: False} == parser.settle_deferred(
+        [(bad, parser.ABORT_QUESTION)])
+    assert f'ERROR processing {bad}: AttributeError: ' in \
+        capsys.readouterr().out
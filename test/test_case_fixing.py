@@ -52,3 +52,32 @@ def test_only_fixes_allcaps_nodes(case_change_and_other_nodes: ET.Element):
             (key, value) = list(value.items())[0]
             key = f"*/{key}"
         assert value == case_change_and_other_nodes.findtext(key)
+
+@pytest.mark.parametrize('name, cased', [
+    ('MCDONALD', 'McDonald'),
+    ("O'NEILL", "O'Neill"),
+    ('VAN DER BERG', 'Van der Berg'),
+    ('SMITH-MCKAY', 'Smith-McKay'),
+    ("ST MARY'S PRIMARY", "St Mary's Primary"),
+])
+def test_title_cases_names(name: str, cased: str):
+    assert cased == parser.title_case_name(name)
+
+def test_uses_case_exceptions_setting(mocker):
+    mocker.patch.dict(parser.RUN_SETTINGS, {'nameCaseExceptions': {
+        'MacDonald': 'MacDonald', 'DE LA SALLE': 'De La Salle'}})
+    root = ET.fromstring(dicttoxml({'Surname': 'MACDONALD-JONES',
+                                    'SchoolName': 'DE LA SALLE'}))
+    assert 2 == parser.repair_case_where_appropriate(root)
+    assert 'MacDonald-Jones' == root.findtext('Surname')
+    assert 'De La Salle' == root.findtext('SchoolName')
+    surname = ET.fromstring('<Surname>MACDONALD</Surname>')
+    assert parser.repair_name_case(surname)
+    assert 'MacDonald' == surname.text
+
+def test_cases_each_name_once(mocker):
+    parser.exceptions_name_caser.cache_clear()
+    title_case_name = mocker.spy(parser, 'title_case_name')
+    root = ET.fromstring(dicttoxml({'nested': [{'Surname': 'SMITH'}] * 5}))
+    assert 5 == parser.repair_case_where_appropriate(root)
+    assert 1 == title_case_name.call_count
@@ -0,0 +1,148 @@
+import os
+import re
+import shutil
+from test_setup import parser, ET, pytest, mocker, MockerFixture
+from test.conftest import CTF_DIR, copy_ctf
+
+
+def mixed_ctf(tmp_path, second_year: int, first_year: int = 6) -> str:
+    """y7_2_students.xml with its pupils moved to other year groups"""
+    def move_pupils(text: str) -> str:
+        first, second = text.split('<NCyearActual>6</NCyearActual>', 1)
+        return (first + f'<NCyearActual>{first_year}</NCyearActual>' +
+                second.replace('<NCyearActual>6</NCyearActual>',
+                               f'<NCyearActual>{second_year}</NCyearActual>'))
+    return copy_ctf(tmp_path, edit=move_pupils)
+
+
+def upns(path) -> list:
+    return [upn.text for upn in ET.parse(path).getroot().iter('UPN')]
+
+
+def only_output(out_dir: str, folder: str) -> str:
+    [name] = os.listdir(os.path.join(out_dir, folder))
+    return os.path.join(out_dir, folder, name)
+
+
+@pytest.fixture(autouse=True)
+def split_by_cohort(mocker: MockerFixture):
+    mocker.patch('parse_CTFs.cohort_folder',
+                 side_effect=lambda year_group: f'Year{year_group}')
+    mocker.patch.dict(parser.RUN_SETTINGS, {'splitByCohort': True})
+
+
+def test_pupils_filed_by_own_year_group(mocker: MockerFixture, tmp_path,
+                                        out_dir: str):
+    ctf_path = mixed_ctf(tmp_path, 9)
+    all_upns = upns(ctf_path)
+    ask = mocker.patch('parse_CTFs.yes_no_q', return_value=False)
+    assert parser.process_ctf(ctf_path)
+    ask.assert_not_called()
+    year_7 = only_output(out_dir, 'Year7')
+    in_year = only_output(out_dir, 'CTF_In')
+    assert upns(year_7) == all_upns[:1]
+    assert upns(in_year) == all_upns[1:]
+    for output in (year_7, in_year):
+        header = ET.parse(output).getroot().find('Header')
+        assert header.findtext('DocumentQualifier') == 'full'
+
+
+@pytest.mark.parametrize('mid_year, folder', [(False, 'Year12'),
+                                              (True, 'CTF_In')])
+def test_year_11s_asked_about_once(mocker: MockerFixture, tmp_path,
+                                   out_dir: str, mid_year: bool, folder: str):
+    ctf_path = mixed_ctf(tmp_path, 11)
+    mocker.patch('parse_CTFs.mid_year_from_leaving_dates',
+                 return_value=mid_year)
+    assert parser.process_ctf(ctf_path)
+    assert sorted(os.listdir(out_dir)) == sorted(['Year7', folder])
+    # The year 11 has no leaving date from the source school
+    parser.mid_year_from_leaving_dates.assert_called_once_with(None, [None])
+
+
+def test_year_groups_sharing_a_folder_share_a_ctf(
+        mocker: MockerFixture, tmp_path, out_dir: str):
+    ctf_path = mixed_ctf(tmp_path, 11, first_year=9)
+    all_upns = upns(ctf_path)
+    mocker.patch('parse_CTFs.mid_year_from_leaving_dates', return_value=True)
+    index_path = str(tmp_path / 'pupils.db')
+    mocker.patch.dict(parser.RUN_SETTINGS, {'pupilIndex': index_path})
+    assert parser.process_ctf(ctf_path)
+    assert ['CTF_In'] == os.listdir(out_dir)
+    in_year = only_output(out_dir, 'CTF_In')
+    assert all_upns == upns(in_year)
+    db = parser.open_pupil_index(index_path)
+    assert [(upn, in_year) for upn in all_upns] == db.execute(
+        'SELECT upn, output_path FROM pupils ORDER BY position').fetchall()
+    db.close()
+
+
+def test_unmixed_ctf_same_as_streamed(tmp_path, out_dir: str):
+    split_path = copy_ctf(tmp_path / 'split')
+    streamed_path = copy_ctf(tmp_path / 'streamed')
+    assert parser.process_ctf(split_path)
+    split = only_output(out_dir, 'Year7')
+    with open(split, 'rb') as split_file:
+        split_bytes = split_file.read()
+    os.remove(split)
+    parser.RUN_SETTINGS['splitByCohort'] = False
+    assert parser.process_ctf_streaming(streamed_path)
+    with open(only_output(out_dir, 'Year7'), 'rb') as streamed_file:
+        assert split_bytes == streamed_file.read()
+
+
+def test_merge_streams_pupils_under_first_header(tmp_path):
+    folder = tmp_path / 'Year7'
+    folder.mkdir()
+    shutil.copy(os.path.join(CTF_DIR, 'y7_2_students.xml'), folder)
+    # More pupils from the same school, sent later
+    (folder / 'y7_3_students.xml').write_text(
+        open(os.path.join(CTF_DIR, 'y7_2_students.xml')).read()
+        .replace('G335311012004', 'G335311012005')
+        .replace('U865346313703', 'U865346313704'))
+    [merged_path] = parser.merge_folders([str(folder)])
+    assert os.path.dirname(merged_path) == str(tmp_path / 'CTF_Merged')
+    merged = ET.parse(merged_path).getroot()
+    assert [upn.text for upn in merged.iter('UPN')] == (
+        upns(folder / 'y7_2_students.xml') +
+        upns(folder / 'y7_3_students.xml'))
+    first = ET.parse(folder / 'y7_2_students.xml').getroot()
+    assert (ET.tostring(merged.find('Header')) ==
+            ET.tostring(first.find('Header')))
+
+
+def test_merge_keeps_source_schools_apart(tmp_path):
+    folder = tmp_path / 'Year7'
+    folder.mkdir()
+    for name in ('y7_2_students.xml', 'y7_spaced_numbers.xml'):
+        shutil.copy(os.path.join(CTF_DIR, name), folder)
+    merged_paths = parser.merge_folders([str(folder)])
+    assert ["Year7_*_stickland's_ce_va_primary.xml",
+            'Year7_*_st_martins_primary.xml'] == [
+        re.sub(r'\d{8}_\d{6}', '*', os.path.basename(path))
+        for path in merged_paths]
+    for merged_path, name in zip(merged_paths, ('y7_2_students.xml',
+                                                'y7_spaced_numbers.xml')):
+        source = ET.parse(folder / name).getroot()
+        merged = ET.parse(merged_path).getroot()
+        assert upns(folder / name) == upns(merged_path)
+        assert (ET.tostring(merged.find('Header')) ==
+                ET.tostring(source.find('Header')))
+
+
+def test_merge_skips_ctfs_without_header(tmp_path, capsys):
+    folder = tmp_path / 'Year7'
+    folder.mkdir()
+    headerless = open(os.path.join(CTF_DIR, 'y7_spaced_numbers.xml')).read()
+    start, end = headerless.index('<Header>'), headerless.index('</Header>')
+    (folder / 'a_headerless.xml').write_text(
+        headerless[:start] + headerless[end + len('</Header>'):])
+    shutil.copy(os.path.join(CTF_DIR, 'y7_2_students.xml'), folder)
+    [merged_path] = parser.merge_folders([str(folder)])
+    assert f'Not merging {folder / "a_headerless.xml"}: it has no header' \
+        in capsys.readouterr().out
+    merged = ET.parse(merged_path).getroot()
+    assert upns(folder / 'y7_2_students.xml') == upns(merged_path)
+    first = ET.parse(folder / 'y7_2_students.xml').getroot()
+    assert (ET.tostring(merged.find('Header')) ==
+            ET.tostring(first.find('Header')))
@@ -0,0 +1,52 @@
+import json
+import os
+import subprocess
+import sys
+from test_setup import parser, pytest, mocker, MockerFixture
+
+
+@pytest.fixture
+def config_file(mocker: MockerFixture, tmp_path):
+    mocker.patch.object(parser, 'CONFIG', None)
+    mocker.patch.object(parser, '__file__', str(tmp_path / 'parse_CTFs.py'))
+    return tmp_path / 'CTF_parser_config.json'
+
+
+def test_config_read_once(config_file, mocker: MockerFixture):
+    config_file.write_text(json.dumps({'destinationParentDir': 'out'}))
+    load = mocker.spy(parser.json, 'load')
+    assert parser.setting('destinationParentDir') == 'out'
+    assert parser.output_parent_dir() == 'out'
+    assert load.call_count == 1
+
+
+def test_missing_config_is_empty(config_file):
+    assert parser.load_config() == {}
+
+
+@pytest.mark.parametrize('config, problem', [
+    ({'destinationParentDr': 'out'}, 'unknown setting "destinationParentDr"'),
+    ({'cacheMaxEntries': '100'}, '"cacheMaxEntries" has the wrong type'),
+    ({'cacheMaxEntries': True}, '"cacheMaxEntries" has the wrong type'),
+    ({'outputMode': 'diff'}, '"outputMode" must be one of rewrite, patch'),
+    ({'disabledFixers': ['case', 'surname']},
+     'unknown fixers in "disabledFixers": surname'),
+])
+def test_invalid_config_rejected(config_file, config: dict, problem: str):
+    config_file.write_text(json.dumps(config))
+    with pytest.raises(ValueError, match=problem):
+        parser.load_config()
+
+
+def test_main_reports_invalid_config(config_file, capsys):
+    config_file.write_text('{"destinationParentDir": ')
+    parser.main(['missing.xml'])
+    assert 'is not valid JSON' in capsys.readouterr().out
+
+
+def test_gui_modules_not_imported_on_startup():
+    code = 'import sys, parse_CTFs; print("tkinter" in sys.modules)'
+    result = subprocess.run([sys.executable, '-c', code], check=True,
+                            capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.dirname(__file__)))
+    assert result.stdout.strip() == 'False'
@@ -0,0 +1,43 @@
+from test_setup import pytest, ET, parser
+
+CONTACTS = ('<Pupil><Address><PostCode>dt93ap</PostCode></Address>'
+            '<Phones><Phone><PhoneNo>+44 1935 812345</PhoneNo></Phone></Phones>'
+            '<Contacts><Contact><Address><PostCode>DT9 3AP</PostCode>'
+            '</Address><Phones><Phone><PhoneNo>+44 1935 812345</PhoneNo>'
+            '</Phone></Phones><Email> J.Smith@Example.COM</Email></Contact>'
+            '<Contact><Email/><PhoneNo></PhoneNo></Contact></Contacts></Pupil>')
+
+
+@pytest.mark.parametrize('postcode, canonical', [
+    ('dt93ap', 'DT9 3AP'),
+    (' SW1A  1AA ', 'SW1A 1AA'),
+    ('m1 1ae', 'M1 1AE'),
+    ('Not known', 'Not known'),
+])
+def test_canonicalises_postcodes(postcode: str, canonical: str):
+    assert canonical == parser.canonical_postcode(postcode)
+
+
+@pytest.mark.parametrize('email, canonical', [
+    (' J.Smith@Example.COM ', 'J.Smith@example.com'),
+    ('j.smith @ yahoo.co.uk', 'j.smith@yahoo.co.uk'),
+    ('no address', 'noaddress'),
+])
+def test_canonicalises_emails(email: str, canonical: str):
+    assert canonical == parser.canonical_email(email)
+
+
+def test_normalises_contacts_in_one_pass():
+    root = ET.fromstring(CONTACTS)
+    assert 4 == parser.normalise_contact_details(root)
+    assert ['DT9 3AP'] * 2 == [node.text for node in root.iter('PostCode')]
+    assert ['01935812345'] * 2 == [node.text for node in root.iter('PhoneNo')
+                                   if node.text]
+    assert 'J.Smith@example.com' == root.findtext('.//Email')
+
+
+def test_repeated_numbers_canonicalised_once():
+    parser.canonical_phone_number.cache_clear()
+    root = ET.fromstring(CONTACTS)
+    parser.normalise_contact_details(root)
+    assert parser.canonical_phone_number.cache_info().misses == 1
@@ -0,0 +1,74 @@
+import os
+import sys
+from test_setup import pytest, parser, mocker, MockerFixture
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(REPO_DIR, 'benchmarks'))
+import differential  # pylint: disable=import-error
+
+PUPILS = 20
+# A few pupils per shard, so every synthetic CTF is sharded
+SHARD_BYTES = 4000
+
+
+@pytest.fixture
+def corpus(tmp_path) -> list:
+    return differential.build_corpus(str(tmp_path / 'corpus'), PUPILS)
+
+
+def test_engines_agree_on_corpus(tmp_path, corpus: list, xml_backend: str):
+    engines = differential.engines([xml_backend])
+    results = differential.compare_engines(
+        corpus, engines, str(tmp_path / 'runs'), SHARD_BYTES)
+    assert len(corpus) == len(results)
+    for ctf_path, by_engine in results.items():
+        assert list(engines) == list(by_engine)
+        for name, result in by_engine.items():
+            assert [] == result['differences'], (ctf_path, name)
+    assert 4 << 20 == parser.SHARD_BYTES
+
+
+def test_sharded_engine_shards_synthetic_ctfs(
+        mocker: MockerFixture, tmp_path, corpus: list):
+    spy = mocker.spy(parser, 'pupil_shards')
+    synthetic = [path for path in corpus if 'synthetic_' in path]
+    differential.compare_engines(
+        synthetic, {'sharded': differential.engines()['sharded']},
+        str(tmp_path / 'runs'), SHARD_BYTES)
+    shardable = [shards for shards in spy.spy_return_list if shards]
+    assert len(synthetic) - 1 == len(shardable)  # all but the commented one
+
+
+def test_differing_output_is_reported(tmp_path, corpus: list):
+    upper_case = [path for path in corpus if 'upper_case' in path]
+    engines = {'tree': differential.engines()['tree'],
+               'misspelt': (False, {'nameCaseExceptions':
+                                    {'SMITH': 'Smyth'}})}
+    results = differential.compare_engines(
+        upper_case, engines, str(tmp_path / 'runs'), SHARD_BYTES)
+    differences = results[upper_case[0]]['misspelt']['differences']
+    assert 1 == len(differences)
+    assert differences[0].startswith(
+        "CTF_Year07_2020_2021/synthetic_upper_case_st_mary's_ce_primary.xml "
+        'differs at character')
+    assert 'Smyth' in differences[0]
+    assert [] == results[upper_case[0]]['tree']['differences']
+
+
+def test_differences_in_fixes_and_folders_are_reported():
+    reference = {'success': True, 'fixes': {'case': 2},
+                 'outputs': {'CTF_In/a.xml': '<a></a>'}}
+    result = {'success': True, 'fixes': {'case': 1},
+              'outputs': {'CTF_Year07_2020_2021/a.xml': '<a></a>'}}
+    assert ["fixes: {'case': 1}, reference: {'case': 2}",
+            "output to: ['CTF_Year07_2020_2021/a.xml'], "
+            "reference: ['CTF_In/a.xml']"] == \
+        differential.differences(reference, result)
+
+
+def test_main_reports_throughput(capsys):
+    assert 0 == differential.main(['--pupils', '5', '--engines', 'patch'])
+    printed = capsys.readouterr().out
+    assert printed.startswith('Throughput (MB/s); * differs from tree\n')
+    assert 'synthetic_year_11.xml' in printed
+    assert printed.endswith('0 of 12 results differ from the reference\n')
@@ -0,0 +1,59 @@
+from test_setup import pytest, ET, parser, mocker, MockerFixture
+
+CTF = ('<CTfile><Header><SourceSchool><SchoolName>Old School</SchoolName>'
+       '</SourceSchool></Header><CTFpupilData><Pupil><Surname>SMITH</Surname>'
+       '<BasicDetails><PreferredSurname>Jones</PreferredSurname></BasicDetails>'
+       '<Phones><Phone><PhoneNo>01234 567890</PhoneNo></Phone></Phones>'
+       '</Pupil></CTFpupilData></CTfile>')
+
+
+def fix_tree(root: ET.Element, fixers: list) -> dict:
+    doc = parser.CTFContext(root, parser.get_source_school(root))
+    counts = dict.fromkeys((fixer.name for fixer in fixers), 0)
+    for _ in parser.fix_elements(parser.tree_events(root), fixers, doc,
+                                 counts):
+        pass
+    parser.finish_fixers(fixers, doc)
+    return counts
+
+
+def test_dispatch_table_respects_parent_tags():
+    fixer = parser.Fixer('test', ('SchoolHistory/School', 'PhoneNo'),
+                         lambda node, doc: 1, str)
+    table = parser.build_dispatch_table([fixer])
+    assert [('SchoolHistory', fixer)] == table['School']
+    assert [(None, fixer)] == table['PhoneNo']
+
+
+def test_single_traversal_runs_all_fixers():
+    root = ET.fromstring(CTF)
+    counts = fix_tree(root, list(parser.FIXERS.values()))
+    assert {'case': 1, 'empty_nodes': 0, 'phone_numbers': 1,
+            'postcodes': 0, 'emails': 0, 'surnames': 1} == counts
+    assert 'Smith' == root.findtext('.//PreferredSurname')
+    assert '01234567890' == root.findtext('.//PhoneNo')
+
+
+def test_fixers_can_be_disabled_in_config(mocker: MockerFixture):
+    mocker.patch('parse_CTFs.load_config',
+                 return_value={'disabledFixers': ['case', 'surnames']})
+    fixers = parser.enabled_fixers()
+    assert ['empty_nodes', 'phone_numbers', 'postcodes', 'emails'] == [
+        fixer.name for fixer in fixers]
+    root = ET.fromstring(CTF)
+    fix_tree(root, fixers)
+    assert 'SMITH' == root.findtext('.//Surname')
+    assert 'Jones' == root.findtext('.//PreferredSurname')
+
+
+def test_registered_fixers_join_the_traversal(mocker: MockerFixture):
+    mocker.patch.dict(parser.FIXERS)
+
+    @parser.register_fixer('upn', ['Pupil'], str)
+    def mark_pupil(pupil_node: ET.Element, doc: parser.CTFContext) -> int:
+        pupil_node.set('checked', 'yes')
+        return 1
+
+    root = ET.fromstring(CTF)
+    assert 1 == fix_tree(root, list(parser.FIXERS.values()))['upn']
+    assert 'yes' == root.find('.//Pupil').get('checked')
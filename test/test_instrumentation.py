@@ -0,0 +1,55 @@
+import os
+import json
+import shutil
+from test_setup import pytest, parser, mocker, MockerFixture
+
+CTF = os.path.join(os.path.dirname(__file__), 'CTFs', 'y7_spaced_numbers.xml')
+
+
+@pytest.fixture
+def ctf_copy(mocker: MockerFixture, tmp_path) -> str:
+    mocker.patch('parse_CTFs.config_parent_dir',
+                 return_value=str(tmp_path / 'out'))
+    mocker.patch('parse_CTFs.yes_no_q', return_value=False)
+    mocker.patch.dict(parser.RUN_SETTINGS)
+    shutil.copy(CTF, tmp_path / 'ctf.xml')
+    return str(tmp_path / 'ctf.xml')
+
+
+def test_disabled_instrumentation_changes_nothing(ctf_copy: str):
+    fixers = parser.enabled_fixers()
+    assert parser.process_ctf(ctf_copy)
+    assert parser.STATS is None
+    assert fixers is parser.instrumented(fixers)
+
+
+@pytest.mark.parametrize('streaming, stage', [(False, 'write'),
+                                              (True, 'parse_fix_write')])
+def test_stats_line_per_file(ctf_copy: str, tmp_path, streaming: bool,
+                             stage: str):
+    stats_log = tmp_path / 'stats.jsonl'
+    parser.RUN_SETTINGS['statsLog'] = str(stats_log)
+    assert parser.process_ctf(ctf_copy, streaming)
+    stats = json.loads(stats_log.read_text())
+    assert stats['success']
+    assert {stage, 'rename', 'total'} <= set(stats['seconds'])
+    assert set(parser.FIXERS) == set(stats['fixer_seconds'])
+    assert stats['fixes']['phone_numbers'] > 0
+    assert stats['nodes'] > 100
+
+
+def test_report_aggregates_batch(capsys):
+    stats = {'file': 'a.xml', 'seconds': {'parse': 1.0, 'total': 2.0},
+             'fixer_seconds': {'case': 0.5}, 'fixes': {'case': 3},
+             'nodes': 10}
+    parser.print_stats_report([stats, {**stats, 'file': 'b.xml'}])
+    out = capsys.readouterr().out
+    assert '2 files: 4.000s in total, 20 nodes visited' in out
+    assert '6 fixes' in out
+
+
+def test_profiles_named_file(ctf_copy: str, capsys):
+    parser.RUN_SETTINGS['profileCTF'] = 'ctf.xml'
+    assert parser.process_ctf(ctf_copy)
+    assert os.path.exists(ctf_copy + '.prof')
+    assert 'cumulative' in capsys.readouterr().out
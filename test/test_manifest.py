@@ -0,0 +1,82 @@
+import json
+import os
+from test_setup import parser, pytest, mocker, MockerFixture
+from test.conftest import copy_ctf
+
+
+@pytest.fixture(autouse=True)
+def manifests(mocker: MockerFixture):
+    mocker.patch.dict(parser.RUN_SETTINGS, {'manifest': True})
+
+
+def manifest_entries(out_dir: str) -> list:
+    entries = []
+    for folder in os.listdir(out_dir):
+        manifest_path = os.path.join(out_dir, folder, parser.MANIFEST_NAME)
+        if os.path.exists(manifest_path):
+            entries += [json.loads(line) for line in open(manifest_path)]
+    return entries
+
+
+@pytest.mark.parametrize('streaming', [False, True])
+def test_processed_ctf_recorded(tmp_path, out_dir: str, streaming: bool):
+    assert parser.process_ctf(copy_ctf(tmp_path), streaming)
+    [entry] = manifest_entries(out_dir)
+    assert entry['input'] == 'y7_2_students.xml'
+    assert entry['fixers'] == parser.fixer_signature()
+    assert os.path.exists(entry['output_path'])
+    assert entry['stamp'] == parser.file_stamp(entry['output_path'])
+    assert 'pupils' not in entry
+
+
+def test_unchanged_ctf_skipped(tmp_path, out_dir: str, mocker: MockerFixture):
+    assert parser.process_ctf(copy_ctf(tmp_path))
+    fix_ctf = mocker.spy(parser, 'fix_ctf')
+    ctf_path = copy_ctf(tmp_path)
+    assert parser.process_ctf(ctf_path)
+    fix_ctf.assert_not_called()
+    assert not os.path.exists(ctf_path)  # Renamed as if processed
+    assert len(manifest_entries(out_dir)) == 1
+
+
+def test_changed_ctf_reprocessed(tmp_path, out_dir: str,
+                                 mocker: MockerFixture):
+    assert parser.process_ctf(copy_ctf(tmp_path))
+    fix_ctf = mocker.spy(parser, 'fix_ctf')
+    assert parser.process_ctf(copy_ctf(tmp_path, edit=lambda text: text
+                                       .replace('2008-11-13', '2008-11-14')))
+    fix_ctf.assert_called_once()
+    assert len(manifest_entries(out_dir)) == 2
+
+
+def test_ctf_reprocessed_if_output_changed(tmp_path, out_dir: str,
+                                           mocker: MockerFixture):
+    assert parser.process_ctf(copy_ctf(tmp_path))
+    [entry] = manifest_entries(out_dir)
+    os.remove(entry['output_path'])
+    fix_ctf = mocker.spy(parser, 'fix_ctf')
+    assert parser.process_ctf(copy_ctf(tmp_path))
+    fix_ctf.assert_called_once()
+    assert os.path.exists(entry['output_path'])
+
+
+def test_truncated_line_ignored(tmp_path, out_dir: str):
+    assert parser.process_ctf(copy_ctf(tmp_path))
+    [entry] = manifest_entries(out_dir)
+    manifest_path = os.path.join(os.path.dirname(entry['output_path']),
+                                 parser.MANIFEST_NAME)
+    with open(manifest_path, 'a') as manifest:
+        manifest.write('{"key": "cut sho')
+    assert parser.current_manifest_entry(entry['key']) == entry
+
+
+def test_async_pipeline_records_share_paths(tmp_path, out_dir: str):
+    assert [True] == parser.process_batch_async([copy_ctf(tmp_path)],
+                                                workers=1)
+    [entry] = manifest_entries(out_dir)
+    assert entry['output_path'].startswith(out_dir)
+    assert entry['stamp'] == parser.file_stamp(entry['output_path'])
+    ctf_path = copy_ctf(tmp_path)
+    assert [True] == parser.process_batch_async([ctf_path], workers=1)
+    assert len(manifest_entries(out_dir)) == 1
+    assert not os.path.exists(ctf_path)
@@ -0,0 +1,74 @@
+import os
+import sqlite3
+import subprocess
+import sys
+from test_setup import parser, pytest, mocker, MockerFixture
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(REPO_DIR, 'benchmarks'))
+from synthetic_ctf import make_ctf  # pylint: disable=import-error
+
+# Pupils in the bulk CTF: 10,000 make a 17 MB CTF. Set CTF_BULK_PUPILS to
+# 200000 to check a 340 MB one.
+BULK_PUPILS = int(os.environ.get('CTF_BULK_PUPILS', 10000))
+MEMORY_LIMIT_MB = 64
+
+# Processes a CTF in a fresh interpreter, then prints its peak RSS in KB
+PROCESS_CTF = '''
+import sys
+import parse_CTFs as parser
+ctf_path, out_dir, db_path, backend, limit = sys.argv[1:]
+parser.RUN_SETTINGS.update(destinationParentDir=out_dir, pupilIndex=db_path,
+                           xmlBackend=backend, memoryLimitMB=float(limit))
+parser.PRESET_ANSWERS.update({parser.ABORT_QUESTION: False,
+                              parser.MID_YEAR_QUESTION: False})
+assert parser.process_ctf_quietly(ctf_path, False, {})[0]
+with open('/proc/self/status') as status:
+    print([line.split()[1] for line in status if line.startswith('VmHWM')][0])
+'''
+
+
+@pytest.fixture
+def limited(mocker: MockerFixture, tmp_path) -> str:
+    mocker.patch.dict(parser.RUN_SETTINGS, {
+        'memoryLimitMB': 0.1, 'destinationParentDir': str(tmp_path / 'out'),
+        'pupilIndex': str(tmp_path / 'pupils.db')})
+    mocker.patch.object(parser, 'PUPIL_RECORDS_IN_MEMORY', 3)
+    mocker.patch('parse_CTFs.yes_no_q', return_value=False)
+    ctf_path = tmp_path / 'bulk.xml'
+    ctf_path.write_bytes(make_ctf(10))
+    return str(ctf_path)
+
+
+def test_ctf_over_limit_streamed(limited: str, mocker: MockerFixture):
+    fix_ctf = mocker.spy(parser, 'fix_ctf')
+    streamed = mocker.spy(parser, 'fix_ctf_streaming')
+    assert parser.process_ctf(limited)
+    fix_ctf.assert_not_called()
+    streamed.assert_called_once()
+
+
+def test_pupil_records_spilled(limited: str, mocker: MockerFixture):
+    spill_pupils = mocker.spy(parser.CTFContext, 'spill_pupils')
+    assert parser.process_ctf(limited)
+    assert spill_pupils.call_count == 3
+    rows = sqlite3.connect(parser.setting('pupilIndex')).execute(
+        'SELECT COUNT(DISTINCT upn) FROM pupils').fetchone()
+    assert rows == (10,)
+
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/status'),
+                    reason='peak RSS is read from /proc')
+def test_bulk_ctf_within_memory_limit(tmp_path, xml_backend: str):
+    ctf_path = tmp_path / 'bulk.xml'
+    ctf_path.write_bytes(make_ctf(BULK_PUPILS))
+    result = subprocess.run(
+        [sys.executable, '-c', PROCESS_CTF, str(ctf_path),
+         str(tmp_path / 'out'), str(tmp_path / 'pupils.db'), xml_backend,
+         str(MEMORY_LIMIT_MB)],
+        cwd=REPO_DIR, check=True, capture_output=True, text=True)
+    peak_kb = int(result.stdout.split()[-1])
+    assert peak_kb < MEMORY_LIMIT_MB * 1024
+    rows = sqlite3.connect(tmp_path / 'pupils.db').execute(
+        'SELECT COUNT(*) FROM pupils').fetchone()
+    assert rows == (BULK_PUPILS,)
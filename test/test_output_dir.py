@@ -61,3 +61,45 @@ def test_gets_academic_year_from_DOB(ctf_data: dict,
     assert year_group == parser.ac_year(ctf)
 
 # todo: Year 11s with different leaving dates go to mid-year folder
+
+def test_context_finds_each_fact_once(mocker: MockerFixture, ctf_data: dict):
+    ctf_data['CTFpupilData']['Pupil']['BasicDetails'] = {'NCyearActual': 11}
+    ctf = ET.fromstring(dicttoxml(ctf_data))
+    history_search = mocker.spy(parser, 'source_school_appearances_in_history')
+    mocker.patch('parse_CTFs.yes_no_q', return_value=True)
+    ctx = parser.CTFContext(ctf)
+    assert 'CTF_In' == parser.get_output_dir(ctf, ctx=ctx)
+    assert parser.are_joining_mid_year(ctf, ctx=ctx)
+    history_search.assert_called_once()
+
+def test_source_school_names_may_contain_quotes():
+    ctf = ET.fromstring(
+        '<CTfile><Pupil><SchoolHistory><School><SchoolName>St Mary\'s "Lower"'
+        '</SchoolName></School></SchoolHistory></Pupil></CTfile>')
+    assert 1 == len(parser.source_school_appearances_in_history(
+        ctf, 'St Mary\'s "Lower"'))
+
+@pytest.mark.parametrize("run_date, folder", [
+    ('2020-09-30', 'CTF_Year07_2020_2021'),#Sep -> this ac-year's cohort
+    ('2020-10-01', 'CTF_Year07_2021_2022'),#Oct -> next ac-year's cohort
+])
+def test_cohort_folder_uses_run_date(mocker: MockerFixture, run_date: str,
+                                     folder: str):
+    mocker.patch.dict(parser.RUN_SETTINGS, {'runDate': run_date})
+    assert folder == parser.cohort_folder(7)
+    assert parser.cohort_resolver().today == date.fromisoformat(run_date)
+
+def test_resolver_remembers_year_groups(mocker: MockerFixture):
+    resolver = parser.CohortResolver(date(2020, 10, 1))
+    academic_year_of = mocker.spy(parser, 'academic_year_of')
+    root = ET.fromstring('<CTfile><Header><DateTime>2020-06-01T09:00:00'
+                         '</DateTime></Header><CTFpupilData><Pupil>'
+                         '<DOB>2009-01-05</DOB></Pupil></CTFpupilData>'
+                         '</CTfile>')
+    doc = parser.CTFContext(root)
+    doc.cohorts = resolver
+    for _ in range(3):
+        assert 6 == parser.pupil_year_group(root.find('.//Pupil'), doc)
+    academic_year_of.assert_called_once()
+    assert 'CTF_Year12_2021_2022' == resolver.cohort_folder(12)
+    assert resolver.cohort_folder(12) is resolver.cohort_folder(12)
@@ -0,0 +1,81 @@
+import os
+import shutil
+from test_setup import parser, ET, pytest, mocker, MockerFixture
+from test.conftest import CTF_DIR
+
+ODD_CTF = '''<?xml version="1.0" encoding="utf-8"?>
+<!-- Exported by hand -->
+<CTfile>
+  <Header><DocumentQualifier>full</DocumentQualifier>
+    <SourceSchool><SchoolName>Old &amp; School</SchoolName></SourceSchool>
+  </Header>
+  <CTFpupilData>
+    <Pupil  id='1'>
+      <Surname>SMITH</Surname>
+      <Forename>JO</Forename>
+      <BasicDetails><PreferredSurname>Smith</PreferredSurname></BasicDetails>
+      <Phones><Phone><PhoneNo> 01234 567 890 </PhoneNo></Phone></Phones>
+      <SchoolHistory><School><SchoolName>Old &amp; School</SchoolName>
+        <LeavingDate/><RemovalGrounds></RemovalGrounds>
+      </School></SchoolHistory>
+    </Pupil>
+  </CTFpupilData>
+</CTfile>
+'''
+
+
+def run_ctf(mocker: MockerFixture, tmp_path, ctf_path: str, mode: str):
+    """Process a copy of a CTF with the output mode, returning its output"""
+    in_dir = tmp_path / mode / 'in'
+    out_dir = tmp_path / mode / 'out'
+    in_dir.mkdir(parents=True)
+    shutil.copy(ctf_path, in_dir)
+    mocker.patch('parse_CTFs.config_parent_dir', return_value=str(out_dir))
+    mocker.patch('parse_CTFs.yes_no_q', return_value=False)
+    mocker.patch.dict(parser.RUN_SETTINGS, {'outputMode': mode})
+    assert parser.process_ctf(str(in_dir / os.path.basename(ctf_path)))
+    [output] = [path for path in out_dir.rglob('*') if path.is_file()]
+    return output.read_bytes()
+
+
+@pytest.mark.parametrize('ctf_name', sorted(os.listdir(CTF_DIR)))
+def test_patched_output_equivalent_to_rewritten(mocker: MockerFixture,
+                                                tmp_path, ctf_name: str):
+    ctf_path = os.path.join(CTF_DIR, ctf_name)
+    rewritten = run_ctf(mocker, tmp_path, ctf_path, 'rewrite')
+    patched = run_ctf(mocker, tmp_path, ctf_path, 'patch')
+    assert (ET.canonicalize(rewritten.decode()) ==
+            ET.canonicalize(patched.decode()))
+
+
+def test_patch_only_changes_fixed_bytes(mocker: MockerFixture, tmp_path):
+    ctf_path = tmp_path / 'odd.xml'
+    ctf_path.write_text(ODD_CTF)
+    expected = (ODD_CTF.replace('SMITH', 'Smith').replace('JO', 'Jo')
+                .replace(' 01234 567 890 ', '01234567890')
+                .replace('<LeavingDate/><RemovalGrounds></RemovalGrounds>\n'
+                         '      ', ''))
+    assert run_ctf(mocker, tmp_path, str(ctf_path), 'patch').decode() == \
+        expected
+
+
+def test_unfixed_ctf_copied_unchanged(mocker: MockerFixture, tmp_path):
+    ctf_path = tmp_path / 'clean.xml'
+    ctf_path.write_text(ODD_CTF.replace('SMITH', 'Smith').replace('JO', 'Jo')
+                        .replace(' 01234 567 890 ', '01234567890')
+                        .replace('<LeavingDate/><RemovalGrounds>',
+                                 '<RemovalGrounds>X'))
+    assert run_ctf(mocker, tmp_path, str(ctf_path), 'patch') == \
+        ctf_path.read_bytes()
+
+
+def test_pupil_with_added_nodes_serialised_in_place(mocker: MockerFixture,
+                                                     tmp_path):
+    ctf_path = tmp_path / 'added.xml'
+    ctf_path.write_text(ODD_CTF.replace(
+        '<PreferredSurname>Smith</PreferredSurname>', ''))
+    rewritten = run_ctf(mocker, tmp_path, str(ctf_path), 'rewrite')
+    patched = run_ctf(mocker, tmp_path, str(ctf_path), 'patch')
+    assert patched.startswith(ODD_CTF[:ODD_CTF.index('<Pupil')].encode())
+    assert (ET.canonicalize(rewritten.decode()) ==
+            ET.canonicalize(patched.decode()))
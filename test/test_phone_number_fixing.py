@@ -18,4 +18,24 @@ def phone_test_nodes() -> ET.Element:
 def test_fixes_phone_number_nodes(phone_test_nodes):
     assert 4 == parser.remove_spaces_from_phone_numbers(phone_test_nodes)
     for node in phone_test_nodes.findall('.//PhoneNo'):
-        assert node.text == CORRECT_NUMBER
\ No newline at end of file
+        assert node.text == CORRECT_NUMBER
+
+@pytest.mark.parametrize('number, canonical', [
+    ('07835-979-025', CORRECT_NUMBER),
+    ('(07835) 979025', CORRECT_NUMBER),
+    ('+44 7835 979025', CORRECT_NUMBER),
+    ('+44 (0)7835 979025', CORRECT_NUMBER),
+    ('0044 7835.979.025', CORRECT_NUMBER),
+    ('+33 1 23 45 67 89', '+33123456789'),
+    ('01935 123456 ext 12', '01935123456ext12'),
+    ('01935 123456 / 07700 900123', '01935123456/07700900123'),
+    ('01935 1234', '019351234'),
+    ('(01935) 123-456-7890', '(01935)123-456-7890'),
+])
+def test_canonicalises_phone_numbers(number: str, canonical: str):
+    assert canonical == parser.canonical_phone_number(number)
+
+def test_empty_phone_number_left():
+    root = ET.fromstring('<Phones><PhoneNo/><PhoneNo>0 1</PhoneNo></Phones>')
+    assert 1 == parser.remove_spaces_from_phone_numbers(root)
+    assert [None, '01'] == [node.text for node in root.iter('PhoneNo')]
@@ -0,0 +1,81 @@
+import re
+import os
+import shutil
+import sqlite3
+from test_setup import parser, pytest, mocker, MockerFixture
+from test.conftest import copy_ctf
+
+
+@pytest.fixture
+def index_path(mocker: MockerFixture, tmp_path, out_dir: str) -> str:
+    db_path = str(tmp_path / 'pupils.db')
+    mocker.patch.dict(parser.RUN_SETTINGS, {'pupilIndex': db_path})
+    return db_path
+
+
+def test_pupils_indexed_after_fixing(tmp_path, index_path: str):
+    assert parser.process_ctf(copy_ctf(tmp_path))
+    rows = sqlite3.connect(index_path).execute(
+        'SELECT upn, year_group, source_school FROM pupils').fetchall()
+    assert len(rows) == 2
+    assert [(6, "Stickland's CE VA Primary")] * 2 == [row[1:] for row in rows]
+
+
+
+def test_creation_date_only_needed_without_year_groups(tmp_path,
+                                                       index_path: str):
+    ctf_path = copy_ctf(tmp_path, 'y12.xml', edit=lambda text: re.sub(
+        r'<DateTime>.*?</DateTime>', '', text))
+    assert parser.process_ctf(ctf_path)
+    rows = sqlite3.connect(index_path).execute(
+        'SELECT year_group FROM pupils').fetchall()
+    assert [(11,)] == rows
+
+@pytest.mark.parametrize('streaming', [False, True])
+def test_reprocessing_doesnt_duplicate(tmp_path, index_path: str,
+                                       streaming: bool):
+    for _ in range(2):
+        ctf_path = copy_ctf(tmp_path)
+        assert parser.process_ctf(ctf_path, streaming)
+        shutil.rmtree(tmp_path / 'in')
+    assert parser.pupil_index_report(index_path) == []
+
+
+def test_report_flags_conflicts(tmp_path, index_path: str):
+    assert parser.process_ctf(copy_ctf(tmp_path))
+    other = copy_ctf(tmp_path / 'other', edit=lambda text: text
+                     .replace("Stickland's CE VA Primary", 'Other Primary')
+                     .replace('2008-11-13', '2008-11-14'))
+    assert parser.process_ctf(other)
+    report = parser.pupil_index_report(index_path)
+    assert len(report) == 6
+    assert report[0].endswith('in 2 CTFs with different schools, DOBs')
+    assert report[3].endswith('in 2 CTFs with different schools')
+
+
+def test_async_pipeline_indexes_share_paths(tmp_path, index_path: str):
+    ctf_path = copy_ctf(tmp_path)
+    assert [True] == parser.process_batch_async([ctf_path], workers=1)
+    paths = sqlite3.connect(index_path).execute(
+        'SELECT DISTINCT ctf_path, output_path FROM pupils').fetchall()
+    assert len(paths) == 1
+    assert paths[0][0] == ctf_path
+    assert paths[0][1].startswith(str(tmp_path / 'out'))
+    assert os.path.exists(paths[0][1])
+
+
+@pytest.mark.parametrize('streaming', [False, True])
+def test_duplicate_upns_within_a_ctf(tmp_path, index_path: str,
+                                     streaming: bool):
+    for _ in range(2):
+        ctf_path = copy_ctf(tmp_path, edit=lambda text:
+                            text.replace('U865346313703', 'G335311012004'))
+        assert parser.process_ctf(ctf_path, streaming)
+        shutil.rmtree(tmp_path / 'in')
+    report = parser.pupil_index_report(index_path)
+    assert 3 == len(report)
+    assert report[0] == ('UPN G335311012004 is used by 2 pupils in 1 CTF '
+                         'with different surnames, DOBs')
+    assert report[1].startswith('    Richie, born')
+    assert report[2].startswith('    Newman, born')
+
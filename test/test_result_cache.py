@@ -0,0 +1,78 @@
+import os
+import shutil
+import time
+from test_setup import pytest, parser, mocker, MockerFixture
+
+CTF = os.path.join(os.path.dirname(__file__), 'CTFs', 'y7_spaced_numbers.xml')
+
+
+@pytest.fixture
+def cached_run(mocker: MockerFixture, tmp_path):
+    mocker.patch('parse_CTFs.config_parent_dir',
+                 return_value=str(tmp_path / 'out'))
+    mocker.patch('parse_CTFs.yes_no_q', return_value=False)
+    mocker.patch.dict(parser.RUN_SETTINGS, {'cacheDir': str(tmp_path / 'cache')})
+    (tmp_path / 'in').mkdir()
+    return tmp_path
+
+
+def test_identical_ctf_reuses_output(mocker: MockerFixture, cached_run, capsys):
+    first = cached_run / 'in' / 'first.xml'
+    second = cached_run / 'in' / 'second.xml'
+    shutil.copy(CTF, first)
+    shutil.copy(CTF, second)
+    assert parser.process_ctf(str(first))
+    capsys.readouterr()
+
+    fix = mocker.patch('parse_CTFs.fix_ctf')
+    assert parser.process_ctf(str(second))
+    fix.assert_not_called()
+    second_out = capsys.readouterr().out
+    assert 'reusing its output' in second_out
+    assert 'Tidied 4 phone numbers' in second_out
+    outputs = sorted((cached_run / 'out').rglob('*.xml'))
+    assert 2 == len(outputs)
+    assert os.path.samefile(outputs[0], outputs[1])
+
+
+def test_skip_duplicate_writes_nothing(mocker: MockerFixture, cached_run):
+    mocker.patch.dict(parser.RUN_SETTINGS, {'onDuplicate': 'skip'})
+    for name in ['first.xml', 'second.xml']:
+        shutil.copy(CTF, cached_run / 'in' / name)
+        assert parser.process_ctf(str(cached_run / 'in' / name))
+    assert 1 == len(list((cached_run / 'out').rglob('*.xml')))
+
+
+def test_key_depends_on_enabled_fixers(mocker: MockerFixture):
+    key = parser.cache_key(CTF)
+    mocker.patch('parse_CTFs.load_config',
+                 return_value={'disabledFixers': ['case']})
+    assert key != parser.cache_key(CTF)
+
+
+def test_eviction_by_age_and_count(tmp_path):
+    for age, name in enumerate('abcd'):
+        entry = tmp_path / f'{name}.json'
+        entry.write_text('{}')
+        then = time.time() - age * 24 * 60 * 60
+        os.utime(entry, (then, then))
+    parser.evict_cache(str(tmp_path), 2, 10)
+    assert ['a.json', 'b.json'] == sorted(os.listdir(tmp_path))
+    parser.evict_cache(str(tmp_path), 10, 0.5)
+    assert ['a.json'] == os.listdir(tmp_path)
+    parser.clear_cache(str(tmp_path))
+    assert [] == os.listdir(tmp_path)
+
+
+def test_cache_evicted_once_per_batch(mocker: MockerFixture, cached_run):
+    mocker.patch.dict(parser.RUN_SETTINGS, {'cacheMaxEntries': 1})
+    evict_cache = mocker.spy(parser, 'evict_cache')
+    ctf_paths = []
+    for name in sorted(os.listdir(os.path.dirname(CTF))):
+        ctf_paths.append(shutil.copy(os.path.join(os.path.dirname(CTF), name),
+                                     cached_run / 'in'))
+    parser.main([str(path) for path in ctf_paths] + [
+        '--workers', '1', '--mid-year', 'no', '--cache',
+        str(cached_run / 'cache')])
+    evict_cache.assert_called_once_with(str(cached_run / 'cache'), 1, 90)
+    assert 1 == len(os.listdir(cached_run / 'cache'))
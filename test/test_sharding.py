@@ -0,0 +1,128 @@
+import os
+import shutil
+from test_setup import pytest, parser, mocker, MockerFixture
+from test.conftest import CTF_DIR
+
+CTF = ('<?xml version="1.0" encoding="UTF-8"?>\n<CTfile>\n<Header>\n'
+       '<DateTime>2020-06-19T12:12:27</DateTime>\n'
+       '<DocumentQualifier>full</DocumentQualifier>\n<SourceSchool>\n'
+       '<SchoolName>ST MARY\'S</SchoolName>\n</SourceSchool>\n</Header>\n'
+       '<CTFpupilData>\n{}</CTFpupilData>\n</CTfile>\n')
+PUPIL = ('<Pupil>\n<UPN>A{:012}</UPN>\n<Surname>SMITH</Surname>\n'
+         '<DOB>2008-11-13</DOB>\n<BasicDetails>\n'
+         '<NCyearActual>6</NCyearActual>\n</BasicDetails>\n'
+         '<Phones><Phone><PhoneNo>01935 812345</PhoneNo></Phone></Phones>\n'
+         '</Pupil>\n')
+
+
+def run_engine(engine, mocker: MockerFixture, tmp_path, ctf_path: str):
+    """Run `engine` on a copy of a CTF, returning its output files"""
+    in_dir = tmp_path / engine.__name__ / 'in'
+    out_dir = tmp_path / engine.__name__ / 'out'
+    in_dir.mkdir(parents=True)
+    shutil.copy(ctf_path, in_dir)
+    mocker.patch('parse_CTFs.config_parent_dir', return_value=str(out_dir))
+    mocker.patch('parse_CTFs.yes_no_q', return_value=False)
+    assert engine(str(in_dir / os.path.basename(ctf_path)))
+    return {path.relative_to(out_dir): path.read_bytes()
+            for path in out_dir.rglob('*') if path.is_file()}
+
+
+@pytest.fixture
+def sharding(mocker: MockerFixture):
+    """Shard every CTF, a pupil or two per shard, over two workers"""
+    mocker.patch.object(parser, 'SHARD_BYTES', 200)
+    mocker.patch.dict(parser.RUN_SETTINGS, {'shardWorkers': 2})
+
+
+@pytest.mark.parametrize('ctf_name', sorted(os.listdir(CTF_DIR)))
+def test_sharded_output_matches_serial_output(
+        mocker: MockerFixture, tmp_path, sharding, ctf_name: str):
+    ctf_path = os.path.join(CTF_DIR, ctf_name)
+    sharded = run_engine(parser.process_ctf, mocker, tmp_path, ctf_path)
+    parser.RUN_SETTINGS.pop('shardWorkers')
+    assert sharded == run_engine(parser.process_ctf_streaming, mocker,
+                                 tmp_path, ctf_path)
+
+
+def test_many_shards_keep_pupil_order(mocker: MockerFixture, tmp_path,
+                                      sharding):
+    ctf = tmp_path / 'many.xml'
+    ctf.write_text(CTF.format(''.join(map(PUPIL.format, range(50)))))
+    assert len(parser.pupil_shards(ctf.read_bytes(), 200)) > 10
+    spy = mocker.spy(parser, 'add_shard')
+    sharded = run_engine(parser.process_ctf, mocker, tmp_path, str(ctf))
+    assert spy.call_count > 10
+    parser.RUN_SETTINGS.pop('shardWorkers')
+    assert sharded == run_engine(parser.process_ctf, mocker,
+                                 tmp_path / 'serial', str(ctf))
+
+
+def test_counts_fixes_across_shards(mocker: MockerFixture, tmp_path,
+                                    sharding):
+    ctf = tmp_path / 'counted.xml'
+    ctf.write_text(CTF.format(''.join(map(PUPIL.format, range(20)))))
+    mocker.patch('parse_CTFs.config_parent_dir',
+                 return_value=str(tmp_path / 'out'))
+    result = parser.fix_ctf_sharded(str(ctf))
+    assert 20 == result['counts']['phone_numbers']
+    assert 21 == result['counts']['case']
+    assert 'ctf_year07_' in result['output_dir'].casefold()
+
+
+@pytest.mark.parametrize('ctf', [
+    CTF.format('<!-- pupils -->\n' + PUPIL.format(1)),
+    CTF.replace('<CTfile>', '<CTfile xmlns="urn:ctf">').format(PUPIL.format(1)),
+    CTF.replace('UTF-8', 'ISO-8859-1').format(PUPIL.format(1)),
+    CTF.format(''),
+])
+def test_unshardable_ctfs(ctf: str):
+    assert parser.pupil_shards(ctf.encode('latin-1'), 200) is None
+
+
+def test_unshardable_ctf_is_streamed(mocker: MockerFixture, tmp_path,
+                                     sharding):
+    ctf = tmp_path / 'commented.xml'
+    ctf.write_text(CTF.format('<!-- pupils -->\n' + PUPIL.format(1)))
+    streamed = mocker.spy(parser, 'fix_ctf_streaming')
+    mocker.patch('parse_CTFs.config_parent_dir',
+                 return_value=str(tmp_path / 'out'))
+    assert parser.fix_ctf_sharded(str(ctf))
+    streamed.assert_called_once()
+
+
+def test_sharding_rejects_nameless_pupils(mocker: MockerFixture, tmp_path,
+                                          sharding):
+    ctf = tmp_path / 'nameless.xml'
+    ctf.write_text(CTF.format(PUPIL.format(1) * 5 + '<Pupil><UPN>err1</UPN>'
+                              '<BasicDetails/></Pupil>\n'))
+    mocker.patch('parse_CTFs.config_parent_dir',
+                 return_value=str(tmp_path / 'out'))
+    assert not parser.process_ctf(str(ctf))
+    assert ctf.exists()
+    assert [] == [path for path in (tmp_path / 'out').rglob('*')
+                  if path.is_file()]
+
+
+def test_small_ctfs_not_sharded(mocker: MockerFixture, tmp_path):
+    ctf = tmp_path / 'small.xml'
+    ctf.write_text(CTF.format(PUPIL.format(1)))
+    mocker.patch.dict(parser.RUN_SETTINGS, {'shardWorkers': 4})
+    assert not parser.should_shard(str(ctf))
+    mocker.patch.object(parser, 'SHARD_BYTES', 100)
+    assert parser.should_shard(str(ctf))
+    parser.RUN_SETTINGS['outputMode'] = 'patch'
+    assert not parser.should_shard(str(ctf))
+
+
+def test_malformed_shard_fails_cleanly(mocker: MockerFixture, tmp_path,
+                                       sharding):
+    ctf = tmp_path / 'malformed.xml'
+    ctf.write_text(CTF.format(PUPIL.format(1) * 5 + '<Pupil><UPN>err1</UPN>'
+                              '</Pupi>\n' + PUPIL.format(2)))
+    mocker.patch('parse_CTFs.config_parent_dir',
+                 return_value=str(tmp_path / 'out'))
+    assert not parser.process_ctf(str(ctf))
+    assert ctf.exists()
+    assert [] == [path for path in (tmp_path / 'out').rglob('*')
+                  if path.is_file()]
@@ -0,0 +1,61 @@
+import os
+import shutil
+from test_setup import pytest, parser, mocker, MockerFixture
+from test.conftest import CTF_DIR
+
+
+def run_engine(engine, mocker: MockerFixture, tmp_path, ctf_name: str,
+               ctf_dir: str = CTF_DIR):
+    """Run `engine` on a copy of a sample CTF, returning its output files"""
+    in_dir = tmp_path / engine.__name__ / 'in'
+    out_dir = tmp_path / engine.__name__ / 'out'
+    in_dir.mkdir(parents=True)
+    shutil.copy(os.path.join(ctf_dir, ctf_name), in_dir)
+    mocker.patch('parse_CTFs.config_parent_dir', return_value=str(out_dir))
+    mocker.patch('parse_CTFs.yes_no_q', return_value=False)
+    assert engine(str(in_dir / ctf_name))
+    return {path.relative_to(out_dir): path.read_bytes()
+            for path in out_dir.rglob('*') if path.is_file()}
+
+
+@pytest.mark.parametrize('ctf_name', sorted(os.listdir(CTF_DIR)))
+def test_streaming_output_matches_tree_output(mocker: MockerFixture, tmp_path,
+                                              ctf_name: str):
+    expected = run_engine(parser.process_ctf, mocker, tmp_path, ctf_name)
+    assert expected == run_engine(parser.process_ctf_streaming, mocker,
+                                  tmp_path, ctf_name)
+
+
+def test_streaming_rejects_nameless_pupils(mocker: MockerFixture, tmp_path):
+    ctf = tmp_path / 'nameless.xml'
+    ctf.write_text('<CTfile><Header><DocumentQualifier>full</DocumentQualifier>'
+                   '</Header><CTFpupilData><Pupil><UPN>err1</UPN>'
+                   '<BasicDetails/></Pupil></CTFpupilData></CTfile>')
+    mocker.patch('parse_CTFs.config_parent_dir',
+                 return_value=str(tmp_path / 'out'))
+    assert not parser.process_ctf_streaming(str(ctf))
+    assert ctf.exists()
+    assert [] == [path for path in (tmp_path / 'out').rglob('*')
+                  if path.is_file()]
+
+
+def test_pupils_ending_at_read_boundaries_keep_tails(mocker: MockerFixture,
+                                                     tmp_path):
+    # iterparse reads 16 KiB (etree) or 32 KiB (lxml) at a time, so every
+    # pupil ends a read here, before the newline after it has been parsed
+    head = ('<?xml version="1.0" encoding="UTF-8"?>\n<CTfile><Header>'
+            '<DocumentQualifier>full</DocumentQualifier></Header>'
+            '<CTFpupilData>\n')
+    pupil = ('<Pupil><UPN>A{}</UPN><Surname>{}</Surname><BasicDetails/>'
+             '</Pupil>')
+    padding = 16384 - len(pupil.format(0, '')) - 1
+    pupils = [pupil.format(number, 'x' * padding) for number in range(8)]
+    pupils[0] = pupil.format(0, 'x' * (padding + 1 - len(head)))
+    ctf = tmp_path / 'boundaries.xml'
+    ctf.write_text(head + ''.join(p + '\n' for p in pupils) +
+                   '</CTFpupilData></CTfile>\n')
+    assert 16384 == ctf.read_text().index('</Pupil>') + len('</Pupil>')
+    expected = run_engine(parser.process_ctf, mocker, tmp_path, ctf.name,
+                          str(tmp_path))
+    assert expected == run_engine(parser.process_ctf_streaming, mocker,
+                                  tmp_path, ctf.name, str(tmp_path))
@@ -0,0 +1,96 @@
+import json
+import os
+from test_setup import parser, pytest, mocker, MockerFixture
+from test.conftest import CTF_DIR, copy_ctf
+
+# Accepts any document whose root is a CTfile
+CTFILE_XSD = '''<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema">
+<xs:element name="CTfile"><xs:complexType><xs:sequence>
+<xs:any processContents="skip" maxOccurs="unbounded"/>
+</xs:sequence></xs:complexType></xs:element></xs:schema>'''
+
+
+def test_valid_ctf_untouched(tmp_path):
+    ctf_path = copy_ctf(tmp_path)
+    report = parser.validate_ctf(ctf_path)
+    assert report['valid']
+    assert report['errors'] == report['warnings'] == []
+    assert report['fixes']['phone_numbers'] == 3
+    assert os.listdir(tmp_path / 'in') == ['y7_2_students.xml']
+    assert open(ctf_path).read() == open(
+        os.path.join(CTF_DIR, 'y7_2_students.xml')).read()
+
+
+def test_invalid_ctf_errors(tmp_path):
+    report = parser.validate_ctf(copy_ctf(tmp_path, edit=lambda text: text
+        .replace('<DocumentQualifier>full', '<DocumentQualifier>fuller')
+        .replace('<DOB>2008-11-13</DOB>', '')
+        .replace('2020-02-14', '2020-02-30')
+        .replace('<Surname>Newman</Surname>', '')
+        .replace('<PreferredSurname>Newman</PreferredSurname>', '')))
+    assert not report['valid']
+    assert report['errors'] == [
+        'DocumentQualifier is non-standard: fuller',
+        'Pupil G335311012004 has no DOB',
+        'Pupil G335311012004 LeavingDate is not a valid date: 2020-02-30',
+        'Students with these UPNs have no surnames: U865346313703. This CTF '
+        'is invalid.']
+
+
+def test_partial_ctf_warned():
+    report = parser.validate_ctf(os.path.join(CTF_DIR, 'y7_partial.xml'))
+    assert report['valid']
+    assert len(report['warnings']) == 1
+
+
+def test_malformed_ctf_invalid(tmp_path):
+    report = parser.validate_ctf(copy_ctf(tmp_path,
+                                          edit=lambda text: text[:-20]))
+    assert not report['valid']
+    assert report['errors'][0].startswith('Not well-formed XML')
+
+
+@pytest.mark.skipif(parser.lxml_etree is None, reason='needs lxml')
+def test_schema_checked(tmp_path):
+    schema_path = tmp_path / 'ctf.xsd'
+    schema_path.write_text(CTFILE_XSD)
+    assert parser.validate_ctf(copy_ctf(tmp_path), str(schema_path))['valid']
+    renamed = copy_ctf(tmp_path, edit=lambda text:
+                       text.replace('CTfile', 'CTF'))
+    report = parser.validate_ctf(renamed, str(schema_path))
+    assert report['errors'][0].startswith('Schema, line 2:')
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_unreadable_ctf_reported(tmp_path, workers: int):
+    missing = str(tmp_path / 'mistyped.xml')
+    reports = parser.validate_batch([missing, copy_ctf(tmp_path)],
+                                    workers=workers)
+    assert [False, True] == [report['valid'] for report in reports]
+    assert reports[0]['errors'][0].startswith("Can't be read: ")
+
+
+@pytest.mark.skipif(parser.lxml_etree is None, reason='needs lxml')
+def test_unloadable_schema_reported(tmp_path):
+    report = parser.validate_ctf(copy_ctf(tmp_path),
+                                 str(tmp_path / 'missing.xsd'))
+    assert not report['valid']
+    assert report['errors'][0].startswith("The schema can't be loaded: ")
+
+
+def test_backend_used_in_this_process(mocker: MockerFixture, tmp_path):
+    mocker.patch.dict(parser.RUN_SETTINGS, {'xmlBackend': 'etree'})
+    parser.validate_batch([copy_ctf(tmp_path)], workers=1)
+    assert parser.ET is parser.XML_BACKENDS['etree']
+
+def test_main_saves_json_report(tmp_path, capsys):
+    ctf_paths = [copy_ctf(tmp_path, name=name) for name in os.listdir(CTF_DIR)]
+    report_path = tmp_path / 'report.json'
+    parser.main(['--validate', '--workers', '2', '--report',
+                 str(report_path)] + ctf_paths)
+    reports = json.loads(report_path.read_text())
+    assert [report['ctf_path'] for report in reports] == ctf_paths
+    assert all(report['valid'] for report in reports)
+    assert '4 of 4 CTFs valid' in capsys.readouterr().out
+    assert not any('original' in name
+                   for name in os.listdir(tmp_path / 'in'))
@@ -0,0 +1,75 @@
+import re
+import os
+import json
+import shutil
+from test_setup import parser, mocker, MockerFixture
+from test.conftest import CTF_DIR
+
+
+def stop_after(polls: int):
+    calls = []
+
+    def stop() -> bool:
+        calls.append(None)
+        return len(calls) > polls
+    return stop
+
+
+def test_only_settled_unprocessed_files_are_ready(tmp_path):
+    ctf = tmp_path / 'new.xml'
+    ctf.write_text('<CTfile>')
+    last_seen = {}
+    assert [] == parser.settled_ctfs(str(tmp_path), last_seen, {})
+    ready = parser.settled_ctfs(str(tmp_path), last_seen, {})
+    assert ['new.xml'] == [name for name, _ in ready]
+    record = {'new.xml': ready[0][1] + [False]}
+    assert [] == parser.settled_ctfs(str(tmp_path), last_seen, record)
+
+    ctf.write_text('<CTfile></CTfile>')
+    assert [] == parser.settled_ctfs(str(tmp_path), last_seen, record)
+    assert 1 == len(parser.settled_ctfs(str(tmp_path), last_seen, record))
+
+
+def test_watch_processes_arrivals_and_records_them(mocker: MockerFixture,
+                                                   tmp_path):
+    inbox = tmp_path / 'inbox'
+    inbox.mkdir()
+    shutil.copy(os.path.join(CTF_DIR, 'y12.xml'), inbox)
+    (inbox / 'broken.xml').write_text('not XML')
+    mocker.patch('parse_CTFs.config_parent_dir',
+                 return_value=str(tmp_path / 'out'))
+    parser.watch_folder(str(inbox), answers={parser.MID_YEAR_QUESTION: True},
+                        workers=1, poll_interval=0, stop=stop_after(3))
+
+    assert 1 == len(list((tmp_path / 'out').rglob('*.xml')))
+    record = json.loads((inbox / parser.WATCH_RECORD_NAME).read_text())
+    assert {'y12.xml': True, 'broken.xml': False} == {
+        name: stamp[2] for name, stamp in record.items()}
+
+    # A restarted watch leaves the failed file alone
+    process = mocker.patch('parse_CTFs.process_ctf_quietly')
+    parser.watch_folder(str(inbox), workers=1, poll_interval=0,
+                        stop=stop_after(3))
+    process.assert_not_called()
+
+
+def test_watch_survives_unexpected_errors(mocker: MockerFixture, tmp_path,
+                                          capsys):
+    inbox = tmp_path / 'inbox'
+    inbox.mkdir()
+    shutil.copy(os.path.join(CTF_DIR, 'y12.xml'), inbox)
+    # No creation date or year groups, so processing raises
+    text = open(os.path.join(CTF_DIR, 'y7_2_students.xml')).read()
+    (inbox / 'undatable.xml').write_text(
+        re.sub(r'<(DateTime|NCyearActual)>.*?</\1>\n', '', text))
+    mocker.patch('parse_CTFs.config_parent_dir',
+                 return_value=str(tmp_path / 'out'))
+    parser.watch_folder(str(inbox), answers={parser.MID_YEAR_QUESTION: True},
+                        workers=1, poll_interval=0, stop=stop_after(3))
+
+    assert 1 == len(list((tmp_path / 'out').rglob('*.xml')))
+    record = json.loads((inbox / parser.WATCH_RECORD_NAME).read_text())
+    assert {'y12.xml': True, 'undatable.xml': False} == {
+        name: stamp[2] for name, stamp in record.items()}
+    assert f"ERROR processing {inbox / 'undatable.xml'}: AttributeError" in \
+        capsys.readouterr().out
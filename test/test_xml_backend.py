@@ -0,0 +1,34 @@
+from test_setup import parser, ET, pytest, mocker, MockerFixture
+
+
+def test_missing_lxml_falls_back_to_etree(mocker: MockerFixture):
+    mocker.patch('parse_CTFs.lxml_etree', None)
+    assert parser.use_backend('lxml') == 'etree'
+    assert parser.ET is ET
+    assert parser.use_backend('auto') == 'etree'
+
+
+def test_unknown_backend_rejected():
+    with pytest.raises(ValueError):
+        parser.use_backend('minidom')
+
+
+@pytest.mark.skipif(parser.lxml_etree is None, reason='lxml not installed')
+def test_history_search_same_on_each_backend():
+    xml = (b'<CTfile><CTFpupilData><Pupil><SchoolHistory>'
+           b'<School><SchoolName>A "B" School</SchoolName></School>'
+           b'<School><SchoolName>Other</SchoolName></School>'
+           b'</SchoolHistory></Pupil></CTFpupilData></CTfile>')
+    for root in (ET.fromstring(xml), parser.lxml_etree.fromstring(xml)):
+        found = parser.source_school_appearances_in_history(
+            root, 'A "B" School')
+        assert [node.find('SchoolName').text for node in found] == [
+            'A "B" School']
+
+
+def test_empty_leaving_date_trimmed():
+    school = ET.fromstring('<School><LeavingDate/><RemovalGrounds>X'
+                           '</RemovalGrounds></School>')
+    parser.trim_empty_history_nodes(school)
+    assert school.find('LeavingDate') is None
+    assert school.find('RemovalGrounds') is not None